@@ -0,0 +1,221 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+"""Benchmarks of the ClimAgent tools over synthetic datasets of increasing size.
+
+Every case runs in a fresh process, so that peak RSS is not polluted by
+the previous ones. Usage (from the repository root):
+
+    python benchmarks/run_benchmarks.py --sizes small medium
+    python benchmarks/run_benchmarks.py --sizes small --save-baseline
+    python benchmarks/run_benchmarks.py --sizes small --compare
+    python benchmarks/run_benchmarks.py --cases --import-budget
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [BENCHMARKS_DIR, os.path.join(BENCHMARKS_DIR, "..", "src")]
+
+# Imported here, so that import time is not part of the measurements
+from langchain_core.messages import AIMessage, HumanMessage
+from climagent.agent.climagent import ClimAgent
+from climagent.agent.replay_llm import ScriptedChatModel
+from climagent.state.dataset_state import DatasetState
+from climagent.state.json_state import JsonState
+from climagent.state.operation_plan import Subset
+from climagent.startup import IMPORT_BUDGET, import_time
+from climagent.tools.xarray_tools_indexing import SubsetDatasetTool, SelectVariablesTool
+from climagent.tools.xarray_tools_grouping import ResampleTimeTool
+from climagent.tools.xarray_tools_aggregating import AggregateDatasetTool
+from climagent.tools.xarray_tools_look import LookDatasetTool
+from synthetic import SIZES, make_dataset
+
+BASELINE_FILE = os.path.join(BENCHMARKS_DIR, "baselines", f"{platform.node() or 'default'}.json")
+
+# Subsets applied before each tool on dask chunked sizes, so that the values
+# materialized by a benchmark stay bounded whatever the dataset size
+BOUNDING_CALLS = [
+    ("subset_dataset", {"coordinate_name": "time", "values": ["1980-01-01", "1980-01-07"]}),
+    ("subset_dataset", {"coordinate_name": "latitude", "values": ["50", "40"]}),
+]
+
+TOOL_CASES = {
+    "subset": [("subset_dataset", {"coordinate_name": "latitude", "values": ["60", "30"]})],
+    "select_variables": [("select_variables", {"variable_names": ["t2m"]})],
+    "resampletime_dataset": [("resampletime_dataset", {"coordinate_name": "time", "frequency": "1D"})],
+    "aggregate_dataset": [("aggregate_dataset", {"func": "mean", "dims": ["time"]})],
+    "look_dataset": [("look_dataset", {"max_chars": 10000})],
+}
+
+OTHER_CASES = ["json_state", "update_json_spec", "agent_run"]
+
+# A regression is reported when a metric grows by more than this fraction and the noise floor
+TOLERANCE = 0.25
+NOISE_FLOOR = {"wall_time_s": 0.05, "peak_rss_delta_mb": 16.0, "materialized_mb": 16.0}
+
+
+def _max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss / 1024 ** 2 if sys.platform == "darwin" else rss / 1024
+
+
+def _make_tools(dataset):
+    dataset_state, json_state = DatasetState(dataset), JsonState(dataset)
+    tools = [t(dataset_state=dataset_state, json_state=json_state) for t in
+             (SubsetDatasetTool, SelectVariablesTool, ResampleTimeTool, AggregateDatasetTool, LookDatasetTool)]
+    return dataset_state, {t.name: t for t in tools}
+
+
+def _scripted_llm(calls):
+    tool_calls = [{"name": name, "args": args, "id": f"call_{i}", "type": "tool_call"}
+                  for i, (name, args) in enumerate(calls)]
+    return ScriptedChatModel(script=["No plan needed", AIMessage(content="", tool_calls=tool_calls), "Done."])
+
+
+def _run_case(case, dataset, bounding):
+    """Runs a case and returns the number of bytes of its result."""
+    if case in TOOL_CASES:
+        dataset_state, tools = _make_tools(dataset)
+        for name, args in bounding + TOOL_CASES[case]:
+            result = tools[name].invoke(args)
+            if str(result).startswith("Error"):
+                raise RuntimeError(result)
+        return dataset_state.dataset.nbytes if case != "look_dataset" else len(result)
+
+    if case == "json_state":
+        JsonState(dataset)
+        return 0
+
+    if case == "update_json_spec":
+        json_state = JsonState(dataset)
+        operation = Subset(coordinate_name="latitude", values=(60, 30))
+        json_state.update_json_spec(operation.apply(dataset), operation)
+        return 0
+
+    if case == "agent_run":
+        calls = bounding + [
+            ("subset_dataset", {"coordinate_name": "latitude", "values": ["60", "30"]}),
+            ("resampletime_dataset", {"coordinate_name": "time", "frequency": "1D"}),
+            ("aggregate_dataset", {"func": "mean", "dims": ["longitude"]}),
+            ("look_dataset", {"max_chars": 10000}),
+        ]
+        agent = ClimAgent(dataset, _scripted_llm(calls))
+        agent.run([HumanMessage("Daily mean over the 60N-30N band.")])
+        return 0
+
+    raise ValueError(f"Unknown case {case}")
+
+
+def _worker(size, kind, case, queue):
+    try:
+        dataset = make_dataset(size, kind)
+        bounding = list(BOUNDING_CALLS) if SIZES[size][-1] else []
+
+        rss_before = _max_rss_mb()
+        tracemalloc.start()
+        start = time.perf_counter()
+        result_bytes = _run_case(case, dataset, bounding)
+        wall_time = time.perf_counter() - start
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        queue.put({
+            "size": size, "kind": kind, "case": case,
+            "wall_time_s": wall_time,
+            "peak_rss_mb": _max_rss_mb(),
+            "peak_rss_delta_mb": _max_rss_mb() - rss_before,
+            "materialized_mb": traced_peak / 1024 ** 2,
+            "result_bytes": result_bytes,
+        })
+    except Exception as e:
+        queue.put({"size": size, "kind": kind, "case": case, "error": f"{type(e).__name__}: {e}"})
+
+
+def run_case(size, kind, case):
+    """Runs a single case in a fresh process."""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_worker, args=(size, kind, case, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def compare(results, baseline):
+    """Returns the regressions of `results` with respect to `baseline`."""
+    reference = {(r["size"], r["kind"], r["case"]): r for r in baseline}
+    regressions = []
+    for r in results:
+        base = reference.get((r["size"], r["kind"], r["case"]))
+        if base is None or "error" in r or "error" in base:
+            continue
+        for metric, floor in NOISE_FLOOR.items():
+            if r[metric] > base[metric] * (1 + TOLERANCE) and r[metric] - base[metric] > floor:
+                regressions.append(f"{r['size']}/{r['kind']}/{r['case']}: {metric} {base[metric]:.3f} -> {r[metric]:.3f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=["small"], choices=["small", "medium", "large", "huge"])
+    parser.add_argument("--kind", default="era5", choices=["era5", "cmip"])
+    parser.add_argument("--cases", nargs="*", default=list(TOOL_CASES) + OTHER_CASES)
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--import-budget", nargs="?", type=float, const=IMPORT_BUDGET, default=None,
+                        help="Fail if importing climagent.agent.climagent takes longer (seconds) in a fresh interpreter.")
+    args = parser.parse_args()
+
+    over_budget = False
+    if args.import_budget is not None:
+        seconds = import_time("climagent.agent.climagent")
+        over_budget = seconds > args.import_budget
+        print(f"import climagent.agent.climagent {seconds:9.3f} s (budget {args.import_budget:.3f} s)"
+              f"{' OVER BUDGET' if over_budget else ''}")
+
+    results = []
+    for size in args.sizes:
+        for case in args.cases:
+            result = run_case(size, args.kind, case)
+            results.append(result)
+            if "error" in result:
+                print(f"{size:>6} {case:<22} ERROR {result['error']}")
+            else:
+                print(f"{size:>6} {case:<22} {result['wall_time_s']:9.3f} s {result['peak_rss_mb']:9.1f} MB peak "
+                      f"{result['peak_rss_delta_mb']:9.1f} MB delta {result['materialized_mb']:9.1f} MB materialized")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f))
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions or over_budget else 0)
+
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
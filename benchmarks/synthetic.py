@@ -0,0 +1,53 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+# (time steps, latitudes, longitudes, variables, dask chunks along time), float32 values
+SIZES = {
+    "small": (24 * 30, 36, 72, 2, None),             # ~15 MB
+    "medium": (24 * 365, 73, 144, 2, None),           # ~0.7 GB
+    "large": (24 * 365 * 5, 181, 360, 2, 24 * 7),     # ~23 GB, dask chunked
+    "huge": (24 * 365 * 40, 721, 1440, 4, 24),        # ~1.5 TB, dask chunked
+}
+
+# Time step of each kind of dataset: hourly reanalysis or daily climate projections
+FREQUENCIES = {"era5": "h", "cmip": "D"}
+
+VARIABLES = [
+    ("t2m", "2 metre temperature", "K", 285.0, 12.0),
+    ("tp", "Total precipitation", "m", 0.0005, 0.001),
+    ("u10", "10 metre U wind component", "m s**-1", 0.0, 5.0),
+    ("v10", "10 metre V wind component", "m s**-1", 0.0, 5.0),
+]
+
+
+def make_dataset(size: str = "small", kind: str = "era5", seed: int = 0) -> xr.Dataset:
+    """ERA5/CMIP-like synthetic dataset (time x latitude x longitude x variables).
+
+    Sizes with chunks are backed by lazy dask random arrays, so datasets
+    larger than RAM are never generated in memory.
+    """
+    n_time, n_lat, n_lon, n_vars, chunks = SIZES[size]
+
+    coords = {
+        "time": pd.date_range("1980-01-01", periods=n_time, freq=FREQUENCIES[kind]),
+        "latitude": np.linspace(90, -90, n_lat),
+        "longitude": np.linspace(0, 360, n_lon, endpoint=False),
+    }
+    dims = ("time", "latitude", "longitude")
+    shape = (n_time, n_lat, n_lon)
+
+    data_vars = {}
+    for i, (name, long_name, units, loc, scale) in enumerate(VARIABLES[:n_vars]):
+        if chunks:
+            import dask.array as da
+            values = da.random.RandomState(seed + i).normal(loc, scale, shape, chunks=(chunks, n_lat, n_lon)).astype("float32")
+        else:
+            values = np.random.default_rng(seed + i).normal(loc, scale, shape).astype("float32")
+        data_vars[name] = (dims, values, {"long_name": long_name, "units": units})
+
+    return xr.Dataset(data_vars, coords=coords, attrs={"title": f"Synthetic {kind} dataset ({size})"})
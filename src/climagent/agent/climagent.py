@@ -2,47 +2,55 @@
 # Institute: Politecnico di Torino
 
 import os
-import xarray as xr
-from langgraph.graph import StateGraph, END
+import copy
+import asyncio
+from typing import TYPE_CHECKING, Union
 
 
-from langchain_core.messages import AnyMessage, ToolMessage, SystemMessage
+from langchain_core.messages import AIMessage, AnyMessage, ToolMessage, SystemMessage
 
 
-# Import tools and memory modules
-from climagent.tools.json_tools import JsonGetValueTool_custom, JsonListKeysTool_custom
-from climagent.tools.xarray_tools_indexing import SubsetDatasetTool, SelectVariablesTool
-from climagent.tools.xarray_tools_grouping import ResampleTimeTool
-from climagent.tools.xarray_tools_aggregating import AggregateDatasetTool
-from climagent.tools.xarray_tools_look import LookDatasetTool
+# Heavy modules (xarray, langgraph, the tools and their dependencies) are
+# imported when the first agent is built rather than with this module, see
+# climagent.startup to load them ahead of time.
+from climagent.tools.tool_executor import map_blocking
+from climagent.tracing import Tracer, span, token_usage
 from climagent.agent.prefix import PREFIX
 from climagent.agent.suffix import make_suffix
-
-from climagent.state.dataset_state import DatasetState
-from climagent.state.json_state import JsonState
+from climagent.agent.compaction import compact_messages
 from climagent.state.agent_state import State
 
+if TYPE_CHECKING:
+    import xarray as xr
+    from climagent.state.catalog import DatasetCatalog
+    from climagent.state.result_cache import ResultCache
+    from climagent.state.prefetch import Prefetcher
+
 
 
 class ClimAgent:
-    def __init__(self, dataset: xr.Dataset, llm, state = State, llm_temperature: float = 0.0):
-        
+    def __init__(self, dataset: Union["xr.Dataset", "DatasetCatalog"], llm, state = State, llm_temperature: float = 0.0, cache: "ResultCache" = None,
+                 trace_sinks: list = None, max_context_tokens: int = 32000, structured_plan: bool = False, prefetcher: "Prefetcher" = None):
+        from climagent.state.dataset_state import DatasetState
+        from climagent.state.json_state import JsonState
+
         # Load dataset
         self.dataset = dataset
-        self.dataset_state = DatasetState(self.dataset)
-        self.json_state = JsonState(self.dataset)
+        self.dataset_state = DatasetState(self.dataset, cache=cache, prefetcher=prefetcher)
+        self.json_state = JsonState(self.dataset_state.dataset_original, source=self.dataset_state.catalog)
         self.state = state
+
+        # Sinks receiving the spans of each run, besides the ones attached to the result
+        self.trace_sinks = trace_sinks or []
+
+        # Token budget of the messages sent to the LLM, older tool outputs are compacted above it
+        self.max_context_tokens = max_context_tokens
+
+        # When True, the planner returns a tool pipeline executed in one pass, the llm/tools loop only handles failures
+        self.structured_plan = structured_plan
         
         # Initialize tools
-        self.tools = [
-            JsonGetValueTool_custom(json_state=self.json_state),
-            JsonListKeysTool_custom(json_state=self.json_state),
-            SubsetDatasetTool(dataset_state=self.dataset_state, json_state=self.json_state),
-            SelectVariablesTool(dataset_state=self.dataset_state, json_state=self.json_state),
-            ResampleTimeTool(dataset_state=self.dataset_state, json_state=self.json_state),
-            AggregateDatasetTool(dataset_state=self.dataset_state, json_state=self.json_state),
-            LookDatasetTool(dataset_state=self.dataset_state, json_state=self.json_state)
-        ]
+        self.tools = self._make_tools()
         self.tools_names = {t.name: t for t in self.tools}
         
         # Bind tools to LLM
@@ -52,10 +60,63 @@ class ClimAgent:
         # Create agent
         self.graph = self._build_agent(self.state)
 
+    def _make_tools(self):
+        from climagent.tools.json_tools import JsonGetValueTool_custom, JsonListKeysTool_custom
+        from climagent.tools.xarray_tools_indexing import SubsetDatasetTool, SelectVariablesTool
+        from climagent.tools.xarray_tools_grouping import ResampleTimeTool, ClimatologyTool
+        from climagent.tools.xarray_tools_aggregating import AggregateDatasetTool
+        from climagent.tools.xarray_tools_derive import DeriveVariableTool
+        from climagent.tools.xarray_tools_look import LookDatasetTool
+        from climagent.tools.xarray_tools_spatial import ExtractPointsTool, SpatialSubsetTool
+        from climagent.tools.xarray_tools_checkpoint import CheckpointDatasetTool, RevertDatasetTool, BranchDatasetTool, ListCheckpointsTool
+        from climagent.tools.xarray_tools_export import ExportDatasetTool
+        from climagent.tools.xarray_tools_cost import DryRunTool
+
+        return [
+            JsonGetValueTool_custom(json_state=self.json_state),
+            JsonListKeysTool_custom(json_state=self.json_state),
+            SubsetDatasetTool(dataset_state=self.dataset_state, json_state=self.json_state),
+            SelectVariablesTool(dataset_state=self.dataset_state, json_state=self.json_state),
+            SpatialSubsetTool(dataset_state=self.dataset_state, json_state=self.json_state),
+            ExtractPointsTool(dataset_state=self.dataset_state, json_state=self.json_state),
+            ResampleTimeTool(dataset_state=self.dataset_state, json_state=self.json_state),
+            ClimatologyTool(dataset_state=self.dataset_state, json_state=self.json_state),
+            AggregateDatasetTool(dataset_state=self.dataset_state, json_state=self.json_state),
+            DeriveVariableTool(dataset_state=self.dataset_state, json_state=self.json_state),
+            LookDatasetTool(dataset_state=self.dataset_state, json_state=self.json_state),
+            ExportDatasetTool(dataset_state=self.dataset_state, json_state=self.json_state),
+            DryRunTool(dataset_state=self.dataset_state, json_state=self.json_state),
+            CheckpointDatasetTool(dataset_state=self.dataset_state, json_state=self.json_state),
+            RevertDatasetTool(dataset_state=self.dataset_state, json_state=self.json_state),
+            BranchDatasetTool(dataset_state=self.dataset_state, json_state=self.json_state),
+            ListCheckpointsTool(dataset_state=self.dataset_state, json_state=self.json_state)
+        ]
+
+    def fork(self):
+        """New agent for another session on the same dataset.
+
+        The dataset, its metadata summary, the LLMs with their bound tools and
+        the compiled graph are shared; the fork only gets its own
+        DatasetState/JsonState views and the tools acting on them.
+        """
+        fork = copy.copy(self)
+        fork.dataset_state = self.dataset_state.fork()
+        fork.json_state = self.json_state.fork()
+        fork.tools = fork._make_tools()
+        fork.tools_names = {t.name: t for t in fork.tools}
+        return fork
+
+    def _agent(self, config):
+        """Agent of the session running the graph, passed in the run config."""
+        return (config or {}).get("configurable", {}).get("agent", self)
+
 
     def _build_agent(self, state):
-        
-        def planner(state):
+        from langchain_core.runnables import RunnableLambda
+        from langgraph.graph import StateGraph, END
+        from climagent.agent.pipeline import Pipeline, PIPELINE_PROMPT, describe_pipeline, pipeline_tool_calls, validate_pipeline
+
+        def plan_messages(state, agent):
             #messages = state['messages']
 
 
@@ -83,38 +144,125 @@ class ClimAgent:
             # Aggiungi il plan_prompt come SystemMessage
             plan_message = SystemMessage(content=plan_prompt)
 
-            messages = state['messages'] + [plan_message] + [make_suffix(self.json_state)]
-            
-            # Chiediamo all'LLM di generare il piano di analisi
-            plan_message_response = self.llm_planner.invoke(messages)
+            return state['messages'] + [plan_message] + [make_suffix(agent.json_state)]
 
+        def plan_result(plan_message_response):
             # Assicuriamoci che il messaggio sia un oggetto valido di tipo AnyMessage
             if isinstance(plan_message_response, str):  
                 plan_message_response = AnyMessage(content=plan_message_response)  
 
             return {'messages': [PREFIX] + [plan_message_response]}
+
+        def planner(state, config):
+            with span("planner", "node") as s:
+                # Chiediamo all'LLM di generare il piano di analisi
+                agent = self._agent(config)
+                response = self.llm_planner.invoke(plan_messages(state, agent))
+                s.set(**token_usage(response))
+                agent._prefetch_plan(response)
+            return plan_result(response)
+
+        async def aplanner(state, config):
+            with span("planner", "node") as s:
+                agent = self._agent(config)
+                response = await self.llm_planner.ainvoke(plan_messages(state, agent))
+                s.set(**token_usage(response))
+                agent._prefetch_plan(response)
+            return plan_result(response)
         
-        def run_llm(state):
-            messages = state['messages']
-            message = self.llm.invoke(messages)
+        def pipeline_messages(state, agent):
+            return state['messages'] + [SystemMessage(content=PIPELINE_PROMPT)] + [make_suffix(agent.json_state)]
+
+        def parse_pipeline(response, agent):
+            """Returns a valid pipeline, or None and the message explaining why it is not used."""
+            if response['parsed'] is None:
+                error = response.get('parsing_error') or "no pipeline returned"
+                return None, SystemMessage(content=f"The structured plan could not be used ({error}). Proceed step by step with the tools.")
+            errors = validate_pipeline(response['parsed'], agent.json_state)
+            if errors:
+                return None, SystemMessage(content="The structured plan is not valid:\n" + "\n".join(errors) + "\nProceed step by step with the tools.")
+            return response['parsed'], None
+
+        def pipeline_result(pipeline, tool_calls, results):
+            # Only the executed calls are recorded, each one followed by its ToolMessage
+            plan = AIMessage(content=describe_pipeline(pipeline), tool_calls=tool_calls[:len(results)])
+            return {'messages': [PREFIX, plan] + results}
+
+        def pipeline(state, config):
+            agent = self._agent(config)
+            with span("pipeline", "node") as s:
+                response = self.llm_planner.with_structured_output(Pipeline, include_raw=True).invoke(pipeline_messages(state, agent))
+                s.set(**token_usage(response['raw']))
+                pipeline, error = parse_pipeline(response, agent)
+                if pipeline is None:
+                    s.set(fallback=True)
+                    return {'messages': [PREFIX, error]}
+                if not pipeline.steps:
+                    return {'messages': [PREFIX]}
+                tool_calls = pipeline_tool_calls(pipeline)
+                results = []
+                for t in tool_calls:
+                    results.append(agent._invoke_tool(t))
+                    if results[-1].content.startswith("Error"):
+                        break
+                s.set(steps=len(tool_calls), executed=len(results))
+            return pipeline_result(pipeline, tool_calls, results)
+
+        async def apipeline(state, config):
+            agent = self._agent(config)
+            with span("pipeline", "node") as s:
+                response = await self.llm_planner.with_structured_output(Pipeline, include_raw=True).ainvoke(pipeline_messages(state, agent))
+                s.set(**token_usage(response['raw']))
+                pipeline, error = parse_pipeline(response, agent)
+                if pipeline is None:
+                    s.set(fallback=True)
+                    return {'messages': [PREFIX, error]}
+                if not pipeline.steps:
+                    return {'messages': [PREFIX]}
+                tool_calls = pipeline_tool_calls(pipeline)
+                results = []
+                for t in tool_calls:
+                    results.append(await agent._ainvoke_tool(t))
+                    if results[-1].content.startswith("Error"):
+                        break
+                s.set(steps=len(tool_calls), executed=len(results))
+            return pipeline_result(pipeline, tool_calls, results)
+
+        def run_llm(state, config):
+            with span("llm", "node", input_messages=len(state['messages'])) as s:
+                messages = self._agent(config)._compact(state['messages'])
+                message = self.llm.invoke(messages)
+                s.set(tool_calls=len(message.tool_calls), **token_usage(message))
+            return {'messages': [message]}
+
+        async def arun_llm(state, config):
+            with span("llm", "node", input_messages=len(state['messages'])) as s:
+                message = await self.llm.ainvoke(self._agent(config)._compact(state['messages']))
+                s.set(tool_calls=len(message.tool_calls), **token_usage(message))
             return {'messages': [message]}
 
-        def execute_tools(state):
+        def execute_tools(state, config):
+            agent = self._agent(config)
+            tool_calls = state['messages'][-1].tool_calls
+            results = []
+            with span("tools", "node", tool_calls=len(tool_calls)):
+                for batch in agent._tool_batches(tool_calls):
+                    if len(batch) == 1:
+                        results.append(agent._invoke_tool(batch[0]))
+                    else:
+                        results.extend(map_blocking(agent._invoke_tool, batch))
+            # The data read by the selections made so far loads while the LLM chooses the next tool
+            agent.dataset_state.prefetch()
+            return {'messages': results}
+
+        async def aexecute_tools(state, config):
+            agent = self._agent(config)
             tool_calls = state['messages'][-1].tool_calls
             results = []
-            for t in tool_calls:
-                if t['name'] not in self.tools_names:
-                    result = "Error: There's no such tool, please try again"
-                else:
-                    result = self.tools_names[t['name']].invoke(t['args'])
-
-                results.append(
-                    ToolMessage(
-                        tool_call_id=t['id'],
-                        name=t['name'],
-                        content=str(result)
-                    )
-                )
+            with span("tools", "node", tool_calls=len(tool_calls)):
+                for batch in agent._tool_batches(tool_calls):
+                    results.extend(await asyncio.gather(*(agent._ainvoke_tool(t) for t in batch)))
+            agent.dataset_state.prefetch()
             return {'messages': results}
 
         def tool_exists(state):
@@ -122,9 +270,12 @@ class ClimAgent:
             return len(result.tool_calls) > 0
         
         graph_builder = StateGraph(state)
-        graph_builder.add_node("planner", planner)
-        graph_builder.add_node("llm", run_llm)
-        graph_builder.add_node("tools", execute_tools)
+        if self.structured_plan:
+            graph_builder.add_node("planner", RunnableLambda(pipeline, afunc=apipeline))
+        else:
+            graph_builder.add_node("planner", RunnableLambda(planner, afunc=aplanner))
+        graph_builder.add_node("llm", RunnableLambda(run_llm, afunc=arun_llm))
+        graph_builder.add_node("tools", RunnableLambda(execute_tools, afunc=aexecute_tools))
 
         # Collegamenti: planner viene eseguito una volta, poi passa il controllo a llm
         graph_builder.set_entry_point("planner")
@@ -135,8 +286,79 @@ class ClimAgent:
         graph_builder.add_edge("tools", "llm")
 
         return graph_builder.compile()
+
+    def _prefetch_plan(self, plan):
+        """Starts loading the variables and period named by the plan, while the LLM chooses the first tool."""
+        if self.dataset_state.prefetcher is None:
+            return
+        from climagent.state.prefetch import plan_hints
+
+        hints = plan_hints(str(plan.content), self.dataset_state.dataset_original)
+        if hints:
+            self.dataset_state.prefetch(hints)
+
+    def _compact(self, messages):
+        """Messages sent to the LLM: stale tool outputs are compacted within the token budget."""
+        mutating_tools = {t.name for t in self.tools if getattr(t, 'mutates_state', True)}
+        return compact_messages(messages, self.max_context_tokens, self.dataset_state.describe(), mutating_tools)
+
+    def _tool_batches(self, tool_calls):
+        """Splits tool calls into batches that can run concurrently.
+
+        Consecutive read-only calls share a batch, while every call that
+        mutates DatasetState/JsonState is a batch on its own, so that their
+        original order is preserved.
+        """
+        batches, current = [], []
+        for t in tool_calls:
+            tool = self.tools_names.get(t['name'])
+            if tool is not None and getattr(tool, 'mutates_state', True):
+                if current:
+                    batches.append(current)
+                    current = []
+                batches.append([t])
+            else:
+                current.append(t)
+        if current:
+            batches.append(current)
+        return batches
+
+    def _tool_message(self, t, result):
+        return ToolMessage(
+            tool_call_id=t['id'],
+            name=t['name'],
+            content=str(result)
+        )
+
+    def _invoke_tool(self, t):
+        if t['name'] not in self.tools_names:
+            result = "Error: There's no such tool, please try again"
+        else:
+            result = self.tools_names[t['name']].invoke(t['args'])
+        return self._tool_message(t, result)
+
+    async def _ainvoke_tool(self, t):
+        if t['name'] not in self.tools_names:
+            result = "Error: There's no such tool, please try again"
+        else:
+            result = await self.tools_names[t['name']].ainvoke(t['args'])
+        return self._tool_message(t, result)
     
     
+    def _run_config(self):
+        # The graph can be shared between forks, every run tells it which agent it serves
+        return {"recursion_limit": 50, "configurable": {"agent": self}}
+
     def run(self, messages: list[AnyMessage]):
-        return self.graph.invoke({'messages': messages},  config={"recursion_limit": 50})
-    
+        tracer = Tracer(self.trace_sinks)
+        with tracer.activate():
+            result = self.graph.invoke({'messages': messages},  config=self._run_config())
+        result['spans'] = tracer.spans
+        return result
+
+    async def arun(self, messages: list[AnyMessage]):
+        tracer = Tracer(self.trace_sinks)
+        with tracer.activate():
+            result = await self.graph.ainvoke({'messages': messages},  config=self._run_config())
+        result['spans'] = tracer.spans
+        return result
@@ -0,0 +1,102 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import json
+
+from langchain_core.messages import AIMessage, AnyMessage, SystemMessage, ToolMessage
+
+
+# Rough number of characters per token, used when no tokenizer is given
+CHARS_PER_TOKEN = 4
+
+# Characters of a stale tool output kept in its digest
+DIGEST_CHARS = 200
+
+
+def estimate_tokens(messages: list[AnyMessage]) -> int:
+    """Approximate token count of the messages, without a tokenizer."""
+    chars = 0
+    for m in messages:
+        chars += len(str(m.content)) + 16
+        if isinstance(m, AIMessage) and m.tool_calls:
+            chars += len(json.dumps([[t['name'], t['args']] for t in m.tool_calls], default=str))
+    return chars // CHARS_PER_TOKEN
+
+
+def _digest(message: ToolMessage, note: str, keep: int = DIGEST_CHARS) -> ToolMessage:
+    content = str(message.content)
+    if len(content) > keep:
+        content = content[:keep] + "..." if keep else ""
+    return message.model_copy(update={'content': f"[compacted: {note}] {content}".rstrip()})
+
+
+def _failed(message: ToolMessage) -> bool:
+    return str(message.content).startswith("Error")
+
+
+def compact_messages(messages: list[AnyMessage], max_tokens: int, dataset_summary: str = None,
+                     mutating_tools=(), count_tokens=estimate_tokens) -> list[AnyMessage]:
+    """Returns the messages to send to the LLM, within `max_tokens` when possible.
+
+    System messages are kept once. The last turn (the last tool calling
+    AIMessage and what follows) is never modified. When over budget, older
+    tool outputs are compacted: outputs superseded by an identical later
+    call on the same dataset state (no successful call of `mutating_tools`
+    in between) first, then the successful outputs of the tools in
+    `mutating_tools` (their effect is described once by `dataset_summary`,
+    placed after the leading system messages), then the remaining ones,
+    errors included, oldest first, until the budget is met.
+    """
+    seen_system = set()
+    compacted = []
+    for m in messages:
+        if isinstance(m, SystemMessage):
+            if m.content in seen_system:
+                continue
+            seen_system.add(m.content)
+        compacted.append(m)
+
+    if count_tokens(compacted) <= max_tokens:
+        return compacted
+
+    last_turn = max((i for i, m in enumerate(compacted) if isinstance(m, AIMessage) and m.tool_calls), default=len(compacted))
+    # Calls keyed by name, arguments and number of dataset changes before them
+    calls, changes = {}, 0
+    for m in compacted:
+        if isinstance(m, AIMessage):
+            for t in m.tool_calls:
+                calls[t['id']] = (t['name'], json.dumps(t['args'], sort_keys=True, default=str), changes)
+        elif isinstance(m, ToolMessage) and m.name in mutating_tools and not _failed(m):
+            changes += 1
+    stale = [i for i in range(last_turn) if isinstance(compacted[i], ToolMessage)]
+
+    # Outputs superseded by an identical later call
+    latest = {}
+    for i in stale:
+        latest[calls.get(compacted[i].tool_call_id)] = i
+    for i in stale:
+        key = calls.get(compacted[i].tool_call_id)
+        if key is not None and latest[key] != i:
+            compacted[i] = _digest(compacted[i], "superseded by a later identical call", keep=0)
+
+    # Dataset operations, described once by the current dataset summary; errors are not part of it
+    collapsed = False
+    for i in stale:
+        if compacted[i].name in mutating_tools and dataset_summary is not None and not _failed(compacted[i]):
+            compacted[i] = _digest(compacted[i], "see the current dataset state", keep=0)
+            collapsed = True
+    if collapsed and dataset_summary not in seen_system:
+        # After the leading system messages: providers reject or demote system messages later in the conversation
+        lead = next((i for i, m in enumerate(compacted) if not isinstance(m, SystemMessage)), len(compacted))
+        compacted.insert(lead, SystemMessage(content=dataset_summary))
+        stale = [i + 1 if i >= lead else i for i in stale]
+
+    # Remaining stale outputs, oldest first
+    for i in stale:
+        if count_tokens(compacted) <= max_tokens:
+            break
+        content = str(compacted[i].content)
+        if len(content) > DIGEST_CHARS and not content.startswith("[compacted"):
+            compacted[i] = _digest(compacted[i], "stale tool output")
+
+    return compacted
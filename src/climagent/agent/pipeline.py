@@ -0,0 +1,136 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+from typing import Annotated, List, Literal, Union
+from pydantic import BaseModel, Field
+
+from climagent.state.json_state import JsonState
+from climagent.tools.xarray_tools_indexing import SubsetDatasetInput, SelectVariablesInput
+from climagent.tools.xarray_tools_grouping import ClimatologyDatasetInput, ResampleTimeDatasetInput
+from climagent.tools.xarray_tools_aggregating import AggregateDatasetInput
+from climagent.tools.xarray_tools_look import LookDatasetInput
+from climagent.tools.xarray_tools_export import ExportDatasetInput
+from climagent.tools.xarray_tools_derive import DeriveVariableInput
+from climagent.state.expressions import Expression
+
+
+# Each step is the args schema of a tool, tagged with the tool name
+
+class SubsetStep(SubsetDatasetInput):
+    tool: Literal["subset_dataset"]
+
+class SelectVariablesStep(SelectVariablesInput):
+    tool: Literal["select_variables"]
+
+class ResampleTimeStep(ResampleTimeDatasetInput):
+    tool: Literal["resampletime_dataset"]
+
+class ClimatologyStep(ClimatologyDatasetInput):
+    tool: Literal["climatology_dataset"]
+
+class AggregateStep(AggregateDatasetInput):
+    tool: Literal["aggregate_dataset"]
+
+class DeriveStep(DeriveVariableInput):
+    tool: Literal["derive_variable"]
+
+class LookStep(LookDatasetInput):
+    tool: Literal["look_dataset"]
+
+class ExportStep(ExportDatasetInput):
+    tool: Literal["export_dataset"]
+
+
+PipelineStep = Annotated[
+    Union[SubsetStep, SelectVariablesStep, ResampleTimeStep, ClimatologyStep, AggregateStep, DeriveStep, LookStep, ExportStep],
+    Field(discriminator="tool")
+]
+
+
+class Pipeline(BaseModel):
+    """Sequence of dataset tool calls answering the user query, executed in order."""
+    steps: List[PipelineStep] = Field(description="The tool calls to execute in order. Leave it empty if the query does not need the dataset tools.")
+
+
+PIPELINE_PROMPT = (
+    "You are a planner agent. Translate the user's request into a pipeline of dataset tool calls, executed in order.\n"
+    "Do not make assumptions about the scope of the analysis, stay strictly to the query.\n"
+    "Available steps:\n"
+    "- `subset_dataset`: select one value (nearest) or a slice of two values on a coordinate.\n"
+    "- `select_variables`: keep only some variables of the dataset.\n"
+    "- `resampletime_dataset`: resample a time coordinate at a frequency.\n"
+    "- `climatology_dataset`: reduce a time coordinate over seasons, months, days of the year or hours.\n"
+    "- `aggregate_dataset`: reduce the dataset on one or more coordinates, with statistics or quantiles.\n"
+    "- `derive_variable`: add a variable computed from an arithmetic expression over the variables (unit conversions, wind speed, indices).\n"
+    "- `look_dataset`: return the content of the resulting dataset, usually as the last step.\n"
+    "- `export_dataset`: write the resulting dataset to a Zarr/NetCDF store, for large results or when a file is requested.\n"
+    "Only use coordinate and variable names that exist in the dataset. "
+    "If the query does not need the dataset tools, return an empty pipeline."
+)
+
+
+def pipeline_tool_calls(pipeline: Pipeline) -> list:
+    """Tool calls of the pipeline steps, in the format of AIMessage.tool_calls."""
+    return [
+        {'name': step.tool, 'args': step.model_dump(exclude={'tool'}), 'id': f"pipeline_{i}", 'type': 'tool_call'}
+        for i, step in enumerate(pipeline.steps)
+    ]
+
+
+def validate_pipeline(pipeline: Pipeline, json_state: JsonState) -> List[str]:
+    """Checks the names used by the pipeline against the dataset description.
+
+    Coordinates and variables are followed through the steps, so that a
+    coordinate removed by an aggregation or a climatology cannot be used
+    afterwards.
+    Returns the list of errors, empty when the pipeline is valid.
+    """
+    spec = json_state.get_spec().dict_
+    coords = {name: set(summary.get('dims', ())) for name, summary in spec['coords'].items()}
+    variables = set(spec['data_vars'])
+    errors = []
+
+    for i, step in enumerate(pipeline.steps, start=1):
+        if isinstance(step, (SubsetStep, ResampleTimeStep, ClimatologyStep)):
+            if step.coordinate_name not in coords:
+                errors.append(f"Step {i} ({step.tool}): unknown coordinate '{step.coordinate_name}'. Available coordinates: {sorted(coords)}")
+            if isinstance(step, SubsetStep) and len(step.values) not in (1, 2):
+                errors.append(f"Step {i} ({step.tool}): provide one or two values.")
+            if isinstance(step, ResampleTimeStep) and len(step.funcs) > 1:
+                variables = {f"{v}_{f}" for v in variables for f in step.funcs}
+            if isinstance(step, ClimatologyStep):
+                # The time coordinate is replaced by the groups
+                removed = coords.get(step.coordinate_name, set())
+                coords = {name: d for name, d in coords.items() if not d.intersection(removed)}
+                coords[step.by] = {step.by}
+
+        elif isinstance(step, SelectVariablesStep):
+            unknown = [v for v in step.variable_names if v not in variables]
+            if unknown:
+                errors.append(f"Step {i} ({step.tool}): unknown variables {unknown}. Available variables: {sorted(variables)}")
+            variables &= set(step.variable_names)
+
+        elif isinstance(step, AggregateStep):
+            dims = set().union(*coords.values())
+            unknown = [d for d in step.dims if d not in dims]
+            if unknown:
+                errors.append(f"Step {i} ({step.tool}): unknown dimensions {unknown}. Available dimensions: {sorted(dims)}")
+            coords = {name: d for name, d in coords.items() if not d.intersection(step.dims)}
+            if step.quantiles:
+                coords['quantile'] = {'quantile'}
+            elif step.funcs and len(set(step.funcs)) > 1:
+                variables = {f"{v}_{f}" for v in variables for f in dict.fromkeys(step.funcs)}
+
+        elif isinstance(step, DeriveStep):
+            try:
+                Expression(step.expression, variables)
+            except ValueError as e:
+                errors.append(f"Step {i} ({step.tool}): {e}")
+            variables.add(step.name)
+
+    return errors
+
+
+def describe_pipeline(pipeline: Pipeline) -> str:
+    steps = [f"- **Step {i}**: `{call['name']}` with {call['args']}" for i, call in enumerate(pipeline_tool_calls(pipeline), start=1)]
+    return "Structured plan:\n" + "\n".join(steps)
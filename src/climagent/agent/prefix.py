@@ -15,7 +15,8 @@ PREFIX = SystemMessage(
     "### Understanding the JSON Structure:\n"
     "The JSON follows this structure:\n"
     "- **'attrs'** – Contains metadata about the dataset (e.g., name, producer, etc.).\n"
-    "- **'coords'** – Contains information about spatial and temporal coordinates.\n"
+    "- **'coords'** – Contains a summary of each spatial and temporal coordinate "
+    "(dtype, length, min/max, regular step, first and last values, monotonicity).\n"
     "- **'data_vars'** – Contains descriptions of the dataset’s variables.\n\n"
 
     "Your goal is to extract meaningful answers by interacting with this JSON and using the available tools "
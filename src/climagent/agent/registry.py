@@ -0,0 +1,128 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import asyncio
+import contextlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from langchain_core.messages import AnyMessage
+
+from climagent.agent.climagent import ClimAgent
+
+
+# Sessions kept at once, the least recently used ones are closed first
+MAX_SESSIONS = int(os.getenv("CLIMAGENT_MAX_SESSIONS", 1000))
+
+# Seconds after which an idle session is closed
+SESSION_TTL = float(os.getenv("CLIMAGENT_SESSION_TTL", 3600))
+
+
+class SessionBusy(Exception):
+    """Raised when a session already has as many pending requests as it accepts."""
+
+
+class Session:
+    """Conversation of one analyst on a shared dataset, with its own agent fork.
+
+    At most `concurrency` runs execute at once, and at most `max_pending`
+    requests (running or waiting) are accepted: further ones are rejected
+    instead of queueing without bound.
+    """
+
+    def __init__(self, session_id: str, dataset_name: str, agent: ClimAgent, concurrency: int = 1, max_pending: int = 4):
+        self.session_id = session_id
+        self.dataset_name = dataset_name
+        self.agent = agent
+        self.messages = []
+        self.max_pending = max_pending
+        self.pending = 0
+        self.last_used = time.monotonic()
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def arun(self, messages: list[AnyMessage], slot=None) -> dict:
+        """Runs the agent on the new messages, appended to the conversation of the session.
+
+        `slot` is an optional async context manager (e.g. a process-wide
+        limit) entered once the session can run.
+        """
+        if self.pending >= self.max_pending:
+            raise SessionBusy(f"Session {self.session_id} already has {self.pending} pending requests")
+        self.pending += 1
+        self.last_used = time.monotonic()
+        try:
+            async with self._semaphore, (slot() if slot else contextlib.nullcontext()):
+                result = await self.agent.arun(self.messages + list(messages))
+                self.messages = result['messages']
+                return result
+        finally:
+            self.pending -= 1
+            self.last_used = time.monotonic()
+
+    def describe(self) -> dict:
+        return {"session_id": self.session_id, "dataset": self.dataset_name, "messages": len(self.messages),
+                "pending": self.pending, "operations": self.agent.dataset_state.history}
+
+
+class AgentRegistry:
+    """Agents shared by many sessions in one process.
+
+    Each dataset is opened, described and compiled into a graph once, when
+    it is registered. Sessions get a fork of its agent: a lightweight
+    DatasetState/JsonState view over the shared dataset.
+    """
+
+    def __init__(self, max_sessions: int = MAX_SESSIONS, session_ttl: float = SESSION_TTL,
+                 session_concurrency: int = 1, session_pending: int = 4):
+        self.agents = {}
+        self.sessions = OrderedDict()
+        self.max_sessions = max_sessions
+        self.session_ttl = session_ttl
+        self.session_concurrency = session_concurrency
+        self.session_pending = session_pending
+        self._lock = threading.Lock()
+
+    def register(self, name: str, dataset, llm, **kwargs) -> ClimAgent:
+        """Builds the shared agent of a dataset; `kwargs` are passed to ClimAgent."""
+        agent = ClimAgent(dataset, llm, **kwargs)
+        with self._lock:
+            self.agents[name] = agent
+        return agent
+
+    def open_session(self, dataset_name: str, session_id: str = None) -> Session:
+        """New session on a registered dataset."""
+        if dataset_name not in self.agents:
+            raise KeyError(f"Unknown dataset '{dataset_name}'. Available datasets: {sorted(self.agents)}")
+        session = Session(session_id or uuid.uuid4().hex, dataset_name, self.agents[dataset_name].fork(),
+                          self.session_concurrency, self.session_pending)
+        with self._lock:
+            self._evict()
+            self.sessions[session.session_id] = session
+        return session
+
+    def get_session(self, session_id: str) -> Session:
+        with self._lock:
+            if session_id not in self.sessions:
+                raise KeyError(f"Unknown session '{session_id}'")
+            self.sessions.move_to_end(session_id)
+            return self.sessions[session_id]
+
+    def close_session(self, session_id: str):
+        with self._lock:
+            self.sessions.pop(session_id, None)
+
+    def _evict(self):
+        """Closes idle sessions, and the least recently used ones above `max_sessions` (busy ones are kept)."""
+        now = time.monotonic()
+        for session_id, session in list(self.sessions.items()):
+            expired = now - session.last_used > self.session_ttl
+            if session.pending == 0 and (expired or len(self.sessions) >= self.max_sessions):
+                del self.sessions[session_id]
+
+    def describe(self) -> dict:
+        with self._lock:
+            return {"datasets": sorted(self.agents), "sessions": len(self.sessions),
+                    "pending": sum(s.pending for s in self.sessions.values())}
@@ -0,0 +1,141 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Any, List, Literal, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pydantic import ConfigDict, Field, PrivateAttr
+
+
+def normalize_messages(messages: List[BaseMessage]) -> list:
+    """Run independent representation of the messages: ids are dropped, content is stripped."""
+    normalized = []
+    for m in messages:
+        item = {"type": m.type, "content": m.content.strip() if isinstance(m.content, str) else m.content}
+        if getattr(m, "tool_calls", None):
+            item["tool_calls"] = [{"name": t["name"], "args": t["args"]} for t in m.tool_calls]
+        if getattr(m, "name", None):
+            item["name"] = m.name
+        normalized.append(item)
+    return normalized
+
+
+class ResponseStore:
+    """Persistent store of LLM responses, one JSON file per request in `path`."""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, messages: List[BaseMessage], tool_schemas: list) -> str:
+        payload = json.dumps([normalize_messages(messages), tool_schemas], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[BaseMessage]:
+        file = os.path.join(self.path, f"{key}.json")
+        if not os.path.exists(file):
+            return None
+        with open(file, "r") as f:
+            return messages_from_dict([json.load(f)["response"]])[0]
+
+    def put(self, key: str, messages: List[BaseMessage], response: BaseMessage):
+        """Writes the response atomically, so that concurrent runs never read half a file."""
+        record = {"messages": normalize_messages(messages), "response": message_to_dict(response)}
+        fd, tmp_file = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(record, f, default=str)
+        os.replace(tmp_file, os.path.join(self.path, f"{key}.json"))
+
+
+class ReplayChatModel(BaseChatModel):
+    """Chat model wrapper that records and replays responses of another model.
+
+    Modes:
+    - 'record': always call the wrapped model and store its responses.
+    - 'replay': only use stored responses, a missing one is an error.
+    - 'auto': use stored responses, call and record the wrapped model on a miss.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    store: ResponseStore
+    llm: Optional[Any] = None
+    mode: Literal["record", "replay", "auto"] = "auto"
+    bound_llm: Optional[Any] = None
+    tool_schemas: list = Field(default_factory=list)
+
+    @property
+    def _llm_type(self) -> str:
+        return "replay"
+
+    def bind_tools(self, tools, **kwargs):
+        bound_llm = self.llm.bind_tools(tools, **kwargs) if self.llm is not None else None
+        return self.model_copy(update={
+            "bound_llm": bound_llm,
+            "tool_schemas": [convert_to_openai_tool(t) for t in tools],
+        })
+
+    def _lookup(self, messages):
+        key = self.store.key(messages, self.tool_schemas)
+        cached = None if self.mode == "record" else self.store.get(key)
+        if cached is None and (self.mode == "replay" or self.llm is None):
+            raise KeyError(f"No recorded response for request {key} in {self.store.path}")
+        return key, cached
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        key, response = self._lookup(messages)
+        if response is None:
+            response = (self.bound_llm or self.llm).invoke(messages)
+            self.store.put(key, messages, response)
+        return ChatResult(generations=[ChatGeneration(message=response)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        key, response = self._lookup(messages)
+        if response is None:
+            response = await (self.bound_llm or self.llm).ainvoke(messages)
+            self.store.put(key, messages, response)
+        return ChatResult(generations=[ChatGeneration(message=response)])
+
+
+class ScriptedChatModel(BaseChatModel):
+    """Local fake chat model returning scripted responses in order.
+
+    Each item of `script` is an AIMessage, a string, or a callable that
+    receives the messages and returns one of them. Once the script is
+    exhausted, an empty AIMessage ends the agent loop.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    script: List[Any] = Field(default_factory=list)
+    tool_schemas: list = Field(default_factory=list)
+
+    # Shared by the copies returned by bind_tools, so planner and tool-bound model consume the script in turn
+    _counter: dict = PrivateAttr(default_factory=lambda: {"next": 0, "lock": threading.Lock()})
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.model_copy(update={"tool_schemas": [convert_to_openai_tool(t) for t in tools]})
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        with self._counter["lock"]:
+            index = self._counter["next"]
+            self._counter["next"] += 1
+
+        response = self.script[index] if index < len(self.script) else AIMessage(content="")
+        if callable(response):
+            response = response(messages)
+        if isinstance(response, str):
+            response = AIMessage(content=response)
+        return ChatResult(generations=[ChatGeneration(message=response)])
@@ -0,0 +1,115 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+from langchain_core.messages import HumanMessage
+
+from climagent.agent.registry import AgentRegistry, SessionBusy
+
+
+# Runs executing at once in the process, shared by all the sessions
+MAX_RUNNING = int(os.getenv("CLIMAGENT_MAX_RUNNING", 16))
+
+# Requests waiting for a free run before new ones are rejected
+MAX_QUEUED = int(os.getenv("CLIMAGENT_MAX_QUEUED", 64))
+
+
+def create_app(registry: AgentRegistry, max_running: int = MAX_RUNNING, max_queued: int = MAX_QUEUED):
+    """aiohttp application serving the sessions of `registry`.
+
+    - `POST /sessions` with `{"dataset": name}` opens a session.
+    - `POST /sessions/{id}/messages` with `{"content": text}` runs the agent.
+    - `GET /sessions/{id}` describes a session, `DELETE /sessions/{id}` closes it.
+    - `GET /health` describes the registry.
+
+    Busy sessions answer 429 and a full process 503, so that clients back
+    off instead of piling up requests.
+    """
+    try:
+        from aiohttp import web
+    except ImportError as e:
+        raise ImportError("aiohttp is required to serve ClimAgent over HTTP") from e
+
+    running = asyncio.Semaphore(max_running)
+    load = {"running": 0, "waiting": 0}
+
+    @asynccontextmanager
+    async def run_slot():
+        """One of the `max_running` runs of the process, rejecting requests when the queue is full."""
+        if running.locked() and load["waiting"] >= max_queued:
+            raise web.HTTPServiceUnavailable(text="Error: the server is busy, retry later", headers={"Retry-After": "1"})
+        load["waiting"] += 1
+        try:
+            await running.acquire()
+        finally:
+            load["waiting"] -= 1
+        load["running"] += 1
+        try:
+            yield
+        finally:
+            load["running"] -= 1
+            running.release()
+
+    async def read_json(request):
+        try:
+            return await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text="Error: the request body must be JSON")
+
+    def get_session(request):
+        try:
+            return registry.get_session(request.match_info["session_id"])
+        except KeyError as e:
+            raise web.HTTPNotFound(text=f"Error: {e.args[0]}")
+
+    async def open_session(request):
+        body = await read_json(request)
+        try:
+            session = registry.open_session(body.get("dataset"), body.get("session_id"))
+        except KeyError as e:
+            raise web.HTTPNotFound(text=f"Error: {e.args[0]}")
+        return web.json_response(session.describe(), status=201)
+
+    async def post_message(request):
+        session = get_session(request)
+        body = await read_json(request)
+        if not body.get("content"):
+            raise web.HTTPBadRequest(text="Error: missing 'content'")
+
+        try:
+            result = await session.arun([HumanMessage(content=body["content"])], slot=run_slot)
+        except SessionBusy as e:
+            raise web.HTTPTooManyRequests(text=f"Error: {e}", headers={"Retry-After": "1"})
+
+        answer = result['messages'][-1]
+        return web.json_response({"session_id": session.session_id, "answer": answer.content, "spans": len(result['spans'])})
+
+    async def describe_session(request):
+        return web.json_response(get_session(request).describe())
+
+    async def close_session(request):
+        registry.close_session(get_session(request).session_id)
+        return web.json_response({"closed": request.match_info["session_id"]})
+
+    async def health(request):
+        return web.json_response(dict(registry.describe(), **load))
+
+    app = web.Application()
+    app.add_routes([
+        web.post("/sessions", open_session),
+        web.post("/sessions/{session_id}/messages", post_message),
+        web.get("/sessions/{session_id}", describe_session),
+        web.delete("/sessions/{session_id}", close_session),
+        web.get("/health", health),
+    ])
+    return app
+
+
+def serve(registry: AgentRegistry, host: str = "127.0.0.1", port: int = 8080, **kwargs):
+    """Serves the registry over HTTP until interrupted."""
+    from aiohttp import web
+
+    web.run_app(create_app(registry, **kwargs), host=host, port=port)
@@ -0,0 +1,80 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import importlib
+import os
+import subprocess
+import sys
+import threading
+import time
+
+
+# Modules imported on first use by ClimAgent, that a service can load during its startup
+HEAVY_MODULES = (
+    "numpy",
+    "xarray",
+    "dask.array",
+    "langgraph.graph",
+    "langchain_community.tools.json.tool",
+    "climagent.state.dataset_state",
+    "climagent.state.json_state",
+    "climagent.agent.pipeline",
+    "climagent.tools.json_tools",
+    "climagent.tools.xarray_tools_indexing",
+    "climagent.tools.xarray_tools_grouping",
+    "climagent.tools.xarray_tools_aggregating",
+    "climagent.tools.xarray_tools_derive",
+    "climagent.tools.xarray_tools_look",
+    "climagent.tools.xarray_tools_spatial",
+    "climagent.tools.xarray_tools_checkpoint",
+    "climagent.tools.xarray_tools_export",
+    "climagent.tools.xarray_tools_cost",
+)
+
+# Seconds allowed to import climagent.agent.climagent in a fresh interpreter
+IMPORT_BUDGET = float(os.getenv("CLIMAGENT_IMPORT_BUDGET", 0.6))
+
+
+def prewarm(modules=HEAVY_MODULES, background: bool = False):
+    """Imports the modules ClimAgent loads lazily, and starts the tool thread pool.
+
+    Returns the import time of each module, or the started thread when
+    `background` is True, so that a service can keep accepting requests
+    while warming up. Missing optional modules are skipped.
+    """
+    if background:
+        thread = threading.Thread(target=prewarm, args=(modules,), name="climagent-prewarm", daemon=True)
+        thread.start()
+        return thread
+
+    timings = {}
+    for module in modules:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            continue
+        timings[module] = time.perf_counter() - start
+
+    from climagent.tools.tool_executor import get_executor
+    get_executor()
+    return timings
+
+
+def import_time(module: str = "climagent.agent.climagent", runs: int = 3) -> float:
+    """Best time (seconds) to import `module` in a fresh interpreter, as a cold start would."""
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    times = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+        times.append(float(output.stdout.strip().splitlines()[-1]))
+    return min(times)
+
+
+def check_import_budget(module: str = "climagent.agent.climagent", budget: float = IMPORT_BUDGET) -> float:
+    """Measures the cold import time of `module`, raising RuntimeError above `budget` seconds."""
+    seconds = import_time(module)
+    if seconds > budget:
+        raise RuntimeError(f"Importing {module} took {seconds:.3f} s, above the budget of {budget:.3f} s")
+    return seconds
@@ -1,10 +1,23 @@
 # Author: jacopo.grassi@polito.it
 # Institute: Politecnico di Torino
 
-from langchain_core.messages import AnyMessage
+from langchain_core.messages import AnyMessage, SystemMessage
 from typing_extensions import TypedDict
 from typing import Annotated
-import operator
+
+
+def add_messages_once(left: list[AnyMessage], right: list[AnyMessage]) -> list[AnyMessage]:
+    """Appends messages, skipping system messages that are already in the state."""
+    system = {m.content for m in left if isinstance(m, SystemMessage)}
+    new = []
+    for m in right:
+        if isinstance(m, SystemMessage):
+            if m.content in system:
+                continue
+            system.add(m.content)
+        new.append(m)
+    return left + new
+
 
 class State(TypedDict):
-    messages: Annotated[list[AnyMessage], operator.add]
+    messages: Annotated[list[AnyMessage], add_messages_once]
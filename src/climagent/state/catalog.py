@@ -0,0 +1,292 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+import xarray as xr
+
+from climagent.state.operation_plan import Operation, SelectVariables, Subset
+
+
+# Version of the index format, older indexes are rebuilt
+INDEX_VERSION = 1
+
+# Number of combined datasets kept open, one for each distinct set of files
+OPEN_DATASETS = 8
+
+
+def _expand(source) -> List[str]:
+    """Files of a catalog: a glob pattern, a manifest (one path per line) or a list of paths."""
+    if isinstance(source, (list, tuple)):
+        paths = list(source)
+    elif os.path.isfile(source) and source.endswith((".txt", ".lst")):
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source) as f:
+            paths = [os.path.join(base, line.strip()) for line in f if line.strip() and not line.startswith("#")]
+    else:
+        paths = glob.glob(os.path.expanduser(source))
+    paths = sorted(os.path.abspath(p) for p in paths)
+    if not paths:
+        raise FileNotFoundError(f"No files found for catalog source {source!r}")
+    return paths
+
+
+def _encode(values: np.ndarray) -> dict:
+    """JSON friendly encoding of a 1-D coordinate: start/step/size if regular, values otherwise."""
+    dtype = str(values.dtype)
+    if np.issubdtype(values.dtype, np.datetime64) or np.issubdtype(values.dtype, np.timedelta64):
+        values = values.astype("int64")
+    if values.size > 1:
+        diffs = np.diff(values)
+        if (diffs == diffs[0]).all() and diffs[0] != 0:
+            return {"dtype": dtype, "start": values[0].item(), "step": diffs[0].item(), "size": int(values.size)}
+    return {"dtype": dtype, "values": values.tolist()}
+
+
+def _decode(encoded: dict) -> np.ndarray:
+    if "values" in encoded:
+        values = np.asarray(encoded["values"])
+    else:
+        values = encoded["start"] + encoded["step"] * np.arange(encoded["size"])
+    dtype = np.dtype(encoded["dtype"])
+    if np.issubdtype(dtype, np.datetime64) or np.issubdtype(dtype, np.timedelta64):
+        return values.astype("int64").astype(dtype)
+    return values.astype(dtype)
+
+
+def index_file(path: str) -> dict:
+    """Reads the header of a file: dims, variables, coordinate bounds and 1-D coordinates."""
+    with xr.open_dataset(path, chunks={}) as dataset:
+        coords = {}
+        for name, coord in dataset.coords.items():
+            values = np.asarray(coord.values)
+            entry = {"dims": list(coord.dims), "attrs": _json_attrs(coord.attrs)}
+            numeric = values.dtype.kind in "iufMm"
+            if numeric and values.size > 0:
+                # Bounds are compared as numbers, datetimes in nanoseconds
+                flat = values.ravel().astype("int64") if values.dtype.kind in "Mm" else values.ravel()
+                entry["min"], entry["max"] = flat.min().item(), flat.max().item()
+            if coord.ndim == 1 and name in coord.dims and numeric:
+                entry["encoded"] = _encode(values)
+            coords[str(name)] = entry
+
+        stat = os.stat(path)
+        return {
+            "path": path,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sizes": {str(k): int(v) for k, v in dataset.sizes.items()},
+            "attrs": _json_attrs(dataset.attrs),
+            "coords": coords,
+            "data_vars": {str(name): {"dims": list(var.dims), "dtype": str(var.dtype), "attrs": _json_attrs(var.attrs)}
+                          for name, var in dataset.data_vars.items()},
+        }
+
+
+def _json_attrs(attrs: dict) -> dict:
+    return json.loads(json.dumps(attrs, default=lambda v: v.tolist() if hasattr(v, "tolist") else str(v)))
+
+
+def _time_bounds(value: str):
+    """Start and end of the period a (partial) date string refers to, in nanoseconds."""
+    import pandas as pd
+
+    try:
+        period = pd.Period(value)
+        return period.start_time.value, period.end_time.value
+    except (ValueError, TypeError):
+        timestamp = pd.Timestamp(value)
+        return timestamp.value, timestamp.value
+
+
+def _interval(values, datetime: bool):
+    """Closed interval covered by the values of a Subset, None if it cannot be computed."""
+    try:
+        if datetime:
+            bounds = [_time_bounds(str(v)) for v in values]
+            return min(b[0] for b in bounds), max(b[1] for b in bounds)
+        numbers = [float(v) for v in values]
+        return min(numbers), max(numbers)
+    except (ValueError, TypeError):
+        return None
+
+
+class DatasetCatalog:
+    """Collection of files opened as one dataset, with an index of their contents.
+
+    The index (dims, variables, coordinate bounds) is built once per file and
+    persisted in `index_path`, files that did not change are not read again.
+    `skeleton` describes the combined dataset without opening any file, and
+    `open` combines only the files matching the selections of a plan.
+    """
+
+    def __init__(self, source, index_path: Optional[str] = None, open_kwargs: Optional[dict] = None):
+        self.paths = _expand(source)
+        if index_path is None:
+            key = hashlib.sha256("\n".join(self.paths).encode()).hexdigest()[:16]
+            index_path = os.path.join(tempfile.gettempdir(), "climagent_catalog", f"{key}.json")
+        self.index_path = index_path
+        self.open_kwargs = open_kwargs or {}
+        self.index = self._load_index()
+        self._skeleton = None
+        self._opened = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load_index(self) -> dict:
+        previous = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path) as f:
+                    stored = json.load(f)
+                if stored.get("version") == INDEX_VERSION:
+                    previous = stored["files"]
+            except (OSError, ValueError, KeyError):
+                previous = {}
+
+        index, changed = {}, False
+        for path in self.paths:
+            stat = os.stat(path)
+            entry = previous.get(path)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+                entry = index_file(path)
+                changed = True
+            index[path] = entry
+
+        if changed or len(index) != len(previous):
+            self._save_index(index)
+        return index
+
+    def _save_index(self, index: dict):
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        tmp = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": INDEX_VERSION, "files": index}, f)
+        os.replace(tmp, self.index_path)
+
+    def fingerprint(self, paths: Optional[List[str]] = None) -> str:
+        """Content address of the combination of `paths` (all the files by default)."""
+        digest = hashlib.sha256()
+        for path in paths if paths is not None else self.paths:
+            entry = self.index[path]
+            digest.update(f"{path}:{entry['size']}:{entry['mtime_ns']}".encode())
+        return digest.hexdigest()
+
+    def skeleton(self) -> xr.Dataset:
+        """Combined dataset with real coordinates and empty lazy variables, built from the index only.
+
+        Operations can be applied to it to check them and to know the shape
+        of their result, while no file is opened.
+        """
+        if self._skeleton is not None:
+            return self._skeleton
+
+        import dask.array as da
+
+        entries = list(self.index.values())
+        coords, coord_attrs, sizes = {}, {}, {}
+        for entry in entries:
+            for name, coord in entry["coords"].items():
+                if "encoded" in coord:
+                    coords.setdefault(name, []).append(_decode(coord["encoded"]))
+                    coord_attrs.setdefault(name, coord["attrs"])
+            for dim, size in entry["sizes"].items():
+                sizes[dim] = max(size, sizes.get(dim, 0))
+
+        for name, parts in coords.items():
+            values = np.unique(np.concatenate(parts))
+            # Keep the order of the files, e.g. latitudes from north to south
+            if len(parts[0]) > 1 and parts[0][0] > parts[0][-1]:
+                values = values[::-1]
+            coords[name] = xr.Variable((name,), values, coord_attrs[name])
+            sizes[name] = values.size
+
+        data_vars, attrs = {}, {}
+        for entry in entries:
+            attrs.update(entry["attrs"])
+            for name, var in entry["data_vars"].items():
+                if name not in data_vars:
+                    shape = tuple(sizes[d] for d in var["dims"])
+                    data = da.empty(shape, dtype=var["dtype"], chunks="auto")
+                    data_vars[name] = xr.Variable(var["dims"], data, var["attrs"])
+
+        self._skeleton = xr.Dataset(data_vars, coords=coords, attrs=attrs)
+        return self._skeleton
+
+    def select(self, operations: List[Operation]) -> List[str]:
+        """Files needed by the leading selections of a plan, the other operations keep every file."""
+        skeleton = self.skeleton()
+        paths = list(self.paths)
+        for operation in operations:
+            if isinstance(operation, SelectVariables):
+                wanted = set(operation.variable_names)
+                paths = [p for p in paths if wanted.intersection(self.index[p]["data_vars"])]
+            elif isinstance(operation, Subset):
+                coord = skeleton.coords.get(operation.coordinate_name)
+                datetime = coord is not None and coord.dtype.kind == "M"
+                interval = _interval(operation.values, datetime)
+                if interval is not None:
+                    paths = self._overlapping(paths, operation.coordinate_name, interval, nearest=len(operation.values) == 1)
+            else:
+                break
+        return paths
+
+    def _overlapping(self, paths, coordinate_name, interval, nearest):
+        """Files whose bounds on the coordinate intersect the interval.
+
+        For a single value (nearest selection) the files at the smallest
+        distance are kept, so that a value between two files still finds
+        its neighbours. Files without the coordinate are always kept.
+        """
+        lo, hi = interval
+        distances = {}
+        for path in paths:
+            coord = self.index[path]["coords"].get(coordinate_name)
+            if coord is None or "min" not in coord:
+                distances[path] = 0
+            else:
+                distances[path] = max(coord["min"] - hi, lo - coord["max"], 0)
+        if nearest:
+            closest = min(distances.values(), default=0)
+            return [p for p in paths if distances[p] <= closest]
+        return [p for p in paths if distances[p] == 0]
+
+    def open(self, paths: Optional[List[str]] = None) -> xr.Dataset:
+        """Lazily opens and combines `paths` (all the files by default).
+
+        The least recently used combinations above `OPEN_DATASETS` are closed,
+        releasing their file handles.
+        """
+        paths = list(paths if paths is not None else self.paths)
+        if not paths:
+            raise ValueError("No file of the catalog matches the selection.")
+        key = tuple(paths)
+        with self._lock:
+            if key in self._opened:
+                self._opened.move_to_end(key)
+                return self._opened[key]
+
+        kwargs = dict(combine="by_coords", data_vars="minimal", coords="minimal", compat="override")
+        kwargs.update(self.open_kwargs)
+        dataset = xr.open_mfdataset(paths, **kwargs)
+
+        evicted = []
+        with self._lock:
+            if key in self._opened:
+                # Opened meanwhile by another thread
+                evicted.append(dataset)
+                dataset = self._opened[key]
+            else:
+                self._opened[key] = dataset
+            while len(self._opened) > OPEN_DATASETS:
+                evicted.append(self._opened.popitem(last=False)[1])
+        for stale in evicted:
+            stale.close()
+        return dataset
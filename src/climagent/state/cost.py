@@ -0,0 +1,178 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import math
+import os
+from typing import Dict, List, Optional
+
+import xarray as xr
+
+from climagent.state.operation_plan import Operation, OperationPlan
+
+
+# Memory (bytes) that executing a plan may use, 0 disables the guard
+MEMORY_BUDGET = int(os.getenv("CLIMAGENT_MEMORY_BUDGET", 4 * 1024 ** 3))
+
+# Working memory of a chunk being processed, as a multiple of its size (input, temporaries, output)
+WORKING_FACTOR = 3
+
+# Smallest chunk the guard rechunks to, below it the plan is rejected
+MIN_CHUNK_BYTES = 1024 ** 2
+
+# Rough throughputs used to turn bytes and elements into seconds
+READ_BYTES_PER_SECOND = float(os.getenv("CLIMAGENT_READ_BYTES_PER_SECOND", 200e6))
+ELEMENTS_PER_SECOND = float(os.getenv("CLIMAGENT_ELEMENTS_PER_SECOND", 100e6))
+
+
+class MemoryBudgetExceeded(MemoryError):
+    """Raised when a plan cannot be executed within the memory budget, even in smaller chunks."""
+
+
+def threads() -> int:
+    """Number of chunks dask processes at once."""
+    try:
+        import dask
+    except ImportError:
+        return 1
+    return dask.config.get("num_workers", None) or os.cpu_count() or 1
+
+
+def _chunking(dataset: xr.Dataset):
+    """Largest chunk (bytes) and number of chunks of the biggest data variable; unchunked ones are a single chunk."""
+    largest, count = 0, 1
+    for var in dataset.data_vars.values():
+        if var.chunks:
+            chunk = var.dtype.itemsize * math.prod(max(c) if c else 1 for c in var.chunks)
+            n = math.prod(len(c) for c in var.chunks)
+        else:
+            chunk, n = var.nbytes, 1
+        if chunk > largest:
+            largest = chunk
+        count = max(count, n)
+    return largest, count
+
+
+def _elements(dataset: xr.Dataset) -> int:
+    return sum(var.size for var in dataset.data_vars.values())
+
+
+def estimate(dataset: xr.Dataset, operations: List[Operation]) -> dict:
+    """Dry run of a plan on a lazy dataset: output schema, bytes read, compute and memory cost.
+
+    Only the shapes, dtypes and chunks of the intermediate lazy datasets are
+    used, no value is read. The leading selections of the plan determine
+    the bytes read; every other operation processes all the elements of its
+    input. `peak_bytes` is the memory to materialize the result (output
+    plus the chunks processed at once), `working_bytes` the memory to
+    stream it (e.g. to look at it or export it).
+    """
+    selections, others = OperationPlan(operations).split_selections()
+    selected = OperationPlan(selections).execute(dataset)
+
+    result, elements = selected, _elements(selected)
+    for operation in others:
+        elements += _elements(result)
+        result = operation.apply(result)
+
+    chunk_bytes, chunks = _chunking(selected)
+    working = min(chunks, threads()) * chunk_bytes * WORKING_FACTOR
+    bytes_read = int(sum(var.nbytes for var in selected.data_vars.values()))
+    output = int(result.nbytes)
+
+    return {
+        "output_sizes": dict(result.sizes),
+        "output_variables": list(result.data_vars),
+        "output_nbytes": output,
+        "bytes_read": bytes_read,
+        "elements": int(elements),
+        "chunks": int(chunks),
+        "chunk_bytes": int(chunk_bytes),
+        "working_bytes": int(working),
+        "peak_bytes": int(output + working),
+        "seconds": round(bytes_read / READ_BYTES_PER_SECOND + elements / ELEMENTS_PER_SECOND, 3),
+    }
+
+
+def fit_chunk_bytes(cost: dict, budget: int, materialize: bool) -> int:
+    """Chunk size that keeps the plan within `budget`, or 0 when the current chunks already fit.
+
+    Raises MemoryBudgetExceeded when the result alone exceeds the budget,
+    or when the needed chunks would be too small.
+    """
+    resident = cost["output_nbytes"] if materialize else 0
+    if resident + cost["working_bytes"] <= budget:
+        return 0
+    if resident > budget:
+        raise MemoryBudgetExceeded(
+            f"The result would take {format_bytes(resident)}, above the memory budget of {format_bytes(budget)}. "
+            f"Subset or aggregate the dataset first, or export it to a file.")
+    chunk_bytes = (budget - resident) // (WORKING_FACTOR * threads())
+    if chunk_bytes < MIN_CHUNK_BYTES:
+        raise MemoryBudgetExceeded(
+            f"Executing the plan needs about {format_bytes(resident + cost['working_bytes'])}, "
+            f"above the memory budget of {format_bytes(budget)}. Subset or aggregate the dataset first.")
+    return int(chunk_bytes)
+
+
+def chunk_limit() -> int:
+    """Bytes of the chunks dask chooses automatically (its `array.chunk-size` setting)."""
+    import dask
+    from dask.utils import parse_bytes
+
+    return parse_bytes(dask.config.get("array.chunk-size"))
+
+
+def auto_chunks(dataset: xr.Dataset, chunk_bytes: Optional[int] = None, fixed: Optional[Dict[str, int]] = None) -> Dict[str, int]:
+    """Chunk size of each dimension such that no chunk of any variable exceeds `chunk_bytes` (dask's default size).
+
+    Variables are split along their first free dimension (usually time)
+    when possible, else along all of them. Sizes are chosen on the largest
+    variables first and shared by all the variables, as xarray needs
+    consistent chunks; dimensions in `fixed` keep the given size.
+    """
+    from dask.array.core import normalize_chunks
+
+    limit = chunk_bytes or chunk_limit()
+    target = dict(fixed or {})
+    for var in sorted(dataset.variables.values(), key=lambda v: v.nbytes, reverse=True):
+        free = [d for d in var.dims if d not in target]
+        if not free or var.dtype.hasobject:
+            continue
+        rest = var.dtype.itemsize * math.prod(target.get(d, var.sizes[d]) for d in var.dims if d != free[0])
+        leading = rest <= limit
+        request = tuple(target.get(d, "auto" if d == free[0] or not leading else -1) for d in var.dims)
+        sizes = normalize_chunks(request, shape=var.shape, limit=limit, dtype=var.dtype)
+        for dim, size in zip(var.dims, sizes):
+            target.setdefault(dim, max(size) if size else 1)
+    return target
+
+
+def rechunk(dataset: xr.Dataset, chunk_bytes: int) -> xr.Dataset:
+    """Dask chunks of at most about `chunk_bytes`, so that the plan is streamed in smaller pieces."""
+    return dataset.chunk(auto_chunks(dataset, chunk_bytes))
+
+
+def format_bytes(n: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(n) < 1024:
+            return f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} TiB"
+
+
+def describe_estimate(cost: dict, budget: int) -> str:
+    """Short description of an estimate for the LLM."""
+    text = (
+        f"output dims {cost['output_sizes']}, variables {cost['output_variables']}, "
+        f"size {format_bytes(cost['output_nbytes'])}; reads {format_bytes(cost['bytes_read'])} "
+        f"and processes {cost['elements']:.3g} values in {cost['chunks']} chunks "
+        f"(about {cost['seconds']:.3g} s); memory to compute the result {format_bytes(cost['peak_bytes'])}"
+    )
+    if not budget:
+        return text
+    if cost["peak_bytes"] <= budget:
+        return text + f", within the budget of {format_bytes(budget)}."
+    if cost["output_nbytes"] <= budget:
+        return text + f", above the budget of {format_bytes(budget)}: it will be computed in smaller chunks."
+    return text + (f". The result is above the budget of {format_bytes(budget)}: it cannot be loaded, "
+                   f"reduce it further or export it to a file.")
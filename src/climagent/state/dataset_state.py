@@ -1,16 +1,392 @@
 # Author: jacopo.grassi@polito.it
 # Institute: Politecnico di Torino
 
+import copy
+import time
+import uuid
+from collections import OrderedDict
+
+from climagent.state.catalog import DatasetCatalog
+from climagent.state.cost import MEMORY_BUDGET, auto_chunks, estimate, fit_chunk_bytes, rechunk
+from climagent.state.operation_plan import Operation, OperationPlan
+from climagent.state.result_cache import ResultCache, chain_key, dataset_fingerprint
+
+
+def _lazy(dataset):
+    """Wraps the dataset in dask arrays so that operations are only recorded.
+
+    Chunks have dask's default size, so that values are read and computed
+    block by block (a single chunk would load each variable at once).
+    """
+    try:
+        import dask  # noqa: F401
+    except ImportError:
+        return dataset
+    return dataset if dataset.chunks else dataset.chunk(auto_chunks(dataset))
+
+
+class Checkpoint:
+    """Named snapshot of a DatasetState, holding references (no copies) to its datasets.
+
+    A snapshot is identified by its lineage: the key of the root dataset
+    and the operations applied to it. `materialized` holds its values once
+    computed, it is dropped when the checkpoint is evicted and the snapshot
+    can still be recomputed from `root` and `lineage`.
+    """
+
+    def __init__(self, name, root, root_key, lineage, view, materialized, records, fingerprint, parent=None):
+        self.name = name
+        self.root = root
+        self.root_key = root_key
+        self.lineage = list(lineage)
+        self.view = view
+        self.materialized = materialized
+        self.records = list(records)
+        self.fingerprint = fingerprint
+        self.parent = parent
+
+    @property
+    def nbytes(self):
+        """Memory held by the checkpoint on top of its root dataset."""
+        if self.materialized is None or self.materialized is self.root:
+            return 0
+        return self.materialized.nbytes
+
+
 class DatasetState:
 
-    def __init__(self, dataset):
+    def __init__(self, dataset, cache: ResultCache = None, checkpoint_bytes: int = 1024 ** 3, memory_budget: int = MEMORY_BUDGET,
+                 prefetcher=None):
+        # A catalog is described by its skeleton, files are only opened when values are needed
+        self.catalog = dataset if isinstance(dataset, DatasetCatalog) else None
+        if self.catalog is not None:
+            dataset = self.catalog.skeleton()
+
         self.dataset_original = dataset
-        self.dataset = dataset
+        self.base = dataset
+        self.plan = OperationPlan()
+
+        # Lineage of the base: the dataset it derives from, a key identifying it and the operations applied to it
+        self.root = dataset
+        self.root_key = self.original_key = uuid.uuid4().hex
+        self.lineage = []
         self.history = []
 
+        # Structured records of the operations: tool, arguments, output schema and cost
+        self.records = []
+
+        # Named checkpoints, least recently used first, and the memory they can retain
+        self.checkpoints = OrderedDict()
+        self.checkpoint_bytes = checkpoint_bytes
+        self.current_checkpoint = None
+        # Checkpoint whose values are those of the current state, if any
+        self._at_checkpoint = None
+
+        # Optional cache of operation chain results, shared between sessions
+        self.cache = cache
+        self._fingerprint = None
+
+        # Optional background loader of the blocks read by the plan, shared between sessions
+        self.prefetcher = prefetcher
+
+        # Memory that executing the plan may use: larger plans are rechunked, or rejected (0 disables the guard)
+        self.memory_budget = memory_budget
+
+        # Lazy view of the current dataset: coordinates are real, values are not computed
+        self.view = _lazy(dataset)
+        self.view_original = self.view
+        self._materialized = dataset if self.catalog is None else None
+
+    @property
+    def dataset(self):
+        """Current dataset with real values, computing the pending plan if needed."""
+        if self._materialized is None:
+            self._materialized = self.materialize()
+            self._retain_checkpoint()
+        return self._materialized
+
+    def apply_operation(self, operation: Operation, tool: str = None):
+        """Records an operation and returns the updated lazy view.
+
+        The operation is applied to the lazy view only, so that invalid
+        operations fail immediately while no data is read or computed.
+        """
+        start = time.perf_counter()
+        self.view = operation.apply(self.view)
+        self.plan.append(operation)
+        self.history.append(operation.describe())
+        self.records.append({
+            "tool": tool,
+            "operation": type(operation).__name__,
+            "args": operation.model_dump(mode="json"),
+            "output_sizes": dict(self.view.sizes),
+            "output_variables": list(self.view.data_vars),
+            "output_nbytes": int(self.view.nbytes),
+            "seconds": time.perf_counter() - start,
+        })
+        self._materialized = None
+        self._at_checkpoint = None
+        return self.view
+
+    def lazy_dataset(self):
+        """Current dataset as a lazy computation of the optimized plan."""
+        if self._materialized is not None:
+            return self._materialized
+        return self._execute(lazy=True)
+
+    def materialize(self):
+        """Executes the optimized plan on the base dataset."""
+        result = self._execute()
+        return result.compute() if result.chunks else result
+
+    def estimate(self, operations=()):
+        """Dry run cost of the current plan, followed by `operations`, without reading any value.
+
+        For a catalog not yet opened, chunks are those of its skeleton.
+        """
+        plan = OperationPlan(self.plan.operations + list(operations)).optimize(self.base)
+        return estimate(self._lazy_base(self.base), plan.operations)
+
+    def fingerprint(self):
+        """Content address of the base dataset, computed once."""
+        if self._fingerprint is None:
+            self._fingerprint = dataset_fingerprint(self.base)
+        return self._fingerprint
+
+    def _execute(self, lazy=False):
+        optimized = self.plan.optimize(self.base)
+        base, fingerprint, operations = self.base, None, optimized.operations
+
+        if self.catalog is not None and self.base is self.dataset_original:
+            # Only the files matching the leading selections of the plan are opened
+            files = self.catalog.select(operations)
+            base, fingerprint = self.catalog.open(files), self.catalog.fingerprint(files)
+
+        if self._prefetchable():
+            base, fingerprint, operations = self._prefetched(base, fingerprint, operations)
+
+        streamed = lazy
+        if self.memory_budget:
+            chunk_bytes = fit_chunk_bytes(estimate(self._lazy_base(base), operations), self.memory_budget, materialize=not lazy)
+            if chunk_bytes:
+                # Streamed in smaller chunks, `materialize` computes the lazy result
+                base, lazy = rechunk(self._lazy_base(base), chunk_bytes), True
+
+        base = self._lazy_base(base) if lazy else base
+        if self.cache is not None:
+            # Lazy results are not stored, so that they are still streamed by their consumer
+            return self.cache.execute(fingerprint or self.fingerprint(), operations, base, lazy=streamed)
+        return OperationPlan(operations).execute(base)
+
+    def _source(self):
+        """Identity of the original dataset, shared by the sessions on it."""
+        return self.catalog.fingerprint() if self.catalog is not None else self.fingerprint()
+
+    def _prefetchable(self):
+        # Datasets already in memory, or replaced by computed ones, have nothing to prefetch
+        return (self.prefetcher is not None and self.base is self.dataset_original
+                and (self.catalog is not None or not all(v._in_memory for v in self.dataset_original.variables.values())))
+
+    def prefetch(self, operations=None):
+        """Starts loading, in the background, the block read by the leading selections of the plan.
+
+        `operations` (e.g. hints from a plan) are used instead of the recorded
+        plan. Nothing is done without a prefetcher, for datasets already in
+        memory, or when the plan does not start with selections.
+        """
+        if not self._prefetchable():
+            return None
+        operations = self.plan.operations if operations is None else list(operations)
+        selections, _ = OperationPlan(operations).optimize(self.base).split_selections()
+        if not selections:
+            return None
+
+        def select():
+            base = self.catalog.open(self.catalog.select(selections)) if self.catalog is not None else self.view_original
+            return OperationPlan(selections).execute(base)
+
+        source = self._source()
+        return self.prefetcher.prefetch(source, chain_key(source, selections), select)
+
+    def _prefetched(self, base, fingerprint, operations):
+        """Base, fingerprint and operations resuming from a prefetched block covering the leading selections."""
+        selections, others = OperationPlan(operations).split_selections()
+        if not selections:
+            return base, fingerprint, operations
+        source = self._source()
+        block = self.prefetcher.lookup(source, OperationPlan(selections).execute(self._lazy_base(base)), chain_key(source, selections))
+        if block is None:
+            return base, fingerprint, operations
+        if self.cache is not None:
+            # Content address of the selection, so that cached results stay valid
+            fingerprint = chain_key(fingerprint or self.fingerprint(), selections)
+        return OperationPlan(selections).execute(block), fingerprint, others
+
+    def _lazy_base(self, base):
+        """Lazy view of a base dataset, reusing the original one (wrapping in-memory arrays in dask copies them)."""
+        return self.view_original if base is self.dataset_original else _lazy(base)
+
     def update_dataset(self, new_dataset, operation):
-        self.dataset = new_dataset
+        """Replaces the current dataset with an already computed one."""
+        self.base = self.root = new_dataset
+        self.root_key = uuid.uuid4().hex
+        self.lineage = []
+        self._fingerprint = None
+        self.plan = OperationPlan()
+        self.view = _lazy(new_dataset)
+        self._materialized = new_dataset
+        self._at_checkpoint = None
         self.history.append(operation)
 
     def get_history(self):
-        return "\n".join(self.history)
\ No newline at end of file
+        return "\n".join(self.history)
+
+    def describe(self):
+        """Short description of the current dataset and of the operations that produced it."""
+        return (
+            f"Current dataset: dims {dict(self.view.sizes)}, variables {list(self.view.data_vars)}.\n"
+            f"Operations performed: {self.history if self.history else 'none'}"
+        )
+
+    def save_checkpoint(self, name):
+        """Saves the current state under `name`, without copying nor computing any dataset.
+
+        The values of the checkpoint are retained the first time they are
+        computed (here if already done), when they fit in `checkpoint_bytes`,
+        so that reverting to the checkpoint does not replay its operations.
+        """
+        self.checkpoints[name] = Checkpoint(
+            name, self.root, self.root_key, self.lineage + self.plan.operations, self.view, None,
+            self.records, self._fingerprint if self.base is self.root else None, parent=self.current_checkpoint)
+        self.checkpoints.move_to_end(name)
+        self.current_checkpoint = self._at_checkpoint = name
+        self._retain_checkpoint()
+        return self.checkpoints[name]
+
+    def revert(self, name):
+        """Restores the checkpoint `name`; later checkpoints are kept, so this also branches."""
+        checkpoint = self.checkpoints[name]
+        self.checkpoints.move_to_end(name)
+
+        if checkpoint.materialized is not None and checkpoint.materialized is not checkpoint.root:
+            # The retained values become the base, later operations resume from them
+            base, lineage, operations, fingerprint = checkpoint.materialized, checkpoint.lineage, [], None
+        else:
+            base, lineage, operations, fingerprint = self._nearest_retained_ancestor(checkpoint)
+
+        self.base = base
+        self.root, self.root_key, self.lineage = checkpoint.root, checkpoint.root_key, list(lineage)
+        self._fingerprint = fingerprint
+        self.plan = OperationPlan(operations)
+        self.view = checkpoint.view
+        self._materialized = checkpoint.materialized
+        self.records = list(checkpoint.records)
+        self.current_checkpoint = self._at_checkpoint = name
+        self.history.append(f"Reverted to checkpoint {name}")
+        return self.view
+
+    def branch(self, name):
+        """New DatasetState starting from the checkpoint `name`, sharing its datasets."""
+        branch = DatasetState(self.catalog or self.dataset_original, cache=self.cache, checkpoint_bytes=self.checkpoint_bytes,
+                              memory_budget=self.memory_budget, prefetcher=self.prefetcher)
+        branch.checkpoints = OrderedDict(self.checkpoints)
+        branch.revert(name)
+        branch.history = list(self.history) + [f"Branched from checkpoint {name}"]
+        return branch
+
+    def fork(self):
+        """New DatasetState over the same original dataset, without operations or checkpoints.
+
+        The original dataset, its lazy view, catalog and cache are shared,
+        so a fork costs no I/O and can serve a new session.
+        """
+        fork = copy.copy(self)
+        fork.base = fork.root = self.dataset_original
+        fork.root_key = self.original_key
+        fork.lineage = []
+        fork.plan = OperationPlan()
+        fork.history = []
+        fork.records = []
+        fork.checkpoints = OrderedDict()
+        fork.current_checkpoint = fork._at_checkpoint = None
+        fork._fingerprint = self._fingerprint if self.base is self.dataset_original else None
+        fork.view = self.view_original
+        fork._materialized = self.dataset_original if self.catalog is None else None
+        return fork
+
+    def copy(self):
+        """Independent DatasetState at the same point of the analysis, sharing its datasets (e.g. for dry runs)."""
+        state = copy.copy(self)
+        state.plan = OperationPlan(self.plan.operations)
+        state.lineage = list(self.lineage)
+        state.history = list(self.history)
+        state.records = list(self.records)
+        state.checkpoints = OrderedDict(self.checkpoints)
+        return state
+
+    def export(self, path, checkpoint=None, **kwargs):
+        """Streams the current dataset, or the checkpoint `checkpoint`, to a Zarr/NetCDF store.
+
+        `kwargs` are passed to `export_dataset`; returns the store manifest.
+        """
+        from climagent.state.export import export_dataset
+
+        if checkpoint is not None:
+            if checkpoint not in self.checkpoints:
+                raise KeyError(f"Unknown checkpoint '{checkpoint}'. Available checkpoints: {list(self.checkpoints)}")
+            return export_dataset(self.branch(checkpoint).lazy_dataset(), path, **kwargs)
+        return export_dataset(self.lazy_dataset(), path, **kwargs)
+
+    def list_checkpoints(self):
+        """Name, number of operations and retained memory of each checkpoint."""
+        return [{"name": c.name, "operations": len(c.lineage), "parent": c.parent,
+                 "retained": c.materialized is not None, "nbytes": c.nbytes}
+                for c in self.checkpoints.values()]
+
+    def _nearest_retained_ancestor(self, checkpoint):
+        """Base, its lineage and the operations recomputing an evicted checkpoint from its closest retained ancestor.
+
+        Ancestors are matched by lineage, so that the values retained by any
+        checkpoint derived from the same root are reused.
+        """
+        ancestor_name = checkpoint.parent
+        while ancestor_name in self.checkpoints:
+            ancestor = self.checkpoints[ancestor_name]
+            n = len(ancestor.lineage)
+            if (ancestor.nbytes and ancestor.root_key == checkpoint.root_key
+                    and ancestor.lineage == checkpoint.lineage[:n]):
+                return ancestor.materialized, ancestor.lineage, checkpoint.lineage[n:], None
+            ancestor_name = ancestor.parent
+        return checkpoint.root, [], checkpoint.lineage, checkpoint.fingerprint
+
+    def _retain_checkpoint(self):
+        """Keeps the computed values of the current state in its checkpoint, if they fit in `checkpoint_bytes`."""
+        checkpoint = self.checkpoints.get(self._at_checkpoint)
+        if (checkpoint is None or checkpoint.materialized is not None or self._materialized is None
+                or self._materialized.nbytes > self.checkpoint_bytes):
+            return
+        checkpoint.materialized = self._materialized
+        self._evict_checkpoints()
+
+    def _evict_checkpoints(self):
+        """Drops the datasets of the least recently used checkpoints above the memory budget.
+
+        Memory is counted once for each dataset, even if held by several
+        checkpoints, and a dataset is only dropped when this frees it: it is
+        then dropped from every checkpoint holding it, and never while it is
+        the base of the current state or held by the current checkpoint.
+        """
+        held = {id(c.materialized): c.nbytes for c in self.checkpoints.values() if c.nbytes}
+        retained = sum(held.values())
+        for checkpoint in self.checkpoints.values():
+            if retained <= self.checkpoint_bytes:
+                break
+            dataset = checkpoint.materialized
+            if id(dataset) not in held or dataset is self.base:
+                continue
+            holders = [c for c in self.checkpoints.values() if c.materialized is dataset]
+            if any(c.name == self.current_checkpoint for c in holders):
+                continue
+            for holder in holders:
+                holder.materialized = None
+            retained -= held.pop(id(dataset))
@@ -0,0 +1,207 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import os
+import tempfile
+import time
+from typing import Dict, Optional
+
+import numpy as np
+import xarray as xr
+
+
+# Directory of the exported stores, the agent can only write inside it
+EXPORT_DIR = os.getenv("CLIMAGENT_EXPORT_DIR", os.path.join(tempfile.gettempdir(), "climagent_exports"))
+
+FORMATS = ("zarr", "netcdf")
+COMPRESSIONS = ("zstd", "lz4", "zlib", "none")
+
+EXTENSIONS = {"zarr": ".zarr", "netcdf": ".nc"}
+
+# Encodings kept from the source variables, the others (compression, chunks) are set by the export
+_KEPT_ENCODING = ("units", "calendar")
+
+
+def export_path(name: str, format: str, export_dir: Optional[str] = None) -> str:
+    """Path of the store `name` inside the export directory; names cannot point outside it."""
+    if not name or os.path.basename(name) != name or name in (".", ".."):
+        raise ValueError(f"Invalid store name '{name}': use a plain file name, without directories")
+    if not name.endswith(EXTENSIONS[format]):
+        name += EXTENSIONS[format]
+    export_dir = export_dir or EXPORT_DIR
+    os.makedirs(export_dir, exist_ok=True)
+    return os.path.join(export_dir, name)
+
+
+def _netcdf_engine() -> str:
+    for engine, module in (("netcdf4", "netCDF4"), ("h5netcdf", "h5netcdf")):
+        try:
+            __import__(module)
+            return engine
+        except ImportError:
+            continue
+    # NetCDF3, without compression nor chunking
+    return "scipy"
+
+
+def _zarr_compressor(compression: str, level: int):
+    """Compressor encoding of a zarr variable, for the installed zarr version."""
+    import zarr
+
+    if compression == "none":
+        return {"compressors": None} if int(zarr.__version__.split(".")[0]) >= 3 else {"compressor": None}
+
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        from zarr import codecs
+        codec = {
+            "zstd": lambda: codecs.ZstdCodec(level=level),
+            "lz4": lambda: codecs.BloscCodec(cname="lz4", clevel=level),
+            "zlib": lambda: codecs.GzipCodec(level=level),
+        }[compression]()
+        return {"compressors": [codec]}
+
+    import numcodecs
+    codec = {
+        "zstd": lambda: numcodecs.Zstd(level=level),
+        "lz4": lambda: numcodecs.Blosc(cname="lz4", clevel=level),
+        "zlib": lambda: numcodecs.Zlib(level=level),
+    }[compression]()
+    return {"compressor": codec}
+
+
+def _target_chunks(dataset: xr.Dataset, chunks: Optional[Dict[str, int]]) -> Dict[str, int]:
+    """Uniform chunk size of each dimension: the requested one, else the largest dask chunk, else the whole dimension.
+
+    Chunks larger than dask's `array.chunk-size` are split along the
+    dimensions not requested, so that every block is computed and
+    compressed on its own.
+    """
+    unknown = [d for d in (chunks or {}) if d not in dataset.dims]
+    if unknown:
+        raise ValueError(f"Dimensions {unknown} not found in the dataset dimensions {list(dataset.dims)}")
+
+    current = dataset.chunks if dataset.chunks else {}
+    target = {}
+    for dim, size in dataset.sizes.items():
+        if chunks and dim in chunks:
+            target[dim] = max(1, min(int(chunks[dim]), size))
+        elif dim in current:
+            target[dim] = max(current[dim])
+        else:
+            target[dim] = size
+
+    try:
+        from climagent.state.cost import auto_chunks, chunk_limit
+        limit = chunk_limit()
+    except ImportError:
+        return target
+    if any(var.dtype.itemsize * int(np.prod([target[d] for d in var.dims])) > limit for var in dataset.data_vars.values()):
+        capped = auto_chunks(dataset, limit, fixed={d: target[d] for d in (chunks or {})})
+        target = {dim: min(size, capped.get(dim, size)) for dim, size in target.items()}
+    return target
+
+
+def _prepare(dataset: xr.Dataset) -> xr.Dataset:
+    """Shallow copy of the dataset whose variables only keep the time encodings."""
+    dataset = dataset.copy(deep=False)
+    for var in dataset.variables.values():
+        var.encoding = {k: v for k, v in var.encoding.items() if k in _KEPT_ENCODING}
+    return dataset
+
+
+def _store_bytes(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def _bounds(coord: xr.DataArray):
+    values = coord.values
+    if values.size == 0 or not (np.issubdtype(values.dtype, np.number) or np.issubdtype(values.dtype, np.datetime64)):
+        return None
+    first, last = values.min(), values.max()
+    if np.issubdtype(values.dtype, np.datetime64):
+        return [str(np.datetime_as_string(first, unit="s")), str(np.datetime_as_string(last, unit="s"))]
+    return [first.item(), last.item()]
+
+
+def manifest(path: str, format: str) -> dict:
+    """Compact description of a store, read from its metadata only."""
+    opened = xr.open_zarr(path) if format == "zarr" else xr.open_dataset(path, chunks={})
+    with opened as dataset:
+        return {
+            "path": path,
+            "format": format,
+            "dims": dict(dataset.sizes),
+            "variables": {
+                name: {"dims": list(var.dims), "dtype": str(var.dtype),
+                       "chunks": list(var.encoding.get("chunks") or var.encoding.get("chunksizes") or var.shape)}
+                for name, var in dataset.data_vars.items()
+            },
+            "bounds": {name: _bounds(coord) for name, coord in dataset.coords.items()
+                       if coord.ndim == 1 and name in dataset.dims},
+            "stored_bytes": _store_bytes(path),
+        }
+
+
+def export_dataset(dataset: xr.Dataset, path: str, format: str = "zarr", compression: Optional[str] = None, level: int = 3,
+                   chunks: Optional[Dict[str, int]] = None, append_dim: Optional[str] = None, overwrite: bool = False) -> dict:
+    """Writes the dataset to a Zarr or NetCDF store, chunk by chunk, and returns its manifest.
+
+    Dask backed datasets are streamed: every chunk is computed and written
+    on its own, so the result never needs to fit in memory (except with the
+    NetCDF3 engine, which writes at close). With `append_dim` the dataset
+    is appended along that dimension (e.g. time) to an existing Zarr store,
+    or creates it. `compression` defaults to zstd for Zarr and zlib for
+    NetCDF (none when only the NetCDF3 engine is available).
+    """
+    if format not in FORMATS:
+        raise ValueError(f"Unsupported format '{format}'. Choose from {list(FORMATS)}")
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError(f"Unsupported compression '{compression}'. Choose from {list(COMPRESSIONS)}")
+    if append_dim is not None and (format != "zarr" or append_dim not in dataset.dims):
+        raise ValueError(f"Appending needs the zarr format and a dimension among {list(dataset.dims)}")
+
+    start = time.perf_counter()
+    dataset = _prepare(dataset)
+    target = _target_chunks(dataset, chunks)
+    if dataset.chunks or chunks:
+        dataset = dataset.chunk(target)
+
+    appending = append_dim is not None and os.path.exists(path)
+    if os.path.exists(path) and not overwrite and not appending:
+        raise FileExistsError(f"The store {path} already exists, choose another name or overwrite it")
+
+    if format == "zarr":
+        if appending:
+            # The existing variables keep their encoding, chunks are aligned to the stored ones
+            dataset.to_zarr(path, mode="a", append_dim=append_dim, align_chunks=True)
+        else:
+            compressor = _zarr_compressor(compression or "zstd", level)
+            encoding = {
+                name: dict(compressor, chunks=tuple(target[d] for d in var.dims))
+                for name, var in dataset.data_vars.items() if var.ndim > 0
+            }
+            dataset.to_zarr(path, mode="w" if overwrite else "w-", encoding=encoding)
+    else:
+        engine = _netcdf_engine()
+        compression = compression or ("zlib" if engine != "scipy" else "none")
+        if compression not in ("zlib", "none"):
+            raise ValueError(f"NetCDF stores support zlib compression only, got '{compression}'")
+        if compression == "zlib" and engine == "scipy":
+            raise ValueError("NetCDF compression needs the netCDF4 or h5netcdf package, export as zarr or without compression")
+        encoding = {}
+        if engine != "scipy":
+            encoding = {
+                name: {"zlib": compression == "zlib", "complevel": level, "chunksizes": tuple(target[d] for d in var.dims)}
+                for name, var in dataset.data_vars.items() if var.ndim > 0
+            }
+        if overwrite and os.path.exists(path):
+            os.remove(path)
+        dataset.to_netcdf(path, engine=engine, encoding=encoding)
+
+    result = manifest(path, format)
+    result["compression"] = None if appending else (compression or "zstd")
+    result["appended"] = appending
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
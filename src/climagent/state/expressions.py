@@ -0,0 +1,259 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import ast
+from fractions import Fraction
+from typing import Dict, List, Optional
+
+import numpy as np
+import xarray as xr
+
+
+# Number of elements evaluated at once: the intermediate results of a block stay in the CPU cache
+BLOCK_SIZE = 8192
+
+# Longest accepted expression, in characters and in syntax nodes
+MAX_LENGTH = 500
+MAX_NODES = 200
+
+
+def _where(condition, x, y, out):
+    np.copyto(out, y)
+    np.copyto(out, x, where=condition)
+    return out
+
+
+FUNCTIONS = {
+    "sqrt": np.sqrt, "exp": np.exp, "log": np.log, "log10": np.log10, "abs": np.abs,
+    "sin": np.sin, "cos": np.cos, "tan": np.tan, "arcsin": np.arcsin, "arccos": np.arccos, "arctan": np.arctan,
+    "arctan2": np.arctan2, "hypot": np.hypot, "minimum": np.minimum, "maximum": np.maximum, "where": _where,
+}
+
+ARITY = {"arctan2": 2, "hypot": 2, "minimum": 2, "maximum": 2, "where": 3}
+
+# Functions also provided by numexpr, which evaluates the whole expression on several threads
+NUMEXPR_FUNCTIONS = {"sqrt", "exp", "log", "log10", "abs", "sin", "cos", "tan", "arcsin", "arccos", "arctan", "arctan2", "where"}
+
+CONSTANTS = {"pi": np.pi, "e": np.e}
+
+OPERATORS = {
+    ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.true_divide,
+    ast.Pow: np.power, ast.Mod: np.mod, ast.USub: np.negative, ast.UAdd: np.positive,
+    ast.Lt: np.less, ast.LtE: np.less_equal, ast.Gt: np.greater, ast.GtE: np.greater_equal,
+    ast.Eq: np.equal, ast.NotEq: np.not_equal,
+}
+
+# Units kept by an operation when all its operands share them
+_UNIT_PRESERVING = {"abs", "minimum", "maximum", "hypot"}
+
+
+class Expression:
+    """Arithmetic expression over data variables, checked and compiled once.
+
+    Only numbers, variable names, the operators + - * / ** % and comparisons,
+    and the functions in FUNCTIONS are accepted. The expression is compiled
+    into a program of NumPy ufuncs evaluated block by block, every
+    intermediate result being written to a small reused buffer: element-wise
+    operations are fused and no temporary array of the size of the data is
+    allocated. numexpr is used instead when installed.
+    """
+
+    def __init__(self, text: str, variables):
+        if len(text) > MAX_LENGTH:
+            raise ValueError(f"The expression is too long, use at most {MAX_LENGTH} characters")
+        try:
+            tree = ast.parse(text.strip(), mode="eval").body
+        except SyntaxError as e:
+            raise ValueError(f"Invalid expression '{text}': {e.msg}") from None
+
+        self.text = text.strip()
+        self.variables = []
+        self._available = set(variables)
+        self._nodes = 0
+        self.tree = self._check(tree)
+
+    def _check(self, node):
+        """Validates a node; variables are collected and constants replaced by their value."""
+        self._nodes += 1
+        if self._nodes > MAX_NODES:
+            raise ValueError(f"The expression is too complex, use at most {MAX_NODES} terms")
+
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            return node
+        if isinstance(node, ast.Name):
+            if node.id in self._available:
+                if node.id not in self.variables:
+                    self.variables.append(node.id)
+                return node
+            if node.id in CONSTANTS:
+                return ast.Constant(CONSTANTS[node.id])
+            raise ValueError(f"Unknown variable '{node.id}'. Available variables: {sorted(self._available)}")
+        if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+            return ast.BinOp(self._check(node.left), node.op, self._check(node.right))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in OPERATORS:
+            return ast.UnaryOp(node.op, self._check(node.operand))
+        if isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in OPERATORS:
+            return ast.Compare(self._check(node.left), node.ops, [self._check(node.comparators[0])])
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS:
+            if node.keywords or len(node.args) != ARITY.get(node.func.id, 1):
+                raise ValueError(f"{node.func.id} takes {ARITY.get(node.func.id, 1)} positional arguments")
+            return ast.Call(node.func, [self._check(arg) for arg in node.args], [])
+        if isinstance(node, ast.Call):
+            raise ValueError(f"Unsupported function '{ast.unparse(node.func)}'. Available functions: {sorted(FUNCTIONS)}")
+        raise ValueError(f"Unsupported syntax '{ast.unparse(node)}': use numbers, variables, + - * / ** %, comparisons and {sorted(FUNCTIONS)}")
+
+    def _numpy(self, node, values):
+        """Direct NumPy evaluation of a node, used on one element samples to find the dtypes."""
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Name):
+            return values[node.id]
+        if isinstance(node, ast.BinOp):
+            return OPERATORS[type(node.op)](self._numpy(node.left, values), self._numpy(node.right, values))
+        if isinstance(node, ast.UnaryOp):
+            return OPERATORS[type(node.op)](self._numpy(node.operand, values))
+        if isinstance(node, ast.Compare):
+            return OPERATORS[type(node.ops[0])](self._numpy(node.left, values), self._numpy(node.comparators[0], values))
+        args = [self._numpy(arg, values) for arg in node.args]
+        return np.where(*args) if node.func.id == "where" else FUNCTIONS[node.func.id](*args)
+
+    def compile(self, dtypes: Dict[str, np.dtype]):
+        """Kernel computing the expression on NumPy arrays of the variables (in the order of `variables`)."""
+        samples = {name: np.ones(1, dtype=dtypes[name]) for name in self.variables}
+        dtype = np.asarray(self._numpy(self.tree, samples)).dtype
+
+        numexpr = _numexpr()
+        if numexpr is not None and self._numexpr_compatible(self.tree):
+            source = ast.unparse(self.tree)
+            names = list(self.variables)
+
+            def numexpr_kernel(*arrays):
+                return numexpr.evaluate(source, local_dict=dict(zip(names, arrays))).astype(dtype, copy=False)
+
+            return numexpr_kernel, dtype
+
+        program, registers = [], []
+
+        def emit(node):
+            """Appends the instructions of a node, returns the reference of its value."""
+            if isinstance(node, ast.Constant):
+                return ("constant", node.value)
+            if isinstance(node, ast.Name):
+                return ("input", self.variables.index(node.id))
+            if isinstance(node, ast.BinOp):
+                func, args = OPERATORS[type(node.op)], [node.left, node.right]
+            elif isinstance(node, ast.UnaryOp):
+                func, args = OPERATORS[type(node.op)], [node.operand]
+            elif isinstance(node, ast.Compare):
+                func, args = OPERATORS[type(node.ops[0])], [node.left, node.comparators[0]]
+            else:
+                func, args = FUNCTIONS[node.func.id], node.args
+            refs = [emit(arg) for arg in args]
+            registers.append(np.asarray(self._numpy(node, samples)).dtype)
+            program.append((func, refs, len(registers) - 1))
+            return ("register", len(registers) - 1)
+
+        root = emit(self.tree)
+        if root[0] != "register":
+            # A bare variable or number is copied
+            program.append((np.copyto, [root], None))
+        else:
+            program[-1] = (program[-1][0], program[-1][1], None)
+
+        def kernel(*arrays):
+            iterator = np.nditer(
+                list(arrays) + [None], flags=["external_loop", "buffered", "zerosize_ok"],
+                op_flags=[["readonly"]] * len(arrays) + [["writeonly", "allocate"]],
+                op_dtypes=[a.dtype for a in arrays] + [dtype], buffersize=BLOCK_SIZE)
+            buffers = [np.empty(BLOCK_SIZE, dtype=d) for d in registers]
+            with iterator:
+                for *inputs, out in iterator:
+                    n = out.shape[0]
+                    for func, refs, target in program:
+                        args = [inputs[i] if kind == "input" else buffers[i][:n] if kind == "register" else i
+                                for kind, i in refs]
+                        if target is None:
+                            func(out, *args) if func is np.copyto else func(*args, out=out)
+                        else:
+                            func(*args, out=buffers[target][:n])
+                return iterator.operands[-1]
+
+        return kernel, dtype
+
+    def _numexpr_compatible(self, node) -> bool:
+        if isinstance(node, ast.Call) and node.func.id not in NUMEXPR_FUNCTIONS:
+            return False
+        return all(self._numexpr_compatible(child) for child in ast.iter_child_nodes(node))
+
+    def units(self, variable_units: Dict[str, Optional[str]]) -> Optional[str]:
+        """Units of the result when they follow from the expression, else None.
+
+        Sums, differences, min/max/abs/hypot of quantities with the same units,
+        and powers and square roots of them, keep their units. Products with
+        numbers and offsets (e.g. Kelvin to Celsius) are conversions whose
+        units cannot be inferred.
+        """
+        def infer(node):
+            # (units, exponent), ("", 0) for pure numbers, None when unknown
+            if isinstance(node, ast.Constant):
+                return ("", Fraction(0))
+            if isinstance(node, ast.Name):
+                units = variable_units.get(node.id)
+                return (units, Fraction(1)) if units else None
+            if isinstance(node, ast.UnaryOp):
+                return infer(node.operand)
+            if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub)):
+                left, right = infer(node.left), infer(node.right)
+                return left if left is not None and left == right and left[1] != 0 else None
+            if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+                base = infer(node.left)
+                if base is None or not isinstance(node.right, ast.Constant):
+                    return None
+                return (base[0], base[1] * Fraction(node.right.value).limit_denominator(100))
+            if isinstance(node, ast.Call) and node.func.id == "sqrt":
+                base = infer(node.args[0])
+                return (base[0], base[1] / 2) if base is not None else None
+            if isinstance(node, ast.Call) and node.func.id in _UNIT_PRESERVING | {"where"}:
+                args = [infer(arg) for arg in (node.args[1:] if node.func.id == "where" else node.args)]
+                return args[0] if args[0] is not None and all(a == args[0] for a in args) and args[0][1] != 0 else None
+            return None
+
+        result = infer(self.tree)
+        if result is None or result[1] == 0:
+            return None
+        units, exponent = result
+        if exponent == 1:
+            return units
+        return f"{units}^{exponent}" if " " not in units else f"({units})^{exponent}"
+
+
+def _numexpr():
+    try:
+        import numexpr
+        return numexpr
+    except ImportError:
+        return None
+
+
+def derive(dataset: xr.Dataset, name: str, expression: str, units: Optional[str] = None,
+           long_name: Optional[str] = None) -> xr.Dataset:
+    """Adds the variable `name` computed from `expression`, lazily and chunk by chunk for dask data.
+
+    Operands are broadcast against each other by dimension name. Units are
+    the given ones, or inferred from the operands when possible.
+    """
+    if name in dataset.coords:
+        raise ValueError(f"'{name}' is a coordinate, choose another name for the derived variable")
+    parsed = Expression(expression, [str(v) for v in dataset.data_vars])
+    if not parsed.variables:
+        raise ValueError("The expression must use at least one variable")
+
+    operands = [dataset[v] for v in parsed.variables]
+    kernel, dtype = parsed.compile({v: dataset[v].dtype for v in parsed.variables})
+    result = xr.apply_ufunc(kernel, *operands, dask="parallelized", output_dtypes=[dtype], keep_attrs=False)
+
+    attrs = {"long_name": long_name or name, "expression": parsed.text}
+    units = units or parsed.units({v: dataset[v].attrs.get("units") for v in parsed.variables})
+    if units:
+        attrs["units"] = units
+    return dataset.assign({name: result.assign_attrs(attrs)})
@@ -0,0 +1,339 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
+
+import numpy as np
+import xarray as xr
+
+
+# Reducers computed from the grouped partial statistics
+REDUCERS = ("mean", "sum", "min", "max", "std", "var", "count")
+
+# Groupings of a time coordinate
+GROUPINGS = ("season", "month", "dayofyear", "hour")
+
+SEASONS = ("DJF", "MAM", "JJA", "SON")
+
+# Partial statistics of a block: count, sum, M2 (squared deviations from the block mean), max, min
+_PARTIALS = 5
+
+# Number of label arrays kept in memory, one for each time coordinate and grouping
+GROUP_LABELS = 32
+
+_labels = OrderedDict()
+_labels_lock = threading.Lock()
+
+
+def _time_key(time: xr.DataArray, by: str) -> str:
+    values = np.asarray(time.values)
+    digest = hashlib.sha256(f"{time.name}:{by}".encode())
+    if values.dtype.kind in "Mm":
+        digest.update(values.astype("int64").tobytes())
+    else:
+        # cftime dates
+        digest.update("\n".join(map(str, values.ravel())).encode())
+    return digest.hexdigest()
+
+
+def group_labels(time: xr.DataArray, by: str):
+    """Integer group code of each time step and the label of each group, cached per time coordinate."""
+    if by not in GROUPINGS:
+        raise ValueError(f"Unsupported grouping '{by}'. Choose from {list(GROUPINGS)}")
+
+    def compute():
+        values = np.asarray(getattr(time.dt, by).values)
+        if by == "season":
+            # Seasons in calendar order rather than alphabetical
+            groups = np.array([s for s in SEASONS if s in set(values)])
+            position = {s: i for i, s in enumerate(groups)}
+            codes = np.array([position[s] for s in values])
+        else:
+            groups, codes = np.unique(values, return_inverse=True)
+        return codes.astype(np.intp), groups
+
+    return _cached_labels(_time_key(time, by), compute)
+
+
+def bin_labels(time: xr.DataArray, frequency: str):
+    """Resample bin of each time step and the label of each bin (empty bins included), cached per time coordinate.
+
+    Bins follow the xarray resample conventions; they are computed on the
+    positions of the time steps only.
+    """
+
+    def compute():
+        positions = xr.DataArray(np.arange(time.size), coords={time.name: time}, dims=time.dims)
+        first = positions.resample({time.name: frequency}).min()
+        filled = np.flatnonzero(~np.isnan(first.values))
+        starts = first.values[filled].astype(np.intp)
+        codes = filled[np.searchsorted(starts, np.arange(time.size), side="right") - 1]
+        return codes.astype(np.intp), first[time.name].values
+
+    return _cached_labels(_time_key(time, f"resample:{frequency}"), compute)
+
+
+def _cached_labels(key: str, compute):
+    with _labels_lock:
+        if key in _labels:
+            _labels.move_to_end(key)
+            return _labels[key]
+
+    labels = compute()
+    with _labels_lock:
+        _labels[key] = labels
+        while len(_labels) > GROUP_LABELS:
+            _labels.popitem(last=False)
+    return labels
+
+
+def _group_sum(codes: np.ndarray, ngroups: int, values: np.ndarray) -> np.ndarray:
+    """Sum of the rows of `values` in each group, as a sparse one-hot product when scipy is available."""
+    try:
+        from scipy import sparse
+    except ImportError:
+        out = np.zeros((ngroups,) + values.shape[1:])
+        np.add.at(out, codes, values)
+        return out
+    onehot = sparse.csr_matrix((np.ones(len(codes)), (codes, np.arange(len(codes)))), shape=(ngroups, len(codes)))
+    return np.asarray(onehot @ values)
+
+
+def _partials(block: np.ndarray, codes: np.ndarray, funcs: Tuple[str, ...]) -> np.ndarray:
+    """Partial statistics of the groups present in a block with time on axis 0.
+
+    Groups come in the order of `np.unique(codes)`, so that a block only
+    holds the groups it covers. Only the statistics needed by `funcs` are
+    computed: sums as a single grouped product, extremes with one pass over
+    the block sorted by group.
+    """
+    present, codes = np.unique(codes, return_inverse=True)
+    ngroups = len(present)
+    block = np.asarray(block, dtype=np.float64)
+    out = np.zeros((_PARTIALS, ngroups) + block.shape[1:])
+    out[3], out[4] = -np.inf, np.inf
+    if block.shape[0] == 0:
+        return out
+
+    data = block.reshape(block.shape[0], -1)
+    valid = ~np.isnan(data)
+    has_nan = not valid.all()
+    filled = np.where(valid, data, 0.0) if has_nan else data
+    parts = out.reshape(_PARTIALS, ngroups, -1)
+
+    if has_nan:
+        parts[0] = _group_sum(codes, ngroups, valid.astype(np.float64))
+    else:
+        parts[0] = np.bincount(codes, minlength=ngroups)[:, None]
+    parts[1] = _group_sum(codes, ngroups, filled)
+
+    if "std" in funcs or "var" in funcs:
+        # Squared deviations around the block mean, shifted to avoid cancellation
+        with np.errstate(invalid="ignore", divide="ignore"):
+            shift = np.nan_to_num(parts[1].sum(axis=0) / parts[0].sum(axis=0))
+        centered = np.where(valid, data - shift, 0.0)
+        squares = _group_sum(codes, ngroups, centered ** 2)
+        sums = parts[1] - parts[0] * shift
+        with np.errstate(invalid="ignore", divide="ignore"):
+            parts[2] = np.where(parts[0] > 0, squares - sums ** 2 / parts[0], 0.0)
+
+    if "max" in funcs or "min" in funcs:
+        order = np.argsort(codes, kind="stable")
+        starts = np.flatnonzero(np.r_[True, np.diff(codes[order]) != 0])
+        data = data[order]
+        for func, ufunc, row in (("max", np.fmax, 3), ("min", np.fmin, 4)):
+            if func in funcs:
+                with np.errstate(invalid="ignore"):
+                    extreme = ufunc.reduceat(data, starts, axis=0)
+                parts[row] = np.where(np.isnan(extreme), parts[row], extreme)
+
+    return out
+
+
+def _segment_reduce(ufunc, values: np.ndarray, owner: np.ndarray, ngroups: int, fill: float) -> np.ndarray:
+    """Reduces the rows of `values` belonging to each group, `owner` being sorted."""
+    out = np.full((ngroups,) + values.shape[1:], fill)
+    if len(owner):
+        present, starts = np.unique(owner, return_index=True)
+        out[present] = ufunc.reduceat(values, starts, axis=0)
+    return out
+
+
+def _combine(parts: np.ndarray, owner: np.ndarray, ngroups: int, func: str) -> np.ndarray:
+    """Merges partial statistics (groups on axis 1, group of each row in sorted `owner`) into the final reduction."""
+    count = _segment_reduce(np.add, parts[0], owner, ngroups, 0.0)
+    total = _segment_reduce(np.add, parts[1], owner, ngroups, 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total / count
+        if func in ("std", "var"):
+            block_mean = np.where(parts[0] > 0, parts[1] / parts[0], 0.0)
+            deviations = np.where(parts[0] > 0, parts[0] * (block_mean - mean[owner]) ** 2, 0.0)
+            m2 = _segment_reduce(np.add, parts[2] + deviations, owner, ngroups, 0.0)
+            var = m2 / count
+
+    empty = count == 0
+    if func == "count":
+        return count
+    if func == "sum":
+        return total
+    if func == "mean":
+        return mean
+    if func == "var":
+        return np.where(empty, np.nan, var)
+    if func == "std":
+        return np.where(empty, np.nan, np.sqrt(var))
+    if func == "max":
+        return np.where(empty, np.nan, _segment_reduce(np.maximum, parts[3], owner, ngroups, -np.inf))
+    if func == "min":
+        return np.where(empty, np.nan, _segment_reduce(np.minimum, parts[4], owner, ngroups, np.inf))
+    raise ValueError(f"Unsupported reducer '{func}'. Choose from {list(REDUCERS)}")
+
+
+def _check_reducers(funcs):
+    unknown = [f for f in funcs if f not in REDUCERS]
+    if unknown:
+        raise ValueError(f"Unsupported reducer {unknown}. Choose from {list(REDUCERS)}")
+
+
+def grouped_reduce(data, codes: np.ndarray, ngroups: int, func: str):
+    """Reduces `data` (time on axis 0) over the groups given by `codes`.
+
+    NumPy arrays are reduced at once. Dask arrays are reduced block by
+    block along time, every block producing partial statistics for the
+    groups it covers only. The partials are then sorted by group and
+    merged in chunks holding whole groups, so the time axis never needs to
+    be rechunked and no block allocates all the groups.
+    """
+    _check_reducers((func,))
+
+    if not hasattr(data, "dask"):
+        return _combine(_partials(data, codes, (func,)), np.unique(codes), ngroups, func)
+
+    import dask.array as da
+
+    parts, owners, start = [], [], 0
+    for size in data.chunks[0]:
+        block_codes = codes[start:start + size]
+        owners.append(np.unique(block_codes))
+        parts.append(data[start:start + size].map_blocks(
+            _partials, block_codes, (func,), drop_axis=0, new_axis=[0, 1],
+            chunks=((_PARTIALS,), (len(owners[-1]),)) + data.chunks[1:], dtype=np.float64))
+        start += size
+
+    owner = np.concatenate(owners)
+    order = np.argsort(owner, kind="stable")
+    owner = owner[order]
+    parts = da.concatenate(parts, axis=1)[:, order]
+    parts = parts.rechunk({1: _aligned_chunks(parts.chunks[1], owner)})
+
+    outputs, start = [], 0
+    for size in parts.chunks[1]:
+        end = start + size
+        # A chunk also covers the groups without any row before the next one
+        first = owner[start] if start > 0 else 0
+        last = owner[end] if end < len(owner) else ngroups
+        outputs.append(parts[:, start:end].map_blocks(
+            _combine, owner[start:end] - first, last - first, func, drop_axis=0,
+            chunks=((last - first,),) + data.chunks[1:], dtype=np.float64))
+        start = end
+    return da.concatenate(outputs, axis=0)
+
+
+def climatology(dataset: xr.Dataset, coordinate_name: str, by: str, func: str) -> xr.Dataset:
+    """Reduces every variable over the groups (season, month, ...) of a time coordinate."""
+    time = dataset[coordinate_name]
+    codes, groups = group_labels(time, by)
+    dim = time.dims[0]
+
+    data_vars = {}
+    for name, var in dataset.data_vars.items():
+        if dim not in var.dims:
+            data_vars[name] = var
+            continue
+        var = var.transpose(dim, ...)
+        reduced = grouped_reduce(var.data, codes, len(groups), func)
+        data_vars[name] = xr.Variable((by,) + var.dims[1:], reduced, var.attrs)
+
+    coords = {name: coord for name, coord in dataset.coords.items() if dim not in coord.dims}
+    coords[by] = groups
+    return xr.Dataset(data_vars, coords=coords, attrs=dataset.attrs)
+
+
+def _reduce_bins(block: np.ndarray, codes: np.ndarray, ngroups: int, funcs: Tuple[str, ...]) -> np.ndarray:
+    """Every reduction of `funcs` over the whole bins of a block, stacked on axis 0."""
+    parts = _partials(block, codes, funcs)
+    present = np.unique(codes)
+    return np.stack([_combine(parts, present, ngroups, func) for func in funcs])
+
+
+def _aligned_chunks(chunks: Tuple[int, ...], codes: np.ndarray) -> Tuple[int, ...]:
+    """Time chunks moved to the next bin start, so that no bin is split between two chunks."""
+    starts = np.flatnonzero(np.diff(codes)) + 1
+    boundaries = [0]
+    for boundary in np.cumsum(chunks)[:-1]:
+        i = np.searchsorted(starts, boundary)
+        if i < len(starts) and starts[i] > boundaries[-1]:
+            boundaries.append(int(starts[i]))
+    boundaries.append(len(codes))
+    return tuple(np.diff(boundaries))
+
+
+def reduce_bins(data, codes: np.ndarray, ngroups: int, funcs: Tuple[str, ...]) -> List:
+    """Reduces `data` (time on axis 0) over contiguous bins, one result for each reducer of `funcs`.
+
+    All the reducers are computed from the same read of the data. Dask
+    arrays are rechunked along time so that every chunk holds whole bins,
+    then each chunk is reduced on its own: memory is bounded by one chunk.
+    """
+    _check_reducers(funcs)
+
+    if not hasattr(data, "dask"):
+        return list(_reduce_bins(data, codes, ngroups, funcs))
+
+    import dask.array as da
+
+    data = data.rechunk({0: _aligned_chunks(data.chunks[0], codes)})
+    outputs, start = [], 0
+    for size in data.chunks[0]:
+        end = start + size
+        # A chunk also covers the empty bins before the next one
+        first = codes[start]
+        last = codes[end] if end < len(codes) else ngroups
+        outputs.append(data[start:end].map_blocks(
+            _reduce_bins, codes[start:end] - first, last - first, funcs, drop_axis=0, new_axis=[0, 1],
+            chunks=((len(funcs),), (last - first,)) + data.chunks[1:], dtype=np.float64))
+        start = end
+    return list(da.concatenate(outputs, axis=1))
+
+
+def resample(dataset: xr.Dataset, coordinate_name: str, frequency: str, funcs: Tuple[str, ...] = ("mean",)) -> xr.Dataset:
+    """Resamples every variable on a time coordinate with one or more reducers.
+
+    With a single reducer the variables keep their names, otherwise one
+    variable is created for each reducer, named `<variable>_<reducer>`.
+    """
+    time = dataset[coordinate_name]
+    codes, labels = bin_labels(time, frequency)
+    dim = time.dims[0]
+    # Bins without time steps are missing values for every reducer, as in xarray
+    empty = np.bincount(codes, minlength=len(labels)) == 0
+
+    data_vars = {}
+    for name, var in dataset.data_vars.items():
+        if dim not in var.dims:
+            data_vars[name] = var
+            continue
+        dims = var.dims
+        var = var.transpose(dim, ...)
+        for func, reduced in zip(funcs, reduce_bins(var.data, codes, len(labels), funcs)):
+            if empty.any():
+                reduced = np.where(empty.reshape((-1,) + (1,) * (var.ndim - 1)), np.nan, reduced)
+            key = name if len(funcs) == 1 else f"{name}_{func}"
+            data_vars[key] = xr.Variable(var.dims, reduced, var.attrs).transpose(*dims)
+
+    coords = {name: coord for name, coord in dataset.coords.items() if dim not in coord.dims}
+    coords[coordinate_name] = xr.Variable((dim,), labels, time.attrs)
+    return xr.Dataset(data_vars, coords=coords, attrs=dataset.attrs)
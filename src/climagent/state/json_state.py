@@ -1,20 +1,46 @@
 # Author: jacopo.grassi@polito.it
 # Institute: Politecnico di Torino
 
+import copy
+
+import numpy as np
 import xarray as xr
-from langchain_community.tools.json.tool import JsonSpec
+
+from climagent.state.metadata_cache import MetadataCache, schema_hash, source_identity, to_json
+from climagent.state.operation_plan import Operation, ResampleTime, Subset
 
 
+# Number of values shown at the beginning and at the end of each coordinate
+SAMPLE_SIZE = 3
+
 
 class JsonState:
-    def __init__(self, dataset : xr.Dataset):
-        self.json_spec_original = self._create_json_spec(dataset)
-        self.json_spec = self._create_json_spec(dataset)
+    def __init__(self, dataset : xr.Dataset, source = None, metadata_cache : MetadataCache = None):
+        # The spec is built once and shared, updates always create a new one.
+        # Datasets read from a file or a catalog (`source`, by default the file in the dataset encoding)
+        # reuse the summary stored in a sidecar by a previous session, while the file does not change.
+        self.metadata_cache = metadata_cache if metadata_cache is not None else MetadataCache()
+        self.json_spec_original = self._load_json_spec(dataset, source)
+        self.json_spec = self.json_spec_original
         self.history = []
+        self.checkpoints = {}
 
     def update_json_spec(self, new_dataset, operation):
-        """Update the json_spec."""
-        self.json_spec = self._create_json_spec(new_dataset)
+        """Update the json_spec.
+
+        When `operation` is an Operation, only the coordinates it touches are
+        summarized again, the others are reused from the current spec.
+        """
+        if isinstance(operation, Operation):
+            data = {
+                'attrs': self._get_dataset_attrs(new_dataset),
+                'coords': self._update_dataset_coords(new_dataset, operation),
+                'data_vars': self._get_dataset_vars(new_dataset)
+                }
+            self.json_spec = _json_spec(data, self.json_spec.max_value_length)
+            operation = operation.describe()
+        else:
+            self.json_spec = self._create_json_spec(new_dataset)
         self.history.append(operation)
 
     def get_spec(self):
@@ -24,16 +50,60 @@ class JsonState:
     def get_history(self):
         """Get history of operations on json_spec."""
         return "\n".join(self.history)
-    
+
+    def fork(self):
+        """New JsonState sharing the original spec, without history or checkpoints."""
+        fork = copy.copy(self)
+        fork.json_spec = self.json_spec_original
+        fork.history = []
+        fork.checkpoints = {}
+        return fork
+
+    def copy(self):
+        """Independent JsonState with the same spec, history and checkpoints."""
+        state = copy.copy(self)
+        state.history = list(self.history)
+        state.checkpoints = dict(self.checkpoints)
+        return state
+
+    def save_checkpoint(self, name):
+        """Save the current json_spec under `name` (specs are never modified in place)."""
+        self.checkpoints[name] = self.json_spec
+
+    def revert(self, name):
+        """Restore the json_spec saved under `name`."""
+        self.json_spec = self.checkpoints[name]
+        self.history.append(f"Reverted to checkpoint {name}")
+
 
     def _get_dataset_attrs(self, dataset : xr.Dataset) -> dict :
         """Returns dataset attributes."""
         return dataset.attrs
 
-    def _get_dataset_coords(self, dataset : xr.Dataset) -> dict : 
-        """Returns dataset coordinates."""
-        all_coords = list(dataset.coords.keys())
-        coord_info = {coord: dataset.coords[coord].to_dict() for coord in all_coords}
+    def _get_dataset_coords(self, dataset : xr.Dataset) -> dict :
+        """Returns a compact summary of each dataset coordinate."""
+        return {coord: summarize_coord(dataset.coords[coord]) for coord in dataset.coords}
+
+    def _update_dataset_coords(self, dataset : xr.Dataset, operation : Operation) -> dict :
+        """Returns the coordinates summary after `operation`, reusing untouched coordinates."""
+        previous = self.json_spec.dict_['coords']
+        touched = set(operation.touched_dims())
+        coord_info = {}
+
+        for coord in dataset.coords:
+            coord_var = dataset.coords[coord]
+
+            if coord in previous and coord not in touched and not touched.intersection(coord_var.dims):
+                coord_info[coord] = previous[coord]
+            elif isinstance(operation, Subset) and coord in previous and coord_var.ndim == 1:
+                # A selection only narrows the bounds of a monotonic coordinate
+                coord_info[coord] = narrow_coord_summary(previous[coord], coord_var)
+            else:
+                coord_info[coord] = summarize_coord(coord_var)
+
+            if isinstance(operation, ResampleTime) and coord == operation.coordinate_name:
+                coord_info[coord]['step'] = operation.frequency
+
         return coord_info
 
     def _get_dataset_vars(self, dataset : xr.Dataset) -> dict :
@@ -42,17 +112,105 @@ class JsonState:
         var_info = {var: dataset[var].attrs for var in all_vars}
         return var_info
 
-    def _create_json_spec(self, dataset : xr.Dataset, max_value_lenght : int = 1000) -> JsonSpec :
+    def _create_json_spec(self, dataset : xr.Dataset, max_value_lenght : int = 1000) -> "JsonSpec" :
         """Creates JsonSpec from dataset."""
-        data = {
-            'attrs': self._get_dataset_attrs(dataset), 
-            'coords': self._get_dataset_coords(dataset), 
+        return _json_spec(self._summarize(dataset), max_value_lenght)
+
+    def _summarize(self, dataset : xr.Dataset) -> dict :
+        return {
+            'attrs': self._get_dataset_attrs(dataset),
+            'coords': self._get_dataset_coords(dataset),
             'data_vars': self._get_dataset_vars(dataset)
             }
 
-        json_spec = JsonSpec(
-            dict_=data,
-            max_value_length=max_value_lenght
-        )
+    def _load_json_spec(self, dataset : xr.Dataset, source = None) -> "JsonSpec" :
+        """JsonSpec of the original dataset, read from its sidecar when valid, else built and stored."""
+        identity = source_identity(dataset, source) if self.metadata_cache.enabled else None
+        if identity is None:
+            return self._create_json_spec(dataset)
+
+        schema = schema_hash(dataset)
+        data = self.metadata_cache.load(identity, schema)
+        if data is None:
+            # Stored as JSON, so that a fresh summary and a cached one are the same
+            data = to_json(self._summarize(dataset))
+            self.metadata_cache.save(identity, schema, data)
+        return _json_spec(data, 1000)
+
+
+def _json_spec(data : dict, max_value_length : int):
+    # langchain_community is slow to import, it is only loaded with the first spec
+    from langchain_community.tools.json.tool import JsonSpec
+
+    return JsonSpec(dict_=data, max_value_length=max_value_length)
+
+
+def _to_python(value):
+    """Converts a numpy scalar into a short, JSON friendly, python value."""
+    if isinstance(value, np.datetime64):
+        return str(np.datetime_as_string(value, unit='s'))
+    if isinstance(value, np.timedelta64):
+        return str(value.astype('timedelta64[s]'))
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _samples(values : np.ndarray) -> tuple :
+    head = [_to_python(v) for v in values[:SAMPLE_SIZE]]
+    tail = [_to_python(v) for v in values[-SAMPLE_SIZE:]]
+    return head, tail
+
+
+def summarize_coord(coord : xr.DataArray) -> dict :
+    """Summary of a coordinate: dtype, length, bounds, regular step, samples and monotonicity."""
+    values = np.asarray(coord.values)
+    summary = {
+        'dims': coord.dims,
+        'dtype': str(values.dtype),
+        'length': int(values.size),
+        'attrs': coord.attrs,
+        }
+
+    if values.ndim == 0:
+        summary['value'] = _to_python(values[()])
+        return summary
+
+    flat = values.ravel()
+    numeric = np.issubdtype(flat.dtype, np.number) or np.issubdtype(flat.dtype, np.datetime64) \
+        or np.issubdtype(flat.dtype, np.timedelta64)
+
+    if numeric and flat.size > 0:
+        summary['min'] = _to_python(flat.min())
+        summary['max'] = _to_python(flat.max())
+
+    summary['step'] = None
+    summary['monotonic'] = None
+    if numeric and values.ndim == 1 and flat.size > 1:
+        diffs = np.diff(flat)
+        zero = np.zeros((), dtype=diffs.dtype)
+        if (diffs > zero).all():
+            summary['monotonic'] = 'increasing'
+        elif (diffs < zero).all():
+            summary['monotonic'] = 'decreasing'
+        if summary['monotonic'] and (diffs == diffs[0]).all():
+            summary['step'] = _to_python(diffs[0])
+
+    summary['head'], summary['tail'] = _samples(flat)
+    return summary
+
+
+def narrow_coord_summary(previous : dict, coord : xr.DataArray) -> dict :
+    """Updates the summary of a monotonic coordinate after a selection, reading only its ends."""
+    if not previous.get('monotonic') or coord.ndim != 1 or coord.size == 0:
+        return summarize_coord(coord)
 
-        return json_spec
+    values = coord.values
+    first, last = _to_python(values[0]), _to_python(values[-1])
+    summary = dict(previous)
+    summary['length'] = int(values.size)
+    summary['min'], summary['max'] = (first, last) if previous['monotonic'] == 'increasing' else (last, first)
+    summary['head'], summary['tail'] = _samples(values)
+    if values.size < 2:
+        summary['step'] = None
+    return summary
@@ -0,0 +1,110 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import hashlib
+import json
+import os
+import tempfile
+from typing import Optional
+
+import numpy as np
+import xarray as xr
+
+
+# Version of the sidecar format, older sidecars are rebuilt
+SIDECAR_VERSION = 1
+
+# Directory of the metadata sidecars, an empty value disables them
+METADATA_CACHE_DIR = os.getenv("CLIMAGENT_METADATA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "climagent_metadata"))
+
+
+def _json_default(value):
+    if isinstance(value, np.datetime64):
+        return str(np.datetime_as_string(value, unit="s"))
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return str(value)
+
+
+def to_json(data: dict) -> dict:
+    """JSON round trip of a metadata summary: tuples become lists, numpy values python ones."""
+    return json.loads(json.dumps(data, default=_json_default))
+
+
+def schema_hash(dataset: xr.Dataset) -> str:
+    """Hash of the structure of a dataset (names, dims, sizes, dtypes), read without touching its values.
+
+    It tells apart the same file opened with different options (e.g.
+    decode_times or drop_variables).
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps(sorted((str(d), int(s)) for d, s in dataset.sizes.items())).encode())
+    for name, var in sorted(dataset.variables.items(), key=lambda item: str(item[0])):
+        digest.update(f"{name}:{var.dims}:{var.dtype}:{name in dataset.coords}".encode())
+    return digest.hexdigest()
+
+
+def source_identity(dataset: xr.Dataset, source=None) -> Optional[dict]:
+    """Identity of the files behind a dataset, None when it does not come from a single file or a catalog.
+
+    `source` can be a path or a DatasetCatalog, by default the file recorded
+    by xarray in the dataset encoding.
+    """
+    if source is not None and hasattr(source, "fingerprint"):
+        # The catalog index already holds the size and modification time of every file
+        return {"source": source.index_path, "fingerprint": source.fingerprint()}
+
+    source = source or dataset.encoding.get("source")
+    if not isinstance(source, str) or not os.path.exists(source):
+        return None
+    source = os.path.abspath(source)
+    stat = os.stat(source)
+    return {"source": source, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+class MetadataCache:
+    """Sidecars storing the metadata summary of a dataset, keyed by its source file and structure.
+
+    A sidecar is valid while the source keeps its size and modification time
+    (or catalog fingerprint) and the dataset its schema hash. Sidecars are
+    written to a temporary file and renamed, so concurrent workers never read
+    a partial one.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None):
+        self.cache_dir = METADATA_CACHE_DIR if cache_dir is None else cache_dir
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.cache_dir)
+
+    def _path(self, identity: dict, schema: str) -> str:
+        key = hashlib.sha256(f"{identity['source']}:{schema}".encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def load(self, identity: dict, schema: str) -> Optional[dict]:
+        """Stored summary, or None when missing, unreadable or stale."""
+        try:
+            with open(self._path(identity, schema)) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if stored.get("version") != SIDECAR_VERSION or stored.get("identity") != identity or stored.get("schema") != schema:
+            return None
+        return stored.get("summary")
+
+    def save(self, identity: dict, schema: str, summary: dict):
+        """Atomically replaces the sidecar; failures (e.g. a read-only directory) are ignored."""
+        path = self._path(identity, schema)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=os.path.basename(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump({"version": SIDECAR_VERSION, "identity": identity, "schema": schema, "summary": summary}, f)
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError:
+            pass
@@ -0,0 +1,144 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+from typing import Optional, Tuple
+
+import numpy as np
+import xarray as xr
+
+from climagent.state.spatial_index import grid_weights
+
+
+# Statistics computed from the partial moments of the blocks
+STATISTICS = ("mean", "sum", "min", "max", "std", "var", "count")
+
+# Partial moments of a block: count, sum, weight, weighted sum, weighted M2, min, max
+_PARTIALS = 7
+
+
+def _block_moments(block: np.ndarray, weights: Optional[np.ndarray] = None, axes: Tuple[int, ...] = (),
+                   funcs: Tuple[str, ...] = STATISTICS) -> np.ndarray:
+    """Partial moments of a block over `axes` (kept with size 1), stacked on a new axis 0.
+
+    Sums are pairwise (NumPy), the M2 is computed around the block mean.
+    """
+    x = np.asarray(block, dtype=np.float64)
+    valid = ~np.isnan(x)
+    filled = np.where(valid, x, 0.0)
+
+    n = valid.sum(axis=axes, keepdims=True).astype(np.float64)
+    total = filled.sum(axis=axes, keepdims=True)
+    if weights is None:
+        w = valid.astype(np.float64)
+        weight, weighted_total = n, total
+    else:
+        w = np.where(valid, np.broadcast_to(weights, x.shape), 0.0)
+        weight = w.sum(axis=axes, keepdims=True)
+        weighted_total = (w * filled).sum(axis=axes, keepdims=True)
+
+    shape = n.shape
+    m2 = np.zeros(shape)
+    if "std" in funcs or "var" in funcs:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(weight > 0, weighted_total / weight, 0.0)
+        m2 = (w * (filled - mean) ** 2).sum(axis=axes, keepdims=True)
+
+    minimum = np.where(valid, x, np.inf).min(axis=axes, keepdims=True) if "min" in funcs else np.full(shape, np.inf)
+    maximum = np.where(valid, x, -np.inf).max(axis=axes, keepdims=True) if "max" in funcs else np.full(shape, -np.inf)
+    return np.stack([n, total, weight, weighted_total, m2, minimum, maximum])
+
+
+def _merge(parts, axes: Tuple[int, ...], funcs: Tuple[str, ...]) -> list:
+    """Merges the partial moments of the blocks (Chan's parallel formulas) into the statistics."""
+    n, total, weight, weighted_total = (parts[i].sum(axis=axes) for i in range(4))
+
+    results = []
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = weighted_total / weight
+        if "std" in funcs or "var" in funcs:
+            block_weight = parts[2]
+            block_mean = np.where(block_weight > 0, parts[3] / block_weight, 0.0)
+            expanded = np.expand_dims(mean, axes)
+            m2 = (parts[4] + block_weight * (block_mean - expanded) ** 2).sum(axis=axes)
+            var = np.where(weight > 0, m2 / weight, np.nan)
+
+        for func in funcs:
+            if func == "mean":
+                results.append(mean)
+            elif func == "sum":
+                results.append(total)
+            elif func == "count":
+                results.append(n)
+            elif func == "var":
+                results.append(var)
+            elif func == "std":
+                results.append(np.sqrt(var))
+            elif func == "min":
+                results.append(np.where(n > 0, parts[5].min(axis=axes), np.nan))
+            elif func == "max":
+                results.append(np.where(n > 0, parts[6].max(axis=axes), np.nan))
+    return results
+
+
+def moments(data, axes: Tuple[int, ...], funcs: Tuple[str, ...], weights: Optional[np.ndarray] = None) -> list:
+    """Computes several statistics of `data` over `axes` in a single pass.
+
+    `weights` (broadcastable to `data`) apply to mean, std and var. Dask
+    arrays are reduced block by block: every block produces its partial
+    moments, merged afterwards, so each chunk is read once for all the
+    statistics.
+    """
+    unknown = [f for f in funcs if f not in STATISTICS]
+    if unknown:
+        raise ValueError(f"Unsupported statistics {unknown}. Choose from {list(STATISTICS)}")
+
+    if not hasattr(data, "dask"):
+        return _merge(_block_moments(data, weights, axes, funcs), axes, funcs)
+
+    import dask.array as da
+
+    chunks = ((_PARTIALS,),) + tuple((1,) * len(c) if i in axes else c for i, c in enumerate(data.chunks))
+    if weights is None:
+        parts = da.map_blocks(_block_moments, data, axes=axes, funcs=funcs, new_axis=0, chunks=chunks, dtype=np.float64)
+    else:
+        weights = np.asarray(weights, dtype=np.float64)
+        weights = da.from_array(weights, chunks=tuple(c if s > 1 else (1,) for c, s in zip(data.chunks, weights.shape)))
+        weights = da.broadcast_to(weights, data.shape, chunks=data.chunks)
+        parts = da.map_blocks(_block_moments, data, weights, axes=axes, funcs=funcs, new_axis=0, chunks=chunks, dtype=np.float64)
+    return _merge(parts, axes, funcs)
+
+
+def aggregate(dataset: xr.Dataset, dims: Tuple[str, ...], funcs: Tuple[str, ...], weights: Optional[str] = None) -> xr.Dataset:
+    """Reduces the dataset over `dims` with several statistics, optionally weighted by the grid cells.
+
+    With a single statistic the variables keep their names, otherwise one
+    variable is created for each statistic, named `<variable>_<statistic>`.
+    Variables without any of `dims` are kept as they are.
+    """
+    missing = [d for d in dims if d not in dataset.dims]
+    if missing:
+        raise ValueError(f"Dimensions {missing} not found in the dataset dimensions {list(dataset.dims)}")
+
+    cell_weights = grid_weights(dataset, weights) if weights else None
+
+    data_vars = {}
+    for name, var in dataset.data_vars.items():
+        axes = tuple(var.get_axis_num(d) for d in dims if d in var.dims)
+        if not axes:
+            data_vars[name] = var
+            continue
+
+        var_weights = None
+        if cell_weights is not None:
+            if not set(cell_weights.dims) <= set(var.dims):
+                raise ValueError(f"Variable {name}{var.dims} does not have the grid dimensions {cell_weights.dims}")
+            shape = [var.sizes[d] if d in cell_weights.dims else 1 for d in var.dims]
+            var_weights = cell_weights.transpose(*[d for d in var.dims if d in cell_weights.dims]).values.reshape(shape)
+
+        out_dims = tuple(d for d in var.dims if d not in dims)
+        for func, reduced in zip(funcs, moments(var.data, axes, funcs, var_weights)):
+            key = name if len(funcs) == 1 else f"{name}_{func}"
+            data_vars[key] = xr.Variable(out_dims, reduced, var.attrs)
+
+    coords = {name: coord for name, coord in dataset.coords.items() if not set(coord.dims).intersection(dims)}
+    return xr.Dataset(data_vars, coords=coords, attrs=dataset.attrs)
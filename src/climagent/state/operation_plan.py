@@ -0,0 +1,377 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import numpy as np
+import xarray as xr
+from typing import ClassVar, List, Optional, Tuple, Union
+from pydantic import BaseModel, ConfigDict
+
+from climagent.state.expressions import derive
+from climagent.state.grouped_reduction import climatology, resample
+from climagent.state.moments import aggregate
+from climagent.state.quantiles import quantiles
+from climagent.state.spatial_index import get_spatial_index
+
+
+# Values accepted by SubsetDatasetTool once they have been parsed
+SubsetValue = Union[int, float, str]
+
+
+class Operation(BaseModel):
+    """Base class for a recorded, not yet executed, dataset operation."""
+
+    model_config = ConfigDict(frozen=True)
+
+    # Operations with a lower priority are moved towards the start of the plan
+    # whenever it is safe to do so (variables are dropped first, then subsets).
+    priority: ClassVar[int] = 2
+
+    def apply(self, dataset: xr.Dataset) -> xr.Dataset:
+        raise NotImplementedError
+
+    def describe(self) -> str:
+        raise NotImplementedError
+
+    def touched_dims(self) -> Tuple[str, ...]:
+        """Coordinates the operation reads or reduces."""
+        return ()
+
+    def created_dims(self) -> Tuple[str, ...]:
+        """Coordinates the operation adds to the dataset."""
+        return ()
+
+
+class Subset(Operation):
+    """Nearest/exact selection (one value) or slice (two values) on a coordinate."""
+
+    coordinate_name: str
+    values: Tuple[SubsetValue, ...]
+    priority: ClassVar[int] = 1
+
+    def apply(self, dataset: xr.Dataset) -> xr.Dataset:
+        if len(self.values) == 1:
+            try:
+                return dataset.sel({self.coordinate_name: self.values[0]})
+            except Exception:
+                return dataset.sel({self.coordinate_name: self.values[0]}, method="nearest")
+
+        if len(self.values) == 2:
+            return dataset.sel({self.coordinate_name: slice(self.values[0], self.values[1])})
+
+        raise ValueError("Invalid number of values provided for subsetting. Provide one or two values.")
+
+    def describe(self) -> str:
+        return f"Subset on {self.coordinate_name}({':'.join(str(v) for v in self.values)})"
+
+    def touched_dims(self) -> Tuple[str, ...]:
+        return (self.coordinate_name,)
+
+
+class SelectVariables(Operation):
+    """Keeps only the given data variables."""
+
+    variable_names: Tuple[str, ...]
+    priority: ClassVar[int] = 0
+
+    def apply(self, dataset: xr.Dataset) -> xr.Dataset:
+        return dataset[list(self.variable_names)]
+
+    def describe(self) -> str:
+        return f"Selected variables:{list(self.variable_names)}"
+
+
+class ResampleTime(Operation):
+    """Resampling of a time coordinate with one or more reductions, computed in a single pass."""
+
+    coordinate_name: str
+    frequency: str
+    funcs: Tuple[str, ...] = ("mean",)
+
+    def apply(self, dataset: xr.Dataset) -> xr.Dataset:
+        return resample(dataset, self.coordinate_name, self.frequency, self.funcs)
+
+    def describe(self) -> str:
+        if self.funcs == ("mean",):
+            return f"Group on {self.coordinate_name}({self.frequency})"
+        return f"Group on {self.coordinate_name}({self.frequency}) using {list(self.funcs)}"
+
+    def touched_dims(self) -> Tuple[str, ...]:
+        return (self.coordinate_name,)
+
+
+class Climatology(Operation):
+    """Reduction over the groups (season, month, day of year, hour) of a time coordinate."""
+
+    coordinate_name: str
+    by: str
+    func: str
+
+    def apply(self, dataset: xr.Dataset) -> xr.Dataset:
+        return climatology(dataset, self.coordinate_name, self.by, self.func)
+
+    def describe(self) -> str:
+        return f"Climatology on {self.coordinate_name} by {self.by} using {self.func}"
+
+    def touched_dims(self) -> Tuple[str, ...]:
+        return (self.coordinate_name,)
+
+    def created_dims(self) -> Tuple[str, ...]:
+        return (self.by,)
+
+
+class Aggregate(Operation):
+    """Reduction of the dataset along one or more dimensions."""
+
+    func: str
+    dims: Tuple[str, ...]
+
+    def apply(self, dataset: xr.Dataset) -> xr.Dataset:
+        return getattr(dataset, self.func)(dim=list(self.dims))
+
+    def describe(self) -> str:
+        return f"Aggregated on {list(self.dims)} using {self.func}"
+
+    def touched_dims(self) -> Tuple[str, ...]:
+        return self.dims
+
+
+class ExtractPoints(Operation):
+    """Nearest grid cell of many (lat, lon) points, gathered at once along a new `station` dimension."""
+
+    lats: Tuple[float, ...]
+    lons: Tuple[float, ...]
+    names: Optional[Tuple[str, ...]] = None
+    dims: Tuple[str, ...]
+
+    def apply(self, dataset: xr.Dataset) -> xr.Dataset:
+        index = get_spatial_index(dataset)
+        indices, distance = index.nearest(self.lats, self.lons)
+        indexers = {dim: xr.DataArray(idx, dims="station") for dim, idx in zip(index.dims, indices)}
+        result = dataset.isel(indexers)
+        return result.assign_coords(
+            station=list(self.names) if self.names else np.arange(len(self.lats)),
+            station_lat=("station", np.asarray(self.lats)),
+            station_lon=("station", np.asarray(self.lons)),
+            distance_km=("station", distance),
+        )
+
+    def describe(self) -> str:
+        return f"Extracted {len(self.lats)} points on {list(self.dims)} (nearest grid cells)"
+
+    def touched_dims(self) -> Tuple[str, ...]:
+        return self.dims
+
+    def created_dims(self) -> Tuple[str, ...]:
+        return ("station", "station_lat", "station_lon", "distance_km")
+
+
+class SpatialMask(Operation):
+    """Cells inside a lat/lon box and/or a polygon of (lat, lon) vertices, cropped to the region."""
+
+    dims: Tuple[str, ...]
+    bbox: Optional[Tuple[float, float, float, float]] = None
+    polygon: Optional[Tuple[Tuple[float, float], ...]] = None
+
+    def apply(self, dataset: xr.Dataset) -> xr.Dataset:
+        index = get_spatial_index(dataset)
+        mask = np.ones(index.shape, dtype=bool)
+        if self.bbox is not None:
+            mask &= index.bbox_mask(*self.bbox)
+        if self.polygon is not None:
+            mask &= index.polygon_mask(self.polygon)
+        if not mask.any():
+            raise ValueError("No grid cell inside the region.")
+
+        # Crop to the rows and columns of the region, cells outside it are masked only if needed
+        crop = {dim: slice(int(idx.min()), int(idx.max()) + 1) for dim, idx in zip(index.dims, np.nonzero(mask))}
+        mask = mask[tuple(crop.values())]
+        result = dataset.isel(crop)
+        if not mask.all():
+            result = result.where(xr.DataArray(mask, dims=index.dims))
+        return result
+
+    def describe(self) -> str:
+        region = []
+        if self.bbox is not None:
+            region.append(f"box lat({self.bbox[0]}:{self.bbox[1]}) lon({self.bbox[2]}:{self.bbox[3]})")
+        if self.polygon is not None:
+            region.append(f"polygon of {len(self.polygon)} vertices")
+        return f"Spatial subset on {' and '.join(region)}"
+
+    def touched_dims(self) -> Tuple[str, ...]:
+        return self.dims
+
+
+class Statistics(Operation):
+    """Several statistics over one or more dimensions, computed in a single pass, optionally area weighted."""
+
+    funcs: Tuple[str, ...]
+    dims: Tuple[str, ...]
+    weights: Optional[str] = None
+
+    def apply(self, dataset: xr.Dataset) -> xr.Dataset:
+        return aggregate(dataset, self.dims, self.funcs, self.weights)
+
+    def describe(self) -> str:
+        weighting = f" weighted by {self.weights}" if self.weights else ""
+        return f"Aggregated on {list(self.dims)} using {list(self.funcs)}{weighting}"
+
+    def touched_dims(self) -> Tuple[str, ...]:
+        return self.dims
+
+
+class Quantiles(Operation):
+    """Quantiles over one or more dimensions: exact when the data fits the memory budget, sketched otherwise."""
+
+    q: Tuple[float, ...]
+    dims: Tuple[str, ...]
+    method: str = "auto"
+    # A single quantile without the `quantile` dimension, as the median
+    squeeze: bool = False
+
+    def apply(self, dataset: xr.Dataset) -> xr.Dataset:
+        return quantiles(dataset, self.dims, self.q, self.method, self.squeeze)
+
+    def describe(self) -> str:
+        if self.squeeze and self.q == (0.5,):
+            return f"Aggregated on {list(self.dims)} using median"
+        return f"Aggregated on {list(self.dims)} using quantiles {list(self.q)}"
+
+    def touched_dims(self) -> Tuple[str, ...]:
+        return self.dims
+
+    def created_dims(self) -> Tuple[str, ...]:
+        return () if self.squeeze else ("quantile",)
+
+
+class Derive(Operation):
+    """New variable computed element-wise from an arithmetic expression over the data variables."""
+
+    name: str
+    expression: str
+    units: Optional[str] = None
+    long_name: Optional[str] = None
+
+    def apply(self, dataset: xr.Dataset) -> xr.Dataset:
+        return derive(dataset, self.name, self.expression, self.units, self.long_name)
+
+    def describe(self) -> str:
+        return f"Derived variable {self.name} = {self.expression}"
+
+
+class OperationPlan:
+    """Ordered list of operations recorded on a dataset.
+
+    The plan is executed only when real values are needed. Before execution
+    it is rewritten by `optimize` so that variables are dropped and subsets
+    applied as early as possible, and adjacent subsets are fused.
+    """
+
+    def __init__(self, operations: Optional[List[Operation]] = None):
+        self.operations = list(operations or [])
+
+    def __len__(self):
+        return len(self.operations)
+
+    def __iter__(self):
+        return iter(self.operations)
+
+    def append(self, operation: Operation):
+        self.operations.append(operation)
+
+    def describe(self) -> str:
+        return " -> ".join(op.describe() for op in self.operations)
+
+    def split_selections(self) -> Tuple[List[Operation], List[Operation]]:
+        """Leading selections of the plan (variables and subsets), which determine the data read, and the other operations."""
+        leading = 0
+        while leading < len(self.operations) and self.operations[leading].priority < Operation.priority:
+            leading += 1
+        return self.operations[:leading], self.operations[leading:]
+
+    def optimize(self, dataset: xr.Dataset) -> "OperationPlan":
+        """Returns an equivalent plan with selections pushed ahead of reductions."""
+        operations = list(self.operations)
+
+        # Bubble operations with a lower priority towards the start of the plan
+        changed = True
+        while changed:
+            changed = False
+            for i in range(1, len(operations)):
+                earlier, later = operations[i - 1], operations[i]
+                if later.priority < earlier.priority and _commutes(earlier, later, dataset):
+                    operations[i - 1], operations[i] = later, earlier
+                    changed = True
+
+        return OperationPlan(_fuse(operations))
+
+    def execute(self, dataset: xr.Dataset) -> xr.Dataset:
+        """Applies the plan as is, without optimizing or computing it."""
+        for operation in self.operations:
+            dataset = operation.apply(dataset)
+        return dataset
+
+
+def _commutes(earlier: Operation, later: Operation, dataset: xr.Dataset) -> bool:
+    """Whether `later` can be executed before `earlier` with the same result."""
+
+    if isinstance(later, SelectVariables):
+        if isinstance(earlier, (SelectVariables, Derive)):
+            # A derived variable needs its operands, which the selection may drop
+            return False
+        # Every coordinate used by the earlier operation must survive the selection
+        try:
+            selected = dataset[list(later.variable_names)]
+        except KeyError:
+            return False
+        return all(dim in selected.dims or dim in selected.coords for dim in earlier.touched_dims())
+
+    if isinstance(later, Subset):
+        if isinstance(earlier, Subset):
+            return False
+        # The coordinate must exist before the earlier operation and be left unchanged by it
+        return later.coordinate_name not in earlier.touched_dims() + earlier.created_dims()
+
+    return False
+
+
+def _fuse(operations: List[Operation]) -> List[Operation]:
+    """Merges adjacent operations that can be expressed as a single one."""
+    fused = []
+    for operation in operations:
+        previous = fused[-1] if fused else None
+
+        if isinstance(previous, SelectVariables) and isinstance(operation, SelectVariables):
+            # The later selection is always a subset of the earlier one
+            fused[-1] = operation
+            continue
+
+        if isinstance(previous, Subset) and isinstance(operation, Subset):
+            merged = _intersect_slices(previous, operation)
+            if merged is not None:
+                fused[-1] = merged
+                continue
+
+        fused.append(operation)
+    return fused
+
+
+def _intersect_slices(first: Subset, second: Subset) -> Optional[Subset]:
+    """Intersects two numeric slices on the same coordinate, if possible."""
+    if first.coordinate_name != second.coordinate_name:
+        return None
+    if len(first.values) != 2 or len(second.values) != 2:
+        return None
+    if not all(isinstance(v, (int, float)) for v in first.values + second.values):
+        return None
+
+    ascending = first.values[0] <= first.values[1]
+    if ascending != (second.values[0] <= second.values[1]):
+        return None
+
+    if ascending:
+        start, stop = max(first.values[0], second.values[0]), min(first.values[1], second.values[1])
+    else:
+        start, stop = min(first.values[0], second.values[0]), max(first.values[1], second.values[1])
+
+    return Subset(coordinate_name=first.coordinate_name, values=(start, stop))
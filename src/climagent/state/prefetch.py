@@ -0,0 +1,151 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+import numpy as np
+import xarray as xr
+
+from climagent.state.operation_plan import Operation, SelectVariables, Subset
+
+
+# Memory (bytes) of the prefetched blocks, the least recently used ones are evicted above it
+PREFETCH_BYTES = int(os.getenv("CLIMAGENT_PREFETCH_BYTES", 1024 ** 3))
+
+# Threads loading blocks in the background
+PREFETCH_WORKERS = int(os.getenv("CLIMAGENT_PREFETCH_WORKERS", 2))
+
+
+def covers(block: xr.Dataset, selected: xr.Dataset) -> bool:
+    """Whether `block` holds every variable and coordinate label of the lazy selection `selected`.
+
+    Selecting again on such a block gives the same result as on the full
+    dataset, also for nearest selections: the nearest label is in the block.
+    """
+    if any(name not in block.data_vars for name in selected.data_vars):
+        return False
+    for dim, size in selected.sizes.items():
+        if dim not in block.dims:
+            return False
+        if dim in selected.indexes:
+            if not np.isin(selected.indexes[dim].values, block.indexes[dim].values).all():
+                return False
+        elif size != block.sizes[dim]:
+            return False
+    for name, coord in selected.coords.items():
+        # Dimensions dropped by a nearest selection keep the selected label as a scalar coordinate
+        if coord.ndim == 0 and name in block.indexes and not np.isin(coord.values, block.indexes[name].values).all():
+            return False
+    return True
+
+
+def plan_hints(text: str, dataset: xr.Dataset) -> List[Operation]:
+    """Selections named in a free text plan: the variables it mentions and the years it spans on the time coordinate."""
+    words = set(re.findall(r"[A-Za-z_][A-Za-z0-9_]*", text))
+    variables = [str(name) for name in dataset.data_vars if str(name) in words]
+    hints = [SelectVariables(variable_names=tuple(variables))] if variables else []
+
+    times = [name for name in dataset.dims if name in dataset.coords and dataset[name].dtype.kind == "M"]
+    years = [int(y) for y in re.findall(r"\b(1[89]\d\d|2[01]\d\d)\b", text)]
+    if times and years:
+        hints.append(Subset(coordinate_name=str(times[0]), values=(f"{min(years)}-01-01", f"{max(years)}-12-31T23:59:59")))
+    return hints
+
+
+class Prefetcher:
+    """Background loading of the dataset blocks that a plan is likely to read.
+
+    A block is the result of the leading selections (variables and subsets)
+    of a plan, persisted in memory as dask chunks by a small thread pool
+    while the LLM is generating. Blocks are kept in an LRU cache limited to `capacity` bytes
+    and shared by every session on the same dataset; a later execution whose
+    selection is covered by a block reads it instead of the storage.
+    """
+
+    def __init__(self, capacity: int = PREFETCH_BYTES, workers: int = PREFETCH_WORKERS):
+        self.capacity = capacity
+        self._blocks = OrderedDict()    # key -> (source, dataset, nbytes)
+        self._pending = {}              # key -> future
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="climagent-prefetch")
+        self._lock = threading.Lock()
+        self.counters = {"requests": 0, "loaded": 0, "skipped": 0, "hits": 0, "misses": 0, "evictions": 0}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.counters, blocks=len(self._blocks), pending=len(self._pending),
+                        nbytes=sum(n for _, _, n in self._blocks.values()))
+
+    def prefetch(self, source: str, key: str, select: Callable[[], xr.Dataset]):
+        """Loads the lazy selection returned by `select` in the background, unless it is already loaded or loading.
+
+        `source` identifies the dataset and `key` the selection. `select` runs
+        in the prefetch thread, so that opening files does not delay the
+        caller. Selections not backed by dask (already in memory) or larger
+        than half of the capacity are skipped. Returns the future of the load.
+        """
+        with self._lock:
+            self.counters["requests"] += 1
+            if key in self._blocks:
+                return None
+            if key not in self._pending:
+                self._pending[key] = self._executor.submit(self._load, source, key, select)
+            return self._pending[key]
+
+    def _load(self, source, key, select):
+        try:
+            selected = select()
+            if not selected.chunks or not 0 < selected.nbytes <= self.capacity // 2 or self._find(source, selected) is not None:
+                with self._lock:
+                    self.counters["skipped"] += 1
+                return None
+            # Persisted chunks stay lazy, so plans on the block are still streamed and guarded
+            block = selected.persist()
+            with self._lock:
+                self._blocks[key] = (source, block, block.nbytes)
+                self.counters["loaded"] += 1
+                self._evict()
+            return block
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def _find(self, source, selected):
+        with self._lock:
+            for key, (block_source, block, _) in reversed(self._blocks.items()):
+                if block_source == source and covers(block, selected):
+                    self._blocks.move_to_end(key)
+                    return block
+        return None
+
+    def lookup(self, source: str, selected: xr.Dataset, key: Optional[str] = None) -> Optional[xr.Dataset]:
+        """Loaded block covering the lazy selection `selected`, or None.
+
+        When the block of the same selection (`key`) is still loading, it is
+        waited for, as it already reads the same data.
+        """
+        block = self._find(source, selected)
+        if block is None and key is not None:
+            with self._lock:
+                future = self._pending.get(key)
+            if future is not None:
+                try:
+                    block = future.result()
+                except Exception:
+                    block = None
+        with self._lock:
+            self.counters["hits" if block is not None else "misses"] += 1
+        return block
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+
+    def _evict(self):
+        while self._blocks and sum(n for _, _, n in self._blocks.values()) > self.capacity:
+            self._blocks.popitem(last=False)
+            self.counters["evictions"] += 1
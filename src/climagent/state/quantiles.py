@@ -0,0 +1,234 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import math
+import os
+from functools import partial
+from typing import Optional, Tuple
+
+import numpy as np
+import xarray as xr
+
+
+# Variables up to this size are reduced with exact quantiles, larger ones with sketches
+QUANTILE_EXACT_BYTES = int(os.getenv("CLIMAGENT_QUANTILE_EXACT_BYTES", 512 * 1024 ** 2))
+
+# Number of centroids of a sketch: more centroids, smaller rank error
+SKETCH_SIZE = 256
+
+# Number of sketches merged at once when combining the blocks of a dask array
+SPLIT_EVERY = 8
+
+
+def _boundaries(k: int) -> np.ndarray:
+    """Quantile boundaries of the centroids (t-digest k1 scale): narrow centroids at the tails."""
+    return (1 - np.cos(np.pi * np.arange(k + 1) / k)) / 2
+
+
+def _interp_columns(t: np.ndarray, xp: np.ndarray, fp: np.ndarray) -> np.ndarray:
+    """np.interp applied column by column: `xp` (increasing along axis 0) and `t` in [0, 1]."""
+    m, columns = xp.shape
+    offset = 2.0 * np.arange(columns)
+    flat_xp = (xp + offset).T.ravel()
+    flat_fp = fp.T.ravel()
+    flat_t = (t + offset).T.ravel()
+
+    base = np.repeat(np.arange(columns) * m, t.shape[0])
+    hi = np.clip(np.searchsorted(flat_xp, flat_t), base + 1, base + m - 1)
+    lo = hi - 1
+    with np.errstate(invalid="ignore", divide="ignore"):
+        frac = np.clip((flat_t - flat_xp[lo]) / (flat_xp[hi] - flat_xp[lo]), 0, 1)
+    frac = np.nan_to_num(frac)
+    return (flat_fp[lo] + frac * (flat_fp[hi] - flat_fp[lo])).reshape(columns, -1).T
+
+
+def _anchors(values: np.ndarray, weights: np.ndarray, minimum: np.ndarray, maximum: np.ndarray):
+    """Normalized mid ranks of the centroids, with the minimum at rank 0 and the maximum at rank 1.
+
+    Centroids are sorted with the empty ones last: these are moved onto the
+    maximum, so the ranks stay sorted and are never interpolated.
+    """
+    total = weights.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mids = (np.cumsum(weights, axis=0) - weights / 2) / total
+    empty = weights == 0
+    xp = np.concatenate([np.zeros((1, values.shape[1])), np.where(empty, 1.0, mids), np.ones((1, values.shape[1]))])
+    fp = np.concatenate([minimum[None], np.where(empty, maximum, values), maximum[None]])
+    return xp, fp, total
+
+
+def _compress(values: np.ndarray, weights: np.ndarray, minimum, maximum, k: int):
+    """Reduces sorted weighted values (axis 0) to `k` centroids, or keeps them when they fit."""
+    if values.shape[0] <= k:
+        pad = k - values.shape[0]
+        return (np.concatenate([values, np.zeros((pad, values.shape[1]))]),
+                np.concatenate([weights, np.zeros((pad, values.shape[1]))]))
+    # Columns with few unit weights are kept as they are (empty centroids are last), without any error
+    exact = (weights.sum(axis=0) <= k) & (weights.max(axis=0, initial=0) <= 1)
+
+    q = _boundaries(k)
+    xp, fp, total = _anchors(values, weights, minimum, maximum)
+    targets = np.repeat(((q[:-1] + q[1:]) / 2)[:, None], values.shape[1], axis=1)
+    new_values = _interp_columns(targets, xp, fp)
+    new_weights = np.diff(q)[:, None] * total[None]
+    new_values[:, exact] = values[:k, exact]
+    new_weights[:, exact] = weights[:k, exact]
+    return new_values, new_weights
+
+
+def _sketch_block(block: np.ndarray, axes: Tuple[int, ...] = (), k: int = SKETCH_SIZE) -> np.ndarray:
+    """Sketch of a block over `axes` (kept with size 1): k values, k weights, minimum and maximum on axis 0."""
+    x = np.asarray(block, dtype=np.float64)
+    kept = [a for a in range(x.ndim) if a not in axes]
+    out_shape = tuple(1 if a in axes else x.shape[a] for a in range(x.ndim))
+    x = np.transpose(x, list(axes) + kept).reshape(-1, int(np.prod([x.shape[a] for a in kept], dtype=int)))
+
+    # NaNs are sorted last and get no weight
+    count = (~np.isnan(x)).sum(axis=0)
+    values = np.sort(x, axis=0)
+    weights = (np.arange(x.shape[0])[:, None] < count).astype(np.float64)
+    values = np.where(weights > 0, values, 0.0)
+    minimum = np.where(count > 0, values[0], np.nan)
+    maximum = np.where(count > 0, np.take_along_axis(values, np.maximum(count - 1, 0)[None], axis=0)[0], np.nan)
+
+    values, weights = _compress(values, weights, minimum, maximum, k)
+    sketch = np.concatenate([values, weights, minimum[None], maximum[None]])
+    return sketch.reshape((2 * k + 2,) + out_shape)
+
+
+def _merge_sketches(sketches: np.ndarray, axis=None, keepdims=True, k: int = SKETCH_SIZE) -> np.ndarray:
+    """Merges the sketches found along `axis` (axis 0 holds the sketch rows) into one."""
+    axes = axis if isinstance(axis, tuple) else (axis,)
+    x = np.asarray(sketches, dtype=np.float64)
+    kept = [a for a in range(1, x.ndim) if a not in axes]
+    out_shape = tuple(1 if a in axes else x.shape[a] for a in range(1, x.ndim))
+    columns = int(np.prod([x.shape[a] for a in kept], dtype=int))
+    # (sketch, rows, columns)
+    x = np.transpose(x, list(axes) + [0] + kept).reshape(-1, 2 * k + 2, columns)
+
+    values = x[:, :k].reshape(-1, columns)
+    weights = x[:, k:2 * k].reshape(-1, columns)
+    with np.errstate(invalid="ignore"):
+        minimum = np.nanmin(np.where(np.isnan(x[:, 2 * k]), np.inf, x[:, 2 * k]), axis=0)
+        maximum = np.nanmax(np.where(np.isnan(x[:, 2 * k + 1]), -np.inf, x[:, 2 * k + 1]), axis=0)
+    minimum = np.where(np.isinf(minimum), np.nan, minimum)
+    maximum = np.where(np.isinf(maximum), np.nan, maximum)
+
+    # Sort the centroids of all the sketches, empty ones last
+    order = np.lexsort((values, weights == 0), axis=0)
+    values = np.take_along_axis(values, order, axis=0)
+    weights = np.take_along_axis(weights, order, axis=0)
+
+    values, weights = _compress(values, weights, minimum, maximum, k)
+    merged = np.concatenate([values, weights, minimum[None], maximum[None]])
+    return merged.reshape((2 * k + 2,) + out_shape)
+
+
+def _keep(sketches: np.ndarray, axis=None, keepdims=True) -> np.ndarray:
+    return sketches
+
+
+def _sketch_quantiles(sketch: np.ndarray, q: Tuple[float, ...], axes: Tuple[int, ...], k: int = SKETCH_SIZE) -> np.ndarray:
+    """Quantiles (new axis 0) of merged sketches, interpolated between the centroids, the minimum and the maximum."""
+    x = np.asarray(sketch, dtype=np.float64)
+    out_shape = tuple(s for a, s in enumerate(x.shape[1:]) if a not in axes)
+    x = x.reshape(2 * k + 2, -1)
+    values, weights = x[:k], x[k:2 * k]
+    xp, fp, total = _anchors(values, weights, x[2 * k], x[2 * k + 1])
+    targets = np.repeat(np.asarray(q, dtype=float)[:, None], x.shape[1], axis=1)
+    result = _interp_columns(targets, xp, fp)
+
+    # Columns still holding all their values get the exact quantiles (linear, as NumPy)
+    exact = (total > 1) & (weights.max(axis=0, initial=0) <= 1)
+    if exact.any():
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ranks = np.where(weights > 0, np.arange(k)[:, None] / (total - 1), 2 - 1 / (np.arange(k)[:, None] + 2))
+        result[:, exact] = _interp_columns(targets[:, exact], ranks[:, exact], values[:, exact])
+    result = np.where(total > 0, result, np.nan)
+    return result.reshape((len(q),) + out_shape)
+
+
+def rank_error_bound(q: float, levels: int, n: int, k: int = SKETCH_SIZE) -> float:
+    """Bound of the rank error (fraction of the `n` reduced values) of a quantile after `levels` compressions.
+
+    Within a centroid the rank of a value is only known up to the centroid
+    width, which is pi / k * sqrt(q (1 - q)) with the k1 scale: every
+    compression can add this error, plus one value for the interpolation.
+    """
+    if levels == 0:
+        return 0.0
+    return levels * math.pi / k * math.sqrt(q * (1 - q)) + 1 / max(n, 1)
+
+
+def sketch_quantiles(data, axes: Tuple[int, ...], q: Tuple[float, ...], k: int = SKETCH_SIZE):
+    """Approximate quantiles of `data` over `axes` (new axis 0) and the number of compressions applied.
+
+    Every block is summarized by a sketch of `k` centroids, sketches are
+    merged `SPLIT_EVERY` at a time, so memory is bounded by the sketches
+    and never holds the whole reduced axis.
+    """
+    if not hasattr(data, "dask"):
+        sketch = _sketch_block(data, axes, k)
+        n = int(np.prod([data.shape[a] for a in axes]))
+        return _sketch_quantiles(sketch, q, axes, k), int(n > k)
+
+    import dask.array as da
+
+    chunks = ((2 * k + 2,),) + tuple((1,) * len(c) if i in axes else c for i, c in enumerate(data.chunks))
+    sketches = da.map_blocks(_sketch_block, data, axes=axes, k=k, new_axis=0, chunks=chunks, dtype=np.float64)
+    sketch_axes = tuple(a + 1 for a in axes)
+    merge = partial(_merge_sketches, k=k)
+    merged = da.reduction(sketches, chunk=_keep, combine=merge, aggregate=merge, axis=sketch_axes, keepdims=True,
+                          split_every=SPLIT_EVERY, dtype=np.float64, concatenate=True)
+    result = merged.map_blocks(
+        _sketch_quantiles, q, axes, k, drop_axis=sketch_axes,
+        chunks=((len(q),),) + tuple(c for i, c in enumerate(data.chunks) if i not in axes), dtype=np.float64)
+
+    blocks = int(np.prod([len(data.chunks[a]) for a in axes]))
+    levels = 1 + (math.ceil(math.log(blocks, SPLIT_EVERY)) if blocks > 1 else 0)
+    return result, levels
+
+
+def quantiles(dataset: xr.Dataset, dims: Tuple[str, ...], q: Tuple[float, ...], method: str = "auto",
+              squeeze: bool = False, exact_bytes: Optional[int] = None) -> xr.Dataset:
+    """Quantiles of every variable over `dims`, along a new `quantile` dimension (dropped if `squeeze`).
+
+    With method 'auto' variables smaller than `exact_bytes` get exact
+    quantiles, larger ones sketched quantiles. Variables in memory, or in a
+    single block along `dims`, always get exact quantiles. The method and the rank
+    error bound of each quantile are stored in the variable attributes.
+    """
+    exact_bytes = QUANTILE_EXACT_BYTES if exact_bytes is None else exact_bytes
+    missing = [d for d in dims if d not in dataset.dims]
+    if missing:
+        raise ValueError(f"Dimensions {missing} not found in the dataset dimensions {list(dataset.dims)}")
+
+    data_vars = {}
+    for name, var in dataset.data_vars.items():
+        axes = tuple(var.get_axis_num(d) for d in dims if d in var.dims)
+        if not axes:
+            data_vars[name] = var
+            continue
+
+        reduced_dims = [d for d in dims if d in var.dims]
+        out_dims = ("quantile",) + tuple(d for d in var.dims if d not in dims)
+        # Sketches only save memory when the reduced axes span several blocks, otherwise exact quantiles cost the same
+        single_block = not var.chunks or all(len(var.chunks[a]) == 1 for a in axes)
+        exact = method == "exact" or single_block or (method == "auto" and var.nbytes <= exact_bytes)
+
+        if exact:
+            if var.chunks:
+                var = var.chunk({d: -1 for d in reduced_dims})
+            result = var.quantile(list(q), dim=reduced_dims).transpose(*out_dims).data
+            attrs = dict(var.attrs, quantile_method="exact", quantile_rank_error=[0.0] * len(q))
+        else:
+            result, levels = sketch_quantiles(var.data, axes, q)
+            n = int(np.prod([var.shape[a] for a in axes]))
+            attrs = dict(var.attrs, quantile_method="sketch",
+                         quantile_rank_error=[rank_error_bound(p, levels, n) for p in q])
+
+        data_vars[name] = xr.Variable(out_dims, result, attrs)
+
+    coords = {name: coord for name, coord in dataset.coords.items() if not set(coord.dims).intersection(dims)}
+    result = xr.Dataset(data_vars, coords=coords, attrs=dataset.attrs).assign_coords(quantile=list(q))
+    return result.isel(quantile=0) if squeeze else result
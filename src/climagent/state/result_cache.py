@@ -0,0 +1,220 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+import xarray as xr
+
+from climagent.state.operation_plan import Operation, OperationPlan
+
+
+def dataset_fingerprint(dataset: xr.Dataset) -> str:
+    """Content address of a dataset.
+
+    Datasets opened from a file are identified by path, size and modification
+    time, dask-backed datasets by their graph token, in-memory datasets by
+    hashing their values.
+    """
+    digest = hashlib.sha256()
+    digest.update(repr(dataset.sizes).encode())
+    digest.update(repr(sorted((name, str(var.dtype), var.dims) for name, var in dataset.variables.items())).encode())
+
+    source = dataset.encoding.get("source")
+    if source and os.path.exists(source):
+        stat = os.stat(source)
+        digest.update(f"{os.path.abspath(source)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return digest.hexdigest()
+
+    if dataset.chunks:
+        from dask.base import tokenize
+        digest.update(tokenize(dataset).encode())
+        return digest.hexdigest()
+
+    for name in sorted(dataset.variables, key=str):
+        digest.update(np.ascontiguousarray(dataset.variables[name].values).tobytes())
+    return digest.hexdigest()
+
+
+def chain_key(fingerprint: str, operations: List[Operation]) -> str:
+    """Key of the result of `operations` applied to the dataset with `fingerprint`."""
+    chain = [[type(op).__name__, op.model_dump(mode="json")] for op in operations]
+    payload = json.dumps([fingerprint, chain], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResultCache:
+    """Two tier cache of operation chain results.
+
+    Results are kept in memory up to `memory_bytes`, least recently used
+    entries are spilled to a local Zarr store limited to `disk_bytes`. The
+    disk tier is disabled if zarr is not installed.
+    """
+
+    def __init__(self, memory_bytes: int = 512 * 1024 ** 2, disk_bytes: int = 8 * 1024 ** 3,
+                 cache_dir: Optional[str] = None):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), "climagent_cache")
+
+        self._memory = OrderedDict()   # key -> (dataset, nbytes)
+        self._disk = OrderedDict()     # key -> nbytes
+        self._lock = threading.RLock()
+        self.counters = {"hits": 0, "prefix_hits": 0, "misses": 0,
+                         "memory_evictions": 0, "disk_evictions": 0}
+
+        try:
+            import zarr  # noqa: F401
+            self.disk_enabled = disk_bytes > 0
+        except ImportError:
+            self.disk_enabled = False
+
+        if self.disk_enabled:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._load_disk_index()
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size of both tiers."""
+        with self._lock:
+            return dict(self.counters,
+                        memory_entries=len(self._memory),
+                        memory_bytes=sum(n for _, n in self._memory.values()),
+                        disk_entries=len(self._disk),
+                        disk_bytes=sum(self._disk.values()))
+
+    def get(self, key: str) -> Optional[xr.Dataset]:
+        """Returns a cached result, from memory or from disk, or None."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key][0]
+            if key in self._disk:
+                self._disk.move_to_end(key)
+                return xr.open_zarr(self._path(key))
+        return None
+
+    def put(self, key: str, dataset: xr.Dataset, lazy: bool = False) -> xr.Dataset:
+        """Stores a result and returns it as it is kept by the cache.
+
+        Results are computed (persisted as dask chunks with `lazy`, so that
+        the following operations are still streamed) and kept in memory.
+        Results larger than the memory tier are written chunk by chunk to the
+        disk tier, except with `lazy`: their consumer may stop reading early,
+        so they are returned unstored. Values are computed and written
+        outside the lock, so that sessions sharing the cache are not
+        serialized.
+        """
+        nbytes = dataset.nbytes
+        if nbytes > self.memory_bytes:
+            if lazy or not self.disk_enabled:
+                return dataset
+            self._write_disk(key, dataset)
+            return xr.open_zarr(self._path(key))
+
+        if dataset.chunks:
+            dataset = dataset.persist() if lazy else dataset.compute()
+        with self._lock:
+            self._memory[key] = (dataset, nbytes)
+            self._memory.move_to_end(key)
+            evicted = self._evict_memory()
+        for evicted_key, evicted_dataset in evicted:
+            self._write_disk(evicted_key, evicted_dataset)
+        return dataset
+
+    def execute(self, fingerprint: str, operations: List[Operation], dataset: xr.Dataset, lazy: bool = False) -> xr.Dataset:
+        """Applies `operations` to `dataset`, resuming from the longest cached prefix.
+
+        The results after the leading selections and after every following
+        operation (reductions, groupings, ...) are stored, so that chains
+        sharing a prefix reuse it. Intermediate results are persisted, the
+        last one is computed unless `lazy`.
+        """
+        operations = list(operations)
+        keys = [chain_key(fingerprint, operations[:i + 1]) for i in range(len(operations))]
+        selections, _ = OperationPlan(operations).split_selections()
+        stored = {i for i in range(len(selections), len(operations) + 1) if i > 0}
+
+        start, current = 0, dataset
+        for i in range(len(operations), 0, -1):
+            cached = self.get(keys[i - 1])
+            if cached is not None:
+                start, current = i, cached
+                break
+
+        with self._lock:
+            if not operations:
+                pass
+            elif start == len(operations):
+                self.counters["hits"] += 1
+            elif start > 0:
+                self.counters["prefix_hits"] += 1
+            else:
+                self.counters["misses"] += 1
+
+        for i in range(start, len(operations)):
+            current = operations[i].apply(current)
+            if i + 1 in stored:
+                current = self.put(keys[i], current, lazy=lazy or i + 1 < len(operations))
+        return current
+
+    def clear(self):
+        """Removes every entry from both tiers."""
+        with self._lock:
+            self._memory.clear()
+            for key in list(self._disk):
+                shutil.rmtree(self._path(key), ignore_errors=True)
+            self._disk.clear()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.zarr")
+
+    def _evict_memory(self):
+        """Drops the least recently used entries above the memory tier, returns those to spill to disk."""
+        evicted = []
+        while self._memory and sum(n for _, n in self._memory.values()) > self.memory_bytes:
+            key, (dataset, _) = self._memory.popitem(last=False)
+            self.counters["memory_evictions"] += 1
+            if self.disk_enabled and key not in self._disk:
+                evicted.append((key, dataset))
+        return evicted
+
+    def _write_disk(self, key: str, dataset: xr.Dataset):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        dataset.drop_encoding().to_zarr(tmp_path, mode="w")
+        with self._lock:
+            shutil.rmtree(path, ignore_errors=True)
+            os.replace(tmp_path, path)
+            self._disk[key] = dataset.nbytes
+            self._disk.move_to_end(key)
+            self._evict_disk()
+
+    def _evict_disk(self):
+        while len(self._disk) > 1 and sum(self._disk.values()) > self.disk_bytes:
+            key, _ = self._disk.popitem(last=False)
+            shutil.rmtree(self._path(key), ignore_errors=True)
+            self.counters["disk_evictions"] += 1
+
+    def _load_disk_index(self):
+        """Registers entries written by previous sessions, oldest first."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".zarr"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                nbytes = xr.open_zarr(path).nbytes
+            except Exception:
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            entries.append((os.path.getmtime(path), name[:-len(".zarr")], nbytes))
+        for _, key, nbytes in sorted(entries):
+            self._disk[key] = nbytes
+        self._evict_disk()
@@ -0,0 +1,189 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Sequence, Tuple
+
+import numpy as np
+import xarray as xr
+
+
+# Names and units used to recognize latitude and longitude coordinates
+LAT_NAMES = ("lat", "latitude", "nav_lat", "y_lat")
+LON_NAMES = ("lon", "longitude", "nav_lon", "x_lon")
+LAT_UNITS = ("degrees_north", "degree_north", "degrees_N")
+LON_UNITS = ("degrees_east", "degree_east", "degrees_E")
+
+EARTH_RADIUS_KM = 6371.0
+
+# Number of grids whose KD-tree is kept in memory
+SPATIAL_INDEXES = 16
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+# Weights of the grid cells, by grid and kind
+WEIGHTS = ("coslat", "area")
+
+_weights = OrderedDict()
+_weights_lock = threading.Lock()
+
+
+def _find_coord(dataset: xr.Dataset, names, units, standard_name):
+    for name, coord in dataset.coords.items():
+        if str(name).lower() in names or coord.attrs.get("standard_name") == standard_name \
+                or coord.attrs.get("units") in units:
+            return name
+    return None
+
+
+def find_latlon(dataset: xr.Dataset) -> Tuple[str, str]:
+    """Names of the latitude and longitude coordinates, from their name, standard_name or units."""
+    lat = _find_coord(dataset, LAT_NAMES, LAT_UNITS, "latitude")
+    lon = _find_coord(dataset, LON_NAMES, LON_UNITS, "longitude")
+    if lat is None or lon is None:
+        raise ValueError(f"Latitude and longitude coordinates not found among {list(dataset.coords)}")
+    return lat, lon
+
+
+def to_xyz(lat, lon) -> np.ndarray:
+    """Points on the unit sphere, so that distances do not depend on the grid projection."""
+    lat, lon = np.radians(np.asarray(lat, dtype=float)), np.radians(np.asarray(lon, dtype=float))
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+class SpatialIndex:
+    """KD-tree over the cells of a rectilinear or curvilinear lat/lon grid.
+
+    `dims` are the grid dimensions, `lat` and `lon` the cell centers
+    broadcast to the grid shape.
+    """
+
+    def __init__(self, lat: np.ndarray, lon: np.ndarray, dims: Tuple[str, ...]):
+        try:
+            from scipy.spatial import cKDTree
+        except ImportError as e:
+            raise ImportError("scipy is required for spatial indexing") from e
+
+        self.dims = dims
+        self.shape = lat.shape
+        self.lat = lat
+        self.lon = lon
+        self.tree = cKDTree(to_xyz(lat, lon).reshape(-1, 3))
+
+    def nearest(self, lats: Sequence[float], lons: Sequence[float]):
+        """Grid indices (one array per dim) of the cells nearest to the points, and their distance in km."""
+        chord, flat = self.tree.query(to_xyz(lats, lons))
+        distance = 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0, 1))
+        return np.unravel_index(flat, self.shape), distance
+
+    def bbox_mask(self, lat_min: float, lat_max: float, lon_min: float, lon_max: float) -> np.ndarray:
+        """Cells inside a lat/lon box; the box can cross the antimeridian (lon_min > lon_max)."""
+        inside = (self.lat >= lat_min) & (self.lat <= lat_max)
+        width = (lon_max - lon_min) % 360
+        if width == 0 and lon_max != lon_min:
+            return inside
+        return inside & ((self.lon - lon_min) % 360 <= width)
+
+    def polygon_mask(self, vertices: Sequence[Tuple[float, float]]) -> np.ndarray:
+        """Cells inside a polygon of (lat, lon) vertices, by ray casting."""
+        vertices = np.asarray(vertices, dtype=float)
+        reference = vertices[0, 1]
+        # Longitudes are unwrapped around the first vertex
+        vy = vertices[:, 0]
+        vx = (vertices[:, 1] - reference + 180) % 360 - 180 + reference
+        y = self.lat
+        x = (self.lon - reference + 180) % 360 - 180 + reference
+
+        inside = np.zeros(self.shape, dtype=bool)
+        for i in range(len(vertices)):
+            x1, y1, x2, y2 = vx[i - 1], vy[i - 1], vx[i], vy[i]
+            if y1 == y2:
+                continue
+            crosses = (y1 > y) != (y2 > y)
+            inside ^= crosses & (x < (x2 - x1) * (y - y1) / (y2 - y1) + x1)
+        return inside
+
+
+def _grid(dataset: xr.Dataset):
+    lat_name, lon_name = find_latlon(dataset)
+    lat, lon = dataset.coords[lat_name], dataset.coords[lon_name]
+    if lat.ndim == 1 and lon.ndim == 1 and lat.dims != lon.dims:
+        # Rectilinear grid
+        lat, lon = xr.broadcast(lat, lon)
+    elif lat.dims != lon.dims:
+        raise ValueError(f"Unsupported grid: {lat_name}{lat.dims} and {lon_name}{lon.dims}")
+    return np.asarray(lat.values, dtype=float), np.asarray(lon.values, dtype=float), lat.dims
+
+
+def _grid_key(lat: np.ndarray, lon: np.ndarray, dims: Tuple[str, ...]) -> str:
+    digest = hashlib.sha256(repr(dims).encode())
+    digest.update(np.ascontiguousarray(lat).tobytes())
+    digest.update(np.ascontiguousarray(lon).tobytes())
+    return digest.hexdigest()
+
+
+def get_spatial_index(dataset: xr.Dataset) -> SpatialIndex:
+    """KD-tree of the dataset grid, built once per grid and shared between datasets."""
+    lat, lon, dims = _grid(dataset)
+    key = _grid_key(lat, lon, dims)
+
+    with _indexes_lock:
+        if key in _indexes:
+            _indexes.move_to_end(key)
+            return _indexes[key]
+
+    index = SpatialIndex(lat, lon, dims)
+    with _indexes_lock:
+        _indexes[key] = index
+        while len(_indexes) > SPATIAL_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def _cell_area(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Approximate area (km2) of the cells of a 2-D grid, from the Jacobian of its lat/lon coordinates."""
+    if min(lat.shape) < 2:
+        raise ValueError("Cell areas need at least two cells along each grid dimension, use coslat weights.")
+    phi = np.radians(lat)
+    lam = np.unwrap(np.radians(lon), axis=1)
+    lam = np.unwrap(lam, axis=0)
+    dphi_i, dphi_j = np.gradient(phi)
+    dlam_i, dlam_j = np.gradient(lam)
+    return EARTH_RADIUS_KM ** 2 * np.abs(dphi_i * dlam_j - dphi_j * dlam_i) * np.cos(phi)
+
+
+def grid_weights(dataset: xr.Dataset, kind: str) -> xr.DataArray:
+    """Weights of the grid cells: cos(latitude) or cell area, computed once per grid.
+
+    The weights have the grid dimensions and no coordinates.
+    """
+    if kind not in WEIGHTS:
+        raise ValueError(f"Unsupported weights '{kind}'. Choose from {list(WEIGHTS)}")
+
+    if kind == "coslat":
+        # Only the latitude is needed, the longitude may have been reduced already
+        lat_name = _find_coord(dataset, LAT_NAMES, LAT_UNITS, "latitude")
+        if lat_name is None:
+            raise ValueError(f"Latitude coordinate not found among {list(dataset.coords)}")
+        lat, dims = np.asarray(dataset.coords[lat_name].values, dtype=float), dataset.coords[lat_name].dims
+        key = f"{kind}:{_grid_key(lat, lat, dims)}"
+    else:
+        lat, lon, dims = _grid(dataset)
+        key = f"{kind}:{_grid_key(lat, lon, dims)}"
+
+    with _weights_lock:
+        if key in _weights:
+            _weights.move_to_end(key)
+            return _weights[key]
+
+    values = np.cos(np.radians(lat)) if kind == "coslat" else _cell_area(lat, lon)
+    weights = xr.DataArray(values, dims=dims, name=kind)
+
+    with _weights_lock:
+        _weights[key] = weights
+        while len(_weights) > SPATIAL_INDEXES:
+            _weights.popitem(last=False)
+    return weights
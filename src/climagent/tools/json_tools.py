@@ -2,18 +2,11 @@
 # Institute: Politecnico di Torino
 
 from climagent.state.json_state import JsonState
-from langchain.tools import BaseTool
-from typing import Optional
+from climagent.tracing import traced_tool
+from langchain_core.tools import BaseTool
+from typing import ClassVar, Optional
 #from langchain.tools import CallbackManagerForToolRun, AsyncCallbackManagerForToolRun
 
-from langchain_community.tools.json.tool import (
-    JsonGetValueTool,   # subclass of BaseTool
-    JsonListKeysTool,   # subclass of BaseTool
-    JsonSpec,           # subclass of BaseModel
-)
-
-import xarray as xr
-
 import logging
 _logger = logging.getLogger(__name__)
 
@@ -29,13 +22,14 @@ class JsonGetValueTool_custom(BaseTool):
     Before calling this you should be SURE that the path to this exists.
     The input is a text representation of the path to the dict in Python syntax (e.g. data["key1"][0]["key2"]).
     """
-    # json_state: JsonState 
+    json_state: JsonState
+    mutates_state: ClassVar[bool] = False
 
     def __init__(self, json_state: JsonState, **kwargs):
-        self.json_state = json_state  # Store the JsonState instance
         kwargs["json_state"] = json_state
         super().__init__(**kwargs)
 
+    @traced_tool
     def _run(
         self,
         tool_input: str,
@@ -62,13 +56,14 @@ class JsonListKeysTool_custom(BaseTool):
     The input should be a text representation of the path in Python syntax 
     (e.g., data["key1"][0]["key2"]). Make sure the path exists before calling.
     """
-    #json_state: JsonState  # Use JsonState instead of a static JsonSpec
+    json_state: JsonState  # Use JsonState instead of a static JsonSpec
+    mutates_state: ClassVar[bool] = False
 
     def __init__(self, json_state: JsonState, **kwargs):
-        self.json_state = json_state  # Store the JsonState instance
         kwargs["json_state"] = json_state
         super().__init__(**kwargs)
 
+    @traced_tool
     def _run(
         self,
         tool_input: str,
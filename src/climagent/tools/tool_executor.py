@@ -0,0 +1,39 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Number of threads running blocking xarray/NumPy work, shared by all the tools
+MAX_WORKERS = int(os.getenv("CLIMAGENT_MAX_WORKERS", min(8, (os.cpu_count() or 1) + 2)))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Returns the bounded thread pool used for blocking tool work."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="climagent")
+        return _executor
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking function in the tool thread pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    # The context carries the active tracer to the worker thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_executor(), functools.partial(context.run, func, *args, **kwargs))
+
+
+def map_blocking(func, items):
+    """Maps a blocking function over items in the tool thread pool, keeping their order."""
+    contexts = [contextvars.copy_context() for _ in items]
+    return list(get_executor().map(lambda pair: pair[0].run(func, pair[1]), zip(contexts, items)))
@@ -1,28 +1,35 @@
 # Author: jacopo.grassi@polito.it
 # Institute: Politecnico di Torino
 
-from langchain.tools import BaseTool
+from langchain_core.tools import BaseTool
 import xarray as xr
-from typing import List, Type, Literal
+from typing import ClassVar, List, Optional, Type, Literal
 from pydantic import BaseModel, Field
 from climagent.state.dataset_state import DatasetState
 from climagent.state.json_state import JsonState
+from climagent.tracing import traced_tool
+from climagent.tools.tool_executor import run_blocking
+from climagent.state.operation_plan import Aggregate, Quantiles, Statistics
 import numpy as np
 
 
 # https://docs.xarray.dev/en/stable/api.html#aggregation
 
 class AggregateDatasetInput(BaseModel):
-    func: Literal["mean", "max", "min", "sum", "std", "var"] = Field(escription="The aggregation function to apply to the dataset.")
+    func: Literal["mean", "max", "min", "sum", "std", "var", "median"] = Field(default="mean", description="The aggregation function to apply to the dataset.")
     dims: List[str] = Field(description="A list of coordinate names along which to aggregate the dataset.")
+    funcs: Optional[List[Literal["mean", "max", "min", "sum", "std", "var", "count"]]] = Field(default=None, description="Several statistics computed in a single pass, used instead of func. With more than one statistic, each variable is split into '<variable>_<statistic>' variables.")
+    weights: Optional[Literal["coslat", "area"]] = Field(default=None, description="Weight the grid cells by cos(latitude) or by their area. Use it for spatial means, std and var on lat/lon grids.")
+    quantiles: Optional[List[float]] = Field(default=None, description="Quantiles between 0 and 1 (e.g. [0.95, 0.99] for the 95th and 99th percentiles), used instead of func and funcs. The result has a new 'quantile' coordinate.")
 
 
 class AggregateDatasetTool(BaseTool):
     name: str = "aggregate_dataset"
-    description: str = "Aggregate the dataset on one or more coordinates."
+    description: str = "Aggregate the dataset on one or more coordinates, with one or several statistics at once, or with quantiles (percentiles). Use area weights for spatial averages on lat/lon grids."
     args_schema: Type[AggregateDatasetInput] = AggregateDatasetInput
     dataset_state: DatasetState
     json_state: JsonState  
+    mutates_state: ClassVar[bool] = True
 
     XARRAY_FUNCTIONS : dict = {
         "mean": "mean",
@@ -42,24 +49,47 @@ class AggregateDatasetTool(BaseTool):
         kwargs["json_state"] = json_state
         super().__init__(**kwargs)
 
-    def _run(self, func: str, dims: List[str]) -> str:
-
-        reduced_dat = self.dataset_state.dataset.copy()
+    @traced_tool
+    def _run(self, func: str = "mean", dims: Optional[List[str]] = None, funcs: Optional[List[str]] = None,
+             weights: Optional[str] = None, quantiles: Optional[List[float]] = None) -> str:
 
+        dims = dims or []
         if func not in self.XARRAY_FUNCTIONS:
             return f"Error: Unsupported function '{func}'. Choose from {list(self.XARRAY_FUNCTIONS.keys())}"
+        if quantiles and any(not 0 <= q <= 1 for q in quantiles):
+            return f"Error: Quantiles must be between 0 and 1, got {quantiles}"
+        if (quantiles or (func == "median" and not funcs)) and weights:
+            return "Error: Weighted quantiles are not supported, aggregate without weights."
 
         try:
-            reduced_dat = getattr(reduced_dat, self.XARRAY_FUNCTIONS[func])(dim=dims)
-            operation = f"Aggregated on {dims} using {func}"
+            if quantiles:
+                operation = Quantiles(q=tuple(dict.fromkeys(quantiles)), dims=tuple(dims))
+            elif func == "median" and not funcs:
+                operation = Quantiles(q=(0.5,), dims=tuple(dims), squeeze=True)
+            elif funcs or weights:
+                # Several statistics, or weighted ones, in a single pass
+                funcs = tuple(dict.fromkeys(funcs or [func]))
+                operation = Statistics(funcs=funcs, dims=tuple(dims), weights=weights)
+            else:
+                operation = Aggregate(func=self.XARRAY_FUNCTIONS[func], dims=tuple(dims))
+            reduced_dat = self.dataset_state.apply_operation(operation, tool=self.name)
 
-            self.dataset_state.update_dataset(reduced_dat, operation)
             self.json_state.update_json_spec(reduced_dat, operation)
 
-            return f"Aggregation executed successfully: {operation}"
+            return f"Aggregation executed successfully: {operation.describe()}{self._quantile_error(reduced_dat)}"
 
         except Exception as e:
             return f"Error in dataset aggregation: {e}"
 
-    async def _arun(self, func: str, dims: List[str]) -> str:
-        raise NotImplementedError("aggregate_dataset does not support async")
\ No newline at end of file
+    @staticmethod
+    def _quantile_error(dataset: xr.Dataset) -> str:
+        """Method and largest rank error of the quantiles, so that the caller knows their accuracy."""
+        sketched = [var.attrs for var in dataset.data_vars.values() if var.attrs.get("quantile_method") == "sketch"]
+        if not sketched:
+            return ""
+        error = max(max(attrs["quantile_rank_error"]) for attrs in sketched)
+        return f" (approximate quantiles from streaming sketches, rank error below {error:.2%})"
+
+    async def _arun(self, func: str = "mean", dims: Optional[List[str]] = None, funcs: Optional[List[str]] = None,
+                    weights: Optional[str] = None, quantiles: Optional[List[float]] = None) -> str:
+        return await run_blocking(self._run, func, dims, funcs, weights, quantiles)
@@ -0,0 +1,148 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+from langchain_core.tools import BaseTool
+from typing import ClassVar, Optional, Type
+from pydantic import BaseModel, Field
+from climagent.state.dataset_state import DatasetState
+from climagent.state.json_state import JsonState
+from climagent.tracing import traced_tool
+from climagent.tools.tool_executor import run_blocking
+
+
+class CheckpointDatasetInput(BaseModel):
+    name: str = Field(description="The name of the checkpoint.")
+
+class CheckpointDatasetTool(BaseTool):
+    name: str = "checkpoint_dataset"
+    description: str = "Save the current state of the dataset under a name, so that you can come back to it later with revert_dataset. Use it before trying an operation you may want to undo."
+    args_schema: Type[CheckpointDatasetInput] = CheckpointDatasetInput
+    dataset_state: DatasetState
+    json_state: JsonState
+    mutates_state: ClassVar[bool] = True
+
+    def __init__(self, dataset_state: DatasetState, json_state: JsonState, **kwargs):
+        kwargs["dataset_state"] = dataset_state
+        kwargs["json_state"] = json_state
+        super().__init__(**kwargs)
+
+    @traced_tool
+    def _run(self, name: str) -> str:
+
+        try:
+            self.dataset_state.save_checkpoint(name)
+            self.json_state.save_checkpoint(name)
+            return f"Checkpoint saved successfully: {name}"
+
+        except Exception as e:
+            return f"Error in checkpoint saving: {e}"
+
+    async def _arun(self, name: str) -> str:
+        return await run_blocking(self._run, name)
+
+
+
+
+class RevertDatasetInput(BaseModel):
+    name: str = Field(description="The name of a checkpoint saved with checkpoint_dataset.")
+
+class RevertDatasetTool(BaseTool):
+    name: str = "revert_dataset"
+    description: str = "Bring the dataset back to a checkpoint saved with checkpoint_dataset, undoing the operations performed after it. The other checkpoints are kept, so you can explore a different branch of the analysis."
+    args_schema: Type[RevertDatasetInput] = RevertDatasetInput
+    dataset_state: DatasetState
+    json_state: JsonState
+    mutates_state: ClassVar[bool] = True
+
+    def __init__(self, dataset_state: DatasetState, json_state: JsonState, **kwargs):
+        kwargs["dataset_state"] = dataset_state
+        kwargs["json_state"] = json_state
+        super().__init__(**kwargs)
+
+    @traced_tool
+    def _run(self, name: str) -> str:
+
+        if name not in self.dataset_state.checkpoints:
+            return f"Error: Unknown checkpoint '{name}'. Available checkpoints: {list(self.dataset_state.checkpoints)}"
+
+        try:
+            self.dataset_state.revert(name)
+            self.json_state.revert(name)
+            return f"Reverted successfully to checkpoint: {name}"
+
+        except Exception as e:
+            return f"Error in checkpoint reverting: {e}"
+
+    async def _arun(self, name: str) -> str:
+        return await run_blocking(self._run, name)
+
+
+
+
+class BranchDatasetInput(BaseModel):
+    checkpoint: str = Field(description="The name of the checkpoint the new branch starts from.")
+    name: str = Field(description="The name of the new branch, saved as a checkpoint.")
+    save_current_as: Optional[str] = Field(default=None, description="Optional checkpoint name to save the current state under before branching, so that you can come back to it.")
+
+class BranchDatasetTool(BaseTool):
+    name: str = "branch_dataset"
+    description: str = "Start a new branch of the analysis from a checkpoint saved with checkpoint_dataset, without losing the other branches: the dataset goes back to the checkpoint and the new branch is saved under its own name. Use save_current_as to keep the current state too."
+    args_schema: Type[BranchDatasetInput] = BranchDatasetInput
+    dataset_state: DatasetState
+    json_state: JsonState
+    mutates_state: ClassVar[bool] = True
+
+    def __init__(self, dataset_state: DatasetState, json_state: JsonState, **kwargs):
+        kwargs["dataset_state"] = dataset_state
+        kwargs["json_state"] = json_state
+        super().__init__(**kwargs)
+
+    @traced_tool
+    def _run(self, checkpoint: str, name: str, save_current_as: Optional[str] = None) -> str:
+
+        if checkpoint not in self.dataset_state.checkpoints:
+            return f"Error: Unknown checkpoint '{checkpoint}'. Available checkpoints: {list(self.dataset_state.checkpoints)}"
+        if name in self.dataset_state.checkpoints or name == save_current_as:
+            return f"Error: Checkpoint '{name}' already exists, choose another name for the branch."
+
+        try:
+            if save_current_as:
+                self.dataset_state.save_checkpoint(save_current_as)
+                self.json_state.save_checkpoint(save_current_as)
+            # The branch shares the datasets of its checkpoint, and is its child
+            self.dataset_state.revert(checkpoint)
+            self.json_state.revert(checkpoint)
+            self.dataset_state.save_checkpoint(name)
+            self.json_state.save_checkpoint(name)
+            saved = f" Current state saved as: {save_current_as}." if save_current_as else ""
+            return f"Branch created successfully: {name} from checkpoint {checkpoint}.{saved}"
+
+        except Exception as e:
+            return f"Error in branch creation: {e}"
+
+    async def _arun(self, checkpoint: str, name: str, save_current_as: Optional[str] = None) -> str:
+        return await run_blocking(self._run, checkpoint, name, save_current_as)
+
+
+
+
+class ListCheckpointsTool(BaseTool):
+    name: str = "list_checkpoints"
+    description: str = "List the checkpoints saved with checkpoint_dataset and the operations performed since the current one."
+    dataset_state: DatasetState
+    json_state: JsonState
+    mutates_state: ClassVar[bool] = False
+
+    def __init__(self, dataset_state: DatasetState, json_state: JsonState, **kwargs):
+        kwargs["dataset_state"] = dataset_state
+        kwargs["json_state"] = json_state
+        super().__init__(**kwargs)
+
+    @traced_tool
+    def _run(self) -> str:
+        checkpoints = [f"{c['name']} ({c['operations']} operations{', from ' + c['parent'] if c['parent'] else ''})"
+                       for c in self.dataset_state.list_checkpoints()]
+        return f"Checkpoints: {checkpoints}. Current checkpoint: {self.dataset_state.current_checkpoint}"
+
+    async def _arun(self) -> str:
+        return self._run()
@@ -0,0 +1,73 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+from langchain_core.tools import BaseTool
+from typing import ClassVar, List, Optional, Type
+from pydantic import BaseModel, Field, TypeAdapter
+from climagent.agent.pipeline import PipelineStep
+from climagent.state.cost import describe_estimate
+from climagent.state.dataset_state import DatasetState
+from climagent.state.json_state import JsonState
+from climagent.tracing import traced_tool
+from climagent.tools.tool_executor import run_blocking
+from climagent.tools.xarray_tools_indexing import SubsetDatasetTool, SelectVariablesTool
+from climagent.tools.xarray_tools_grouping import ResampleTimeTool, ClimatologyTool
+from climagent.tools.xarray_tools_aggregating import AggregateDatasetTool
+from climagent.tools.xarray_tools_derive import DeriveVariableTool
+
+
+# Tools whose steps are simulated, look_dataset and export_dataset only read the result
+SIMULATED_TOOLS = {
+    "subset_dataset": SubsetDatasetTool,
+    "select_variables": SelectVariablesTool,
+    "resampletime_dataset": ResampleTimeTool,
+    "climatology_dataset": ClimatologyTool,
+    "aggregate_dataset": AggregateDatasetTool,
+    "derive_variable": DeriveVariableTool,
+}
+
+_STEP = TypeAdapter(PipelineStep)
+
+
+class DryRunInput(BaseModel):
+    steps: List[PipelineStep] = Field(default_factory=list, description="Optional tool calls to simulate after the operations already performed, in order. Leave it empty to estimate the current dataset.")
+
+class DryRunTool(BaseTool):
+    name: str = "dry_run"
+    description: str = "Estimate the cost of the current dataset, optionally followed by more steps, without computing anything: output dims and size, bytes read, values processed, approximate time and memory, compared with the memory budget. Use it before looking at or exporting large datasets."
+    args_schema: Type[DryRunInput] = DryRunInput
+    dataset_state: DatasetState
+    json_state: JsonState
+    mutates_state: ClassVar[bool] = False
+
+    def __init__(self, dataset_state: DatasetState, json_state: JsonState, **kwargs):
+        kwargs["dataset_state"] = dataset_state
+        kwargs["json_state"] = json_state
+        super().__init__(**kwargs)
+
+    @traced_tool
+    def _run(self, steps: Optional[List[PipelineStep]] = None) -> str:
+
+        steps = steps or []
+        try:
+            dataset_state, json_state = self.dataset_state, self.json_state
+            if steps:
+                # The steps are applied to copies, the session state is left untouched
+                dataset_state, json_state = dataset_state.copy(), json_state.copy()
+            for i, step in enumerate(steps, start=1):
+                step = step if isinstance(step, BaseModel) else _STEP.validate_python(step)
+                if step.tool not in SIMULATED_TOOLS:
+                    continue
+                tool = SIMULATED_TOOLS[step.tool](dataset_state=dataset_state, json_state=json_state)
+                output = tool._run(**step.model_dump(exclude={"tool"}))
+                if output.startswith("Error"):
+                    return f"Error in step {i} ({step.tool}): {output}"
+
+            cost = dataset_state.estimate()
+            return f"Estimated cost: {describe_estimate(cost, dataset_state.memory_budget)}"
+
+        except Exception as e:
+            return f"Error in cost estimation: {e}"
+
+    async def _arun(self, steps: Optional[List[PipelineStep]] = None) -> str:
+        return await run_blocking(self._run, steps)
@@ -0,0 +1,58 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+from langchain_core.tools import BaseTool
+from typing import ClassVar, Optional, Type
+from pydantic import BaseModel, Field
+from climagent.state.dataset_state import DatasetState
+from climagent.state.json_state import JsonState
+from climagent.state.expressions import Expression
+from climagent.tracing import traced_tool
+from climagent.tools.tool_executor import run_blocking
+from climagent.state.operation_plan import Derive
+
+
+class DeriveVariableInput(BaseModel):
+    name: str = Field(description="The name of the new variable.")
+    expression: str = Field(description="Arithmetic expression over the data variables, e.g. 't2m - 273.15', 'sqrt(u10**2 + v10**2)' or 'tp * 86400'. Operators: + - * / ** % and comparisons; functions: sqrt, exp, log, log10, abs, sin, cos, tan, arcsin, arccos, arctan, arctan2, hypot, minimum, maximum, where(condition, x, y); constants: pi, e.")
+    units: Optional[str] = Field(default=None, description="Units of the new variable. Provide them for unit conversions (e.g. 'degC' or 'mm day-1'), they are only inferred when the operands keep their units.")
+    long_name: Optional[str] = Field(default=None, description="Optional description of the new variable, e.g. '10 m wind speed'.")
+
+class DeriveVariableTool(BaseTool):
+    name: str = "derive_variable"
+    description: str = "Add a variable computed element-wise from an arithmetic expression over the data variables, e.g. unit conversions (Kelvin to Celsius, precipitation rate to daily totals), wind speed from u/v components or indices. The other variables are kept."
+    args_schema: Type[DeriveVariableInput] = DeriveVariableInput
+    dataset_state: DatasetState
+    json_state: JsonState
+    mutates_state: ClassVar[bool] = True
+
+    def __init__(self, dataset_state: DatasetState, json_state: JsonState, **kwargs):
+        kwargs["dataset_state"] = dataset_state
+        kwargs["json_state"] = json_state
+        super().__init__(**kwargs)
+
+    @traced_tool
+    def _run(self, name: str, expression: str, units: Optional[str] = None, long_name: Optional[str] = None) -> str:
+
+        spec = self.json_state.get_spec().dict_
+        if not name.isidentifier():
+            return f"Error: Invalid variable name '{name}', use letters, digits and underscores."
+        if name in spec['coords']:
+            return f"Error: '{name}' is a coordinate, choose another name for the derived variable."
+
+        try:
+            # The names are checked against the dataset description before touching the data
+            Expression(expression, spec['data_vars'])
+
+            operation = Derive(name=name, expression=expression, units=units, long_name=long_name)
+            derived_dat = self.dataset_state.apply_operation(operation, tool=self.name)
+            self.json_state.update_json_spec(derived_dat, operation)
+
+            units = derived_dat[name].attrs.get('units')
+            return f"Variable derived successfully: {operation.describe()} ({f'units {units}' if units else 'units unknown, provide them if needed'})"
+
+        except Exception as e:
+            return f"Error in variable derivation: {e}"
+
+    async def _arun(self, name: str, expression: str, units: Optional[str] = None, long_name: Optional[str] = None) -> str:
+        return await run_blocking(self._run, name, expression, units, long_name)
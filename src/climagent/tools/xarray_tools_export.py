@@ -0,0 +1,56 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import json
+from langchain_core.tools import BaseTool
+from typing import ClassVar, Dict, Literal, Optional, Type
+from pydantic import BaseModel, Field
+from climagent.state.dataset_state import DatasetState
+from climagent.state.json_state import JsonState
+from climagent.state.export import export_path
+from climagent.tracing import traced_tool
+from climagent.tools.tool_executor import run_blocking
+
+
+class ExportDatasetInput(BaseModel):
+    name: str = Field(description="The file name of the store, without directories (e.g. 'monthly_t2m').")
+    format: Literal["zarr", "netcdf"] = Field(default="zarr", description="The format of the store.")
+    checkpoint: Optional[str] = Field(default=None, description="Export this checkpoint instead of the current dataset.")
+    compression: Optional[Literal["zstd", "lz4", "zlib", "none"]] = Field(default=None, description="The compression of the values. By default zstd for zarr and zlib for netcdf.")
+    chunks: Optional[Dict[str, int]] = Field(default=None, description="The chunk size of some dimensions in the store, e.g. {'time': 365}.")
+    append_dim: Optional[str] = Field(default=None, description="Append to an existing zarr store along this dimension (e.g. time) instead of creating a new one.")
+    overwrite: bool = Field(default=False, description="Replace the store if it already exists.")
+
+
+class ExportDatasetTool(BaseTool):
+    name: str = "export_dataset"
+    description: str = "Write the current dataset (or a checkpoint) to a Zarr or NetCDF store on disk, chunk by chunk. Returns the path and a short manifest of the store: use it to hand large results over instead of looking at their values."
+    args_schema: Type[ExportDatasetInput] = ExportDatasetInput
+    dataset_state: DatasetState
+    json_state: JsonState
+    mutates_state: ClassVar[bool] = False
+
+    def __init__(self, dataset_state: DatasetState, json_state: JsonState, **kwargs):
+        kwargs["dataset_state"] = dataset_state
+        kwargs["json_state"] = json_state
+        super().__init__(**kwargs)
+
+    @traced_tool
+    def _run(self, name: str, format: str = "zarr", checkpoint: Optional[str] = None, compression: Optional[str] = None,
+             chunks: Optional[Dict[str, int]] = None, append_dim: Optional[str] = None, overwrite: bool = False) -> str:
+
+        if checkpoint is not None and checkpoint not in self.dataset_state.checkpoints:
+            return f"Error: Unknown checkpoint '{checkpoint}'. Available checkpoints: {list(self.dataset_state.checkpoints)}"
+
+        try:
+            path = export_path(name, format)
+            manifest = self.dataset_state.export(path, checkpoint=checkpoint, format=format, compression=compression,
+                                                 chunks=chunks, append_dim=append_dim, overwrite=overwrite)
+            return f"Dataset exported successfully to {path}. Manifest: {json.dumps(manifest, default=str)}"
+
+        except Exception as e:
+            return f"Error in dataset export: {e}"
+
+    async def _arun(self, name: str, format: str = "zarr", checkpoint: Optional[str] = None, compression: Optional[str] = None,
+                    chunks: Optional[Dict[str, int]] = None, append_dim: Optional[str] = None, overwrite: bool = False) -> str:
+        return await run_blocking(self._run, name, format, checkpoint, compression, chunks, append_dim, overwrite)
@@ -1,46 +1,91 @@
 # Author: jacopo.grassi@polito.it
 # Institute: Politecnico di Torino
 
-from langchain.tools import BaseTool
+from langchain_core.tools import BaseTool
 import xarray as xr
-from typing import List, Type
+from typing import ClassVar, List, Literal, Optional, Type
 from pydantic import BaseModel, Field
 from climagent.state.dataset_state import DatasetState
 from climagent.state.json_state import JsonState
+from climagent.tracing import traced_tool
+from climagent.tools.tool_executor import run_blocking
+from climagent.state.operation_plan import Climatology, ResampleTime
 
 
 
 class ResampleTimeDatasetInput(BaseModel):
     coordinate_name: str = Field(description="The name of the coordinate to group the dataset on.")
     frequency: str = Field(description="The frequency of the resampling operation. Use '*YE', '*M', '*W', '*D', '*H', '*T', '*S' for yearly, monthly, weekly, daily, hourly, minutely, and secondly grouping, respectively. Substitute '*' with an integer for a custom frequency.")
+    funcs: List[Literal["mean", "sum", "min", "max", "std", "var", "count"]] = Field(default=["mean"], description="The reductions applied to each time bin, e.g. ['max'] for daily maxima or ['sum'] for precipitation totals. With more than one reduction, each variable is split into '<variable>_<reduction>' variables.")
 
 class ResampleTimeTool(BaseTool):
     name: str = "resampletime_dataset"
-    description: str = "Resample a dataset on a time coordinate"
+    description: str = "Resample a dataset on a time coordinate, reducing each time bin with one or more functions (mean by default)."
     args_schema: Type[ResampleTimeDatasetInput] = ResampleTimeDatasetInput
     dataset_state: DatasetState
     json_state: JsonState  
+    mutates_state: ClassVar[bool] = True
 
     def __init__(self, dataset_state: DatasetState, json_state: JsonState, **kwargs):
         kwargs["dataset_state"] = dataset_state 
         kwargs["json_state"] = json_state
         super().__init__(**kwargs)
 
-    def _run(self, coordinate_name: str, frequency: str) -> str:
+    @traced_tool
+    def _run(self, coordinate_name: str, frequency: str, funcs: Optional[List[str]] = None) -> str:
 
-        subset_dat = self.dataset_state.dataset.copy()
+        funcs = ["mean"] if funcs is None else funcs
+        if not funcs:
+            return "Error: Provide at least one reduction."
 
         try:
             
-            subset_dat = subset_dat.resample({coordinate_name : frequency}).mean()
-            operation = f"Group on {coordinate_name}({frequency})"
+            operation = ResampleTime(coordinate_name=coordinate_name, frequency=frequency, funcs=tuple(dict.fromkeys(funcs)))
+            subset_dat = self.dataset_state.apply_operation(operation, tool=self.name)
 
-            self.dataset_state.update_dataset(subset_dat, operation)
             self.json_state.update_json_spec(subset_dat, operation)
-            return f"Subset executed successfully: {operation}"
+            return f"Subset executed successfully: {operation.describe()}"
 
         except Exception as e:
             return f"Error in dataset resampling: {e}"
 
-    async def _arun(self, coordinate_name: str, values: List[str]) -> str:
-        raise NotImplementedError("resampletime_dataset does not support async")
\ No newline at end of file
+    async def _arun(self, coordinate_name: str, frequency: str, funcs: Optional[List[str]] = None) -> str:
+        return await run_blocking(self._run, coordinate_name, frequency, funcs)
+
+
+
+
+
+class ClimatologyDatasetInput(BaseModel):
+    coordinate_name: str = Field(description="The name of the time coordinate to group the dataset on.")
+    by: Literal["season", "month", "dayofyear", "hour"] = Field(description="The groups of the climatology: seasons (DJF, MAM, JJA, SON), months, days of the year or hours of the day.")
+    func: Literal["mean", "sum", "min", "max", "std", "var", "count"] = Field(default="mean", description="The reduction applied to each group.")
+
+class ClimatologyTool(BaseTool):
+    name: str = "climatology_dataset"
+    description: str = "Compute a climatology: reduce the dataset over the seasons, months, days of the year or hours of the day of a time coordinate, which is replaced by a coordinate named after the grouping."
+    args_schema: Type[ClimatologyDatasetInput] = ClimatologyDatasetInput
+    dataset_state: DatasetState
+    json_state: JsonState
+    mutates_state: ClassVar[bool] = True
+
+    def __init__(self, dataset_state: DatasetState, json_state: JsonState, **kwargs):
+        kwargs["dataset_state"] = dataset_state
+        kwargs["json_state"] = json_state
+        super().__init__(**kwargs)
+
+    @traced_tool
+    def _run(self, coordinate_name: str, by: str, func: str = "mean") -> str:
+
+        try:
+            operation = Climatology(coordinate_name=coordinate_name, by=by, func=func)
+            climatology_dat = self.dataset_state.apply_operation(operation, tool=self.name)
+
+            self.json_state.update_json_spec(climatology_dat, operation)
+            return f"Climatology executed successfully: {operation.describe()}"
+
+        except Exception as e:
+            return f"Error in dataset climatology: {e}"
+
+    async def _arun(self, coordinate_name: str, by: str, func: str = "mean") -> str:
+        return await run_blocking(self._run, coordinate_name, by, func)
@@ -1,12 +1,15 @@
 # Author: jacopo.grassi@polito.it
 # Institute: Politecnico di Torino
 
-from langchain.tools import BaseTool
+from langchain_core.tools import BaseTool
 import xarray as xr
-from typing import List, Type
+from typing import ClassVar, List, Type
 from pydantic import BaseModel, Field
 from climagent.state.dataset_state import DatasetState
 from climagent.state.json_state import JsonState
+from climagent.tracing import traced_tool
+from climagent.tools.tool_executor import run_blocking
+from climagent.state.operation_plan import Subset, SelectVariables
 # JSON functions developed by langchain_community
 
 
@@ -20,16 +23,16 @@ class SubsetDatasetTool(BaseTool):
     args_schema: Type[SubsetDatasetInput] = SubsetDatasetInput
     dataset_state: DatasetState
     json_state: JsonState  
+    mutates_state: ClassVar[bool] = True
 
     def __init__(self, dataset_state: DatasetState, json_state: JsonState, **kwargs):
         kwargs["dataset_state"] = dataset_state 
         kwargs["json_state"] = json_state
         super().__init__(**kwargs)
 
+    @traced_tool
     def _run(self, coordinate_name: str, values: List[str]) -> str:
 
-        subset_dat = self.dataset_state.dataset.copy()
-
         try:
             try:
                 if coordinate_name not in ['time', 'datetime', 'timedelta', 'valid_time', 'scenario', 'model']:
@@ -37,32 +40,20 @@ class SubsetDatasetTool(BaseTool):
             except ValueError:
                 return "Error: Values must be numeric strings."
 
-            if len(values) == 1:
-
-                try:
-                    subset_dat = subset_dat.sel({coordinate_name: values[0]})
-                
-                except:
-                    subset_dat = subset_dat.sel({coordinate_name: values[0]}, method="nearest")
-
-                operation = f"Subset on {coordinate_name}({values[0]})"
-
-            elif len(values) == 2:
-                subset_dat = subset_dat.sel({coordinate_name: slice(values[0], values[1])})
-                operation = f"Subset on {coordinate_name}({values[0]}:{values[1]})"
-
-            else:
+            if len(values) not in (1, 2):
                 return "Error: Invalid number of values provided for subsetting. Provide one or two numeric values."
 
-            self.dataset_state.update_dataset(subset_dat, operation)
+            # Operation is only recorded on the plan, values are computed when needed
+            operation = Subset(coordinate_name=coordinate_name, values=tuple(values))
+            subset_dat = self.dataset_state.apply_operation(operation, tool=self.name)
             self.json_state.update_json_spec(subset_dat, operation)
-            return f"Subset executed successfully: {operation}"
+            return f"Subset executed successfully: {operation.describe()}"
 
         except Exception as e:
             return f"Error in dataset slicing: {e}"
 
     async def _arun(self, coordinate_name: str, values: List[str]) -> str:
-        raise NotImplementedError("subset_dataset does not support async")
+        return await run_blocking(self._run, coordinate_name, values)
     
 
 
@@ -78,27 +69,26 @@ class SelectVariablesTool(BaseTool):
     args_schema: Type[SelectVariablesInput] = SelectVariablesInput
     dataset_state: DatasetState
     json_state: JsonState  
+    mutates_state: ClassVar[bool] = True
 
     def __init__(self, dataset_state: DatasetState, json_state: JsonState, **kwargs):
         kwargs["dataset_state"] = dataset_state 
         kwargs["json_state"] = json_state
         super().__init__(**kwargs)
 
+    @traced_tool
     def _run(self, variable_names: List[str]) -> str:
 
-        subset_dat = self.dataset_state.dataset.copy()
-
         try:
 
-            subset_dat = subset_dat[variable_names]
-            operation = f"Selected variables:{variable_names})"
-            self.dataset_state.update_dataset(subset_dat, operation)
+            operation = SelectVariables(variable_names=tuple(variable_names))
+            subset_dat = self.dataset_state.apply_operation(operation, tool=self.name)
             self.json_state.update_json_spec(subset_dat, operation)
 
-            return f"Variables selected successfully: {operation}"
+            return f"Variables selected successfully: {operation.describe()}"
 
         except Exception as e:
             return f"Error in variables selection: {e}"
 
     async def _arun(self, variable_names: List[str]) -> str:
-        raise NotImplementedError("select_variables does not support async")
\ No newline at end of file
+        return await run_blocking(self._run, variable_names)
\ No newline at end of file
@@ -1,44 +1,188 @@
 # Author: jacopo.grassi@polito.it
 # Institute: Politecnico di Torino
 
-from langchain.tools import BaseTool
+from langchain_core.tools import BaseTool
 import xarray as xr
-from typing import List, Type
+import numpy as np
+from typing import ClassVar, Iterator, List, Type
 from pydantic import BaseModel, Field
 from climagent.state.dataset_state import DatasetState
 from climagent.state.json_state import JsonState
+from climagent.tracing import traced_tool
+from climagent.tools.tool_executor import run_blocking
 # JSON functions developed by langchain_community
 
 
-# class LookDatasetInput(BaseModel):
-#     coordinate_name: str = Field(description="The name of the coordinate to subset the dataset on.")
-#     values: List[str] = Field(description="A list of values to subset the dataset on. Use one value for nearest selection or two values for a slice.")
+# Maximum size of a block of values read at once from a variable
+BLOCK_BYTES = 64 * 1024 * 1024
+
+# Number of values kept along each dimension for corners and strided samples
+PREVIEW_SIZE = 3
+
+
+class LookDatasetInput(BaseModel):
+    max_chars: int = Field(default=10000, description="Maximum number of characters of the returned content. If the dataset is larger, a preview with summary statistics is returned instead.")
 
 class LookDatasetTool(BaseTool):
     name: str = "look_dataset"
-    description: str = "Look at the numerical data inside the dataset. Use this tool when you have performed all the operations you need and want to see the final result."
-    #args_schema: Type[LookDatasetInput] = LookDatasetInput
+    description: str = "Look at the numerical data inside the dataset. Use this tool when you have performed all the operations you need and want to see the final result. Large datasets are returned as a preview with summary statistics, reduce the dataset first to see all the values."
+    args_schema: Type[LookDatasetInput] = LookDatasetInput
     dataset_state: DatasetState
-    json_state: JsonState  
+    json_state: JsonState
+    mutates_state: ClassVar[bool] = False
 
     def __init__(self, dataset_state: DatasetState, json_state: JsonState, **kwargs):
-        kwargs["dataset_state"] = dataset_state 
+        kwargs["dataset_state"] = dataset_state
         kwargs["json_state"] = json_state
         super().__init__(**kwargs)
 
-    def _run(self) -> str:
+    @traced_tool
+    def _run(self, max_chars: int = 10000) -> str:
 
-        dat = self.dataset_state.dataset.copy()
-        content = dat.to_dict()
+        try:
+            dat = self.dataset_state.lazy_dataset()
 
-        if len(content) > 10000:
-            content = content[:10000] + "... [truncated]"
+            content = _stream_content(dat, max_chars)
+            if content is None:
+                content = _preview_content(dat, max_chars)
+                return f"Dataset is too large to be shown in full, preview: {content}"
 
-        try:
             return f"Dataset content: {content}"
 
         except Exception as e:
             return f"Cannot look at the dataset: {e}"
 
-    async def _arun(self) -> str:
-        raise NotImplementedError("look_dataset does not support async")
\ No newline at end of file
+    async def _arun(self, max_chars: int = 10000) -> str:
+        return await run_blocking(self._run, max_chars)
+
+
+def _iter_blocks(var: xr.DataArray) -> Iterator[np.ndarray]:
+    """Yields the values of a variable in blocks along its first dimension."""
+    if var.ndim == 0:
+        yield np.asarray(var.values)
+        return
+
+    dim = var.dims[0]
+    row_bytes = max(1, var.dtype.itemsize * (var.size // max(1, var.shape[0])))
+    rows = max(1, BLOCK_BYTES // row_bytes)
+    for start in range(0, var.shape[0], rows):
+        yield np.asarray(var.isel({dim: slice(start, start + rows)}).values)
+
+
+def _format_values(values: np.ndarray) -> str:
+    flat = values.ravel()
+    if flat.dtype.kind in "Mm":
+        # tolist() turns nanosecond datetimes into integers
+        flat = flat.astype(str)
+    return ", ".join(str(v) for v in flat.tolist())
+
+
+def _format_coords(dataset: xr.Dataset) -> str:
+    lines = []
+    for coord in dataset.coords:
+        values = np.asarray(dataset.coords[coord].values)
+        lines.append(f"{coord} {dataset.coords[coord].dims}: [{_format_values(values)}]")
+    return "\n".join(lines)
+
+
+def _stream_content(dataset: xr.Dataset, max_chars: int):
+    """Renders all the values, reading block by block.
+
+    Returns None as soon as the content exceeds `max_chars`, without reading
+    the remaining blocks.
+    """
+    # Every value takes at least two characters: reject large datasets before reading them
+    if 2 * sum(v.size for v in dataset.variables.values()) > max_chars:
+        return None
+
+    parts = [f"attrs: {dataset.attrs}", "coords:", _format_coords(dataset), "data_vars:"]
+    size = sum(len(p) + 1 for p in parts)
+    if size > max_chars:
+        return None
+
+    for name, var in dataset.data_vars.items():
+        header = f"{name} {var.dims} {var.attrs}: ["
+        parts.append(header)
+        size += len(header) + 2
+        for block in _iter_blocks(var):
+            text = _format_values(block)
+            size += len(text) + 2
+            if size > max_chars:
+                return None
+            parts.append(text)
+        parts.append("]")
+
+    return "\n".join(parts)
+
+
+def _preview_indices(length: int, size: int = PREVIEW_SIZE):
+    """Corner indices (first and last values) and strided indices along one dimension."""
+    corners = sorted(set(list(range(min(size, length))) + list(range(max(0, length - size), length))))
+    strided = list(range(0, length, max(1, -(-length // size))))
+    return corners, strided
+
+
+def _summary_statistics(var: xr.DataArray) -> dict:
+    """Count, missing values, mean, std, min and max computed in a single pass over the blocks."""
+    count, missing, mean, m2 = 0, 0, 0.0, 0.0
+    minimum, maximum = None, None
+
+    for block in _iter_blocks(var):
+        block = block.ravel()
+        if not np.issubdtype(block.dtype, np.number):
+            return {}
+        valid = block[~np.isnan(block)] if np.issubdtype(block.dtype, np.floating) else block
+        missing += block.size - valid.size
+        if valid.size == 0:
+            continue
+        valid = valid.astype(np.float64)
+
+        # Merge the block moments into the running ones (Chan et al.)
+        block_mean = valid.mean()
+        block_m2 = np.square(valid - block_mean).sum()
+        delta = block_mean - mean
+        total = count + valid.size
+        mean += delta * valid.size / total
+        m2 += block_m2 + delta ** 2 * count * valid.size / total
+        count = total
+
+        minimum = valid.min() if minimum is None else min(minimum, valid.min())
+        maximum = valid.max() if maximum is None else max(maximum, valid.max())
+
+    if count == 0:
+        return {"count": 0, "missing": missing}
+
+    return {"count": count, "missing": missing, "mean": float(mean), "std": float(np.sqrt(m2 / count)),
+            "min": float(minimum), "max": float(maximum)}
+
+
+def _rounded(var: xr.DataArray, decimals: int = 4) -> list:
+    values = np.asarray(var.values)
+    if np.issubdtype(values.dtype, np.floating):
+        values = np.round(values, decimals)
+    return values.tolist()
+
+
+def _preview_content(dataset: xr.Dataset, max_chars: int) -> str:
+    """Shape aware preview: corners, strided samples and summary statistics of each variable."""
+    parts = [f"attrs: {dataset.attrs}", f"dims: {dict(dataset.sizes)}", "data_vars:"]
+
+    # Statistics of all the variables come first, so they survive truncation
+    for name, var in dataset.data_vars.items():
+        parts.append(f"{name} {var.dims} shape={var.shape} {var.attrs}")
+        parts.append(f"  statistics: {_summary_statistics(var)}")
+
+    parts.append("samples:")
+    for name, var in dataset.data_vars.items():
+        if var.ndim == 0:
+            continue
+        corners, strided = {}, {}
+        for dim, length in zip(var.dims, var.shape):
+            corners[dim], strided[dim] = _preview_indices(length)
+        parts.append(f"{name} corners {corners}: {_rounded(var.isel(corners))}")
+        parts.append(f"{name} strided samples {strided}: {_rounded(var.isel(strided))}")
+
+    content = "\n".join(parts)
+    if len(content) > max_chars:
+        content = content[:max_chars] + "... [truncated]"
+    return content
@@ -0,0 +1,128 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+from langchain_core.tools import BaseTool
+from typing import ClassVar, List, Optional, Type
+from pydantic import BaseModel, Field
+from climagent.state.dataset_state import DatasetState
+from climagent.state.json_state import JsonState
+from climagent.state.spatial_index import get_spatial_index
+from climagent.tracing import traced_tool
+from climagent.tools.tool_executor import run_blocking
+from climagent.state.operation_plan import ExtractPoints, SpatialMask
+
+
+def _read_stations(path: str):
+    """Latitudes, longitudes and names of the stations listed in a CSV file."""
+    import pandas as pd
+
+    stations = pd.read_csv(path)
+    columns = {c.lower(): c for c in stations.columns}
+    lat = next((columns[c] for c in ("lat", "latitude") if c in columns), None)
+    lon = next((columns[c] for c in ("lon", "longitude") if c in columns), None)
+    name = next((columns[c] for c in ("name", "station", "id") if c in columns), None)
+    if lat is None or lon is None:
+        raise ValueError(f"The stations file needs 'lat' and 'lon' columns, found {list(stations.columns)}")
+    names = stations[name].astype(str).tolist() if name is not None else None
+    return stations[lat].astype(float).tolist(), stations[lon].astype(float).tolist(), names
+
+
+class ExtractPointsInput(BaseModel):
+    latitudes: List[float] = Field(default_factory=list, description="Latitudes of the points to extract.")
+    longitudes: List[float] = Field(default_factory=list, description="Longitudes of the points to extract, in the same order as the latitudes.")
+    names: Optional[List[str]] = Field(default=None, description="Optional names of the points, used as labels of the 'station' dimension.")
+    stations_file: Optional[str] = Field(default=None, description="Path of a CSV file with 'lat', 'lon' and optionally 'name' columns, to use instead of latitudes and longitudes for many points.")
+
+class ExtractPointsTool(BaseTool):
+    name: str = "extract_points"
+    description: str = "Extract the time series at many (lat, lon) points at once, taking the nearest grid cell of each point. Works on regular and curvilinear grids. The points become a new 'station' dimension, with their coordinates and the distance to the grid cell in km."
+    args_schema: Type[ExtractPointsInput] = ExtractPointsInput
+    dataset_state: DatasetState
+    json_state: JsonState
+    mutates_state: ClassVar[bool] = True
+
+    def __init__(self, dataset_state: DatasetState, json_state: JsonState, **kwargs):
+        kwargs["dataset_state"] = dataset_state
+        kwargs["json_state"] = json_state
+        super().__init__(**kwargs)
+
+    @traced_tool
+    def _run(self, latitudes: Optional[List[float]] = None, longitudes: Optional[List[float]] = None, names: Optional[List[str]] = None,
+             stations_file: Optional[str] = None) -> str:
+
+        try:
+            if stations_file is not None:
+                latitudes, longitudes, names = _read_stations(stations_file)
+            latitudes, longitudes = latitudes or [], longitudes or []
+
+            if not latitudes or len(latitudes) != len(longitudes):
+                return "Error: Provide the same number of latitudes and longitudes, or a stations file."
+            if names is not None and len(names) != len(latitudes):
+                return "Error: Provide one name for each point."
+
+            index = get_spatial_index(self.dataset_state.view)
+            operation = ExtractPoints(lats=tuple(latitudes), lons=tuple(longitudes),
+                                      names=tuple(names) if names else None, dims=index.dims)
+            points_dat = self.dataset_state.apply_operation(operation, tool=self.name)
+            self.json_state.update_json_spec(points_dat, operation)
+            return f"Points extracted successfully: {operation.describe()}"
+
+        except Exception as e:
+            return f"Error in points extraction: {e}"
+
+    async def _arun(self, latitudes: Optional[List[float]] = None, longitudes: Optional[List[float]] = None, names: Optional[List[str]] = None,
+                    stations_file: Optional[str] = None) -> str:
+        return await run_blocking(self._run, latitudes, longitudes, names, stations_file)
+
+
+
+
+
+class SpatialSubsetInput(BaseModel):
+    lat_min: Optional[float] = Field(default=None, description="Southern bound of the box.")
+    lat_max: Optional[float] = Field(default=None, description="Northern bound of the box.")
+    lon_min: Optional[float] = Field(default=None, description="Western bound of the box. It can be larger than lon_max for boxes crossing the antimeridian.")
+    lon_max: Optional[float] = Field(default=None, description="Eastern bound of the box.")
+    polygon: Optional[List[List[float]]] = Field(default=None, description="Vertices [lat, lon] of a polygon, in order. Cells outside the polygon are masked.")
+
+class SpatialSubsetTool(BaseTool):
+    name: str = "spatial_subset"
+    description: str = "Keep the grid cells inside a lat/lon box and/or a polygon. Works on regular and curvilinear grids, unlike subset_dataset that works on one coordinate at a time."
+    args_schema: Type[SpatialSubsetInput] = SpatialSubsetInput
+    dataset_state: DatasetState
+    json_state: JsonState
+    mutates_state: ClassVar[bool] = True
+
+    def __init__(self, dataset_state: DatasetState, json_state: JsonState, **kwargs):
+        kwargs["dataset_state"] = dataset_state
+        kwargs["json_state"] = json_state
+        super().__init__(**kwargs)
+
+    @traced_tool
+    def _run(self, lat_min: Optional[float] = None, lat_max: Optional[float] = None, lon_min: Optional[float] = None,
+             lon_max: Optional[float] = None, polygon: Optional[List[List[float]]] = None) -> str:
+
+        bounds = (lat_min, lat_max, lon_min, lon_max)
+        if any(b is None for b in bounds) and any(b is not None for b in bounds):
+            return "Error: Provide all of lat_min, lat_max, lon_min and lon_max for a box."
+        if all(b is None for b in bounds) and not polygon:
+            return "Error: Provide a box, a polygon, or both."
+        if polygon and (len(polygon) < 3 or any(len(v) != 2 for v in polygon)):
+            return "Error: A polygon needs at least three [lat, lon] vertices."
+
+        try:
+            index = get_spatial_index(self.dataset_state.view)
+            operation = SpatialMask(
+                dims=index.dims,
+                bbox=bounds if lat_min is not None else None,
+                polygon=tuple(tuple(v) for v in polygon) if polygon else None)
+            region_dat = self.dataset_state.apply_operation(operation, tool=self.name)
+            self.json_state.update_json_spec(region_dat, operation)
+            return f"Spatial subset executed successfully: {operation.describe()}"
+
+        except Exception as e:
+            return f"Error in spatial subsetting: {e}"
+
+    async def _arun(self, lat_min: Optional[float] = None, lat_max: Optional[float] = None, lon_min: Optional[float] = None,
+                    lon_max: Optional[float] = None, polygon: Optional[List[List[float]]] = None) -> str:
+        return await run_blocking(self._run, lat_min, lat_max, lon_min, lon_max, polygon)
@@ -0,0 +1,250 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import contextvars
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager, nullcontext
+from typing import List, Optional
+
+
+# Tracer and span of the current agent run, propagated to the tool threads
+_current_tracer = contextvars.ContextVar("climagent_tracer", default=None)
+_current_span = contextvars.ContextVar("climagent_span", default=None)
+
+# Records the peak of the Python allocations (NumPy arrays included) of each span, with tracemalloc
+TRACE_MEMORY = os.getenv("CLIMAGENT_TRACE_MEMORY", "0").lower() not in ("", "0", "false")
+
+# Spans open while allocations are traced: span id -> [traced memory at start, highest peak since]
+_open_spans = {}
+_open_spans_lock = threading.Lock()
+
+
+def _max_rss_bytes() -> int:
+    """Highest resident memory of the process since it started."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _rss_bytes() -> Optional[int]:
+    """Current resident memory of the process, None where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _observe_peak():
+    """Folds the tracemalloc peak into every open span and resets it; called with the lock held."""
+    _, peak = tracemalloc.get_traced_memory()
+    for entry in _open_spans.values():
+        entry[1] = max(entry[1], peak)
+    tracemalloc.reset_peak()
+
+
+def _start_allocations(span_id: str):
+    with _open_spans_lock:
+        _observe_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        _open_spans[span_id] = [current, current]
+
+
+def _peak_allocations(span_id: str) -> int:
+    """Highest traced memory above its start value while the span was open."""
+    with _open_spans_lock:
+        _observe_peak()
+        start, peak = _open_spans.pop(span_id)
+    return peak - start
+
+
+class Span:
+    """A timed unit of work (graph node or tool call) with its metrics."""
+
+    def __init__(self, name: str, kind: str, parent_id: Optional[str] = None, attributes: Optional[dict] = None):
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time()
+        self.duration_s = None
+        self.status = "ok"
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> dict:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start_time": self.start_time,
+            "duration_s": self.duration_s,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class CollectorSink:
+    """Keeps the spans in memory."""
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def emit(self, span: Span):
+        with self._lock:
+            self.spans.append(span.to_dict())
+
+
+class JsonlSink:
+    """Appends one JSON line per span to a file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, span: Span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock, open(self.path, "a") as f:
+            f.write(line + "\n")
+
+
+class OpenTelemetrySink:
+    """Exports the spans through an OpenTelemetry tracer (requires opentelemetry-api)."""
+
+    def __init__(self, tracer=None):
+        from opentelemetry import trace
+        self.tracer = tracer or trace.get_tracer("climagent")
+
+    def emit(self, span: Span):
+        attributes = {"climagent.kind": span.kind, "climagent.status": span.status}
+        for key, value in span.attributes.items():
+            attributes[f"climagent.{key}"] = value if isinstance(value, (str, bool, int, float)) else str(value)
+        start = int(span.start_time * 1e9)
+        otel_span = self.tracer.start_span(span.name, start_time=start, attributes=attributes)
+        otel_span.end(end_time=start + int((span.duration_s or 0.0) * 1e9))
+
+
+class Tracer:
+    """Creates spans and sends the finished ones to the sinks.
+
+    Every span records the change of the resident memory of the process
+    (`rss_delta_bytes`). With `trace_memory`, tracemalloc is started and
+    spans also record the peak of the allocations made while they are open
+    (`peak_alloc_bytes`), which slows allocations down. Both are measured
+    process-wide: spans running concurrently include each other's memory.
+    """
+
+    def __init__(self, sinks: Optional[List] = None, trace_memory: bool = TRACE_MEMORY):
+        self.collector = CollectorSink()
+        self.sinks = [self.collector] + list(sinks or [])
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @property
+    def spans(self) -> List[dict]:
+        return list(self.collector.spans)
+
+    @contextmanager
+    def activate(self):
+        """Makes this tracer the current one for the code run inside the block."""
+        token = _current_tracer.set(self)
+        try:
+            yield self
+        finally:
+            _current_tracer.reset(token)
+
+    @contextmanager
+    def span(self, name: str, kind: str, **attributes):
+        parent = _current_span.get()
+        span = Span(name, kind, parent.span_id if parent else None, attributes)
+        token = _current_span.set(span)
+        trace_memory = self.trace_memory and tracemalloc.is_tracing()
+        if trace_memory:
+            _start_allocations(span.span_id)
+        rss_before = _rss_bytes()
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span.status = f"error: {type(e).__name__}: {e}"
+            raise
+        finally:
+            span.duration_s = time.perf_counter() - start
+            rss_after = _rss_bytes()
+            span.set(rss_delta_bytes=None if rss_before is None or rss_after is None else rss_after - rss_before,
+                     max_rss_bytes=_max_rss_bytes())
+            if trace_memory:
+                span.set(peak_alloc_bytes=_peak_allocations(span.span_id))
+            _current_span.reset(token)
+            for sink in self.sinks:
+                sink.emit(span)
+
+
+def current_tracer() -> Optional[Tracer]:
+    return _current_tracer.get()
+
+
+class _NullSpan:
+    def set(self, **attributes):
+        pass
+
+
+def span(name: str, kind: str, **attributes):
+    """Span of the current tracer, or a no-op context when tracing is not active."""
+    tracer = current_tracer()
+    if tracer is None:
+        return nullcontext(_NullSpan())
+    return tracer.span(name, kind, **attributes)
+
+
+def _dataset_metrics(dataset_state, prefix: str) -> dict:
+    view = dataset_state.view
+    return {f"{prefix}_shape": dict(view.sizes), f"{prefix}_nbytes": int(view.nbytes)}
+
+
+def traced_tool(run):
+    """Decorator for BaseTool._run: records a span when a tracer is active."""
+
+    @functools.wraps(run)
+    def wrapper(self, *args, **kwargs):
+        tracer = current_tracer()
+        if tracer is None:
+            return run(self, *args, **kwargs)
+
+        dataset_state = getattr(self, "dataset_state", None)
+        cache = getattr(dataset_state, "cache", None)
+        cache_before = cache.stats() if cache is not None else None
+
+        with tracer.span(self.name, "tool", args=kwargs or list(args)) as span:
+            if dataset_state is not None:
+                span.set(**_dataset_metrics(dataset_state, "input"))
+            result = run(self, *args, **kwargs)
+            if dataset_state is not None:
+                span.set(**_dataset_metrics(dataset_state, "output"))
+            if cache is not None:
+                cache_after = cache.stats()
+                span.set(cache={k: cache_after[k] - cache_before[k] for k in ("hits", "prefix_hits", "misses")})
+            if isinstance(result, str) and result.startswith("Error"):
+                span.status = "error"
+            return result
+
+    return wrapper
+
+
+def token_usage(message) -> dict:
+    """Token counts of an LLM response, when the provider reports them."""
+    usage = getattr(message, "usage_metadata", None) or {}
+    return {k: usage[k] for k in ("input_tokens", "output_tokens", "total_tokens") if k in usage}
@@ -1,20 +1,25 @@
-from climagent.tools.xarray_tools_indexing import SubsetDatasetTool
+from climagent.tools.xarray_tools_indexing import SubsetDatasetTool, SelectVariablesTool
 from climagent.tools.xarray_tools_grouping import ResampleTimeTool
 from climagent.tools.xarray_tools_aggregating import AggregateDatasetTool
+from climagent.tools.xarray_tools_derive import DeriveVariableTool
 from climagent.state.dataset_state import DatasetState
 from climagent.state.json_state import JsonState
 
 
-from langchain_openai import AzureChatOpenAI
 import os
 import json
-import pandas as pd
-
-from dotenv import load_dotenv
-load_dotenv("../credentials.env")
+import time
+import numpy as np
+import xarray as xr
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 def initialize_llm():
+    # The LLM provider and the credentials are only loaded when an LLM is needed
+    from dotenv import load_dotenv
+    from langchain_openai import AzureChatOpenAI
+
+    load_dotenv("../credentials.env")
     return AzureChatOpenAI(
         deployment_name=os.getenv("GPT_DEPLOYMENT_NAME"),
         openai_api_version=os.getenv("OPENAI_API_VERSION"),
@@ -27,14 +32,16 @@ def initialize_llm():
 
 ## UTILS FOR EVALUATION
 
-def deterministic_process_dataset(dataset, functions):
-    dataset_state_ref = DatasetState(dataset)
+def deterministic_process_dataset(dataset, functions, cache=None):
+    dataset_state_ref = DatasetState(dataset, cache=cache)
     json_state_ref = JsonState(dataset)
     
     tools = {
         "subset": SubsetDatasetTool(dataset_state=dataset_state_ref, json_state=json_state_ref),
+        "select_variables": SelectVariablesTool(dataset_state=dataset_state_ref, json_state=json_state_ref),
         "resampletime_dataset": ResampleTimeTool(dataset_state=dataset_state_ref, json_state=json_state_ref),
-        "aggregate_dataset": AggregateDatasetTool(dataset_state=dataset_state_ref, json_state=json_state_ref)
+        "aggregate_dataset": AggregateDatasetTool(dataset_state=dataset_state_ref, json_state=json_state_ref),
+        "derive_variable": DeriveVariableTool(dataset_state=dataset_state_ref, json_state=json_state_ref)
     }
     
     for function in functions:
@@ -55,5 +62,109 @@ def load_queries(query_file):
         return json.load(f)
 
 def save_statistics_to_excel(stats, filename="evaluation_results.xlsx"):
+    import pandas as pd
+
     df = pd.DataFrame(stats)
-    df.to_excel(filename, index=False)
\ No newline at end of file
+    df.to_excel(filename, index=False)
+
+
+## PARALLEL EVALUATION
+
+# Dataset opened once by each worker process of run_evaluation
+_worker_dataset = None
+
+
+def open_dataset_lazily(path):
+    """Opens a NetCDF file or a Zarr store without loading values in memory."""
+    if path.rstrip("/").endswith(".zarr"):
+        return xr.open_zarr(path)
+    return xr.open_dataset(path, chunks={})
+
+
+def _init_worker(dataset_path):
+    global _worker_dataset
+    _worker_dataset = open_dataset_lazily(dataset_path)
+
+
+def compare_datasets(result, reference, rtol=1e-5, atol=1e-8):
+    """Compares two datasets numerically, variable by variable."""
+    if set(result.data_vars) != set(reference.data_vars):
+        return {"match": False, "error": f"Variables differ: {sorted(result.data_vars)} != {sorted(reference.data_vars)}"}
+
+    max_abs_error = 0.0
+    for var in reference.data_vars:
+        res, ref = result[var], reference[var]
+        if res.sizes != ref.sizes:
+            return {"match": False, "error": f"Shape of {var} differs: {dict(res.sizes)} != {dict(ref.sizes)}"}
+        res_values, ref_values = np.asarray(res.transpose(*ref.dims).values), np.asarray(ref.values)
+
+        if not np.issubdtype(ref_values.dtype, np.number):
+            if not np.array_equal(res_values, ref_values):
+                return {"match": False, "error": f"Values of {var} differ"}
+            continue
+
+        diff = np.abs(res_values.astype(float) - ref_values.astype(float))
+        error = float(np.nanmax(diff)) if ref_values.size and not np.isnan(diff).all() else 0.0
+        max_abs_error = max(max_abs_error, error)
+        if not np.allclose(res_values, ref_values, rtol=rtol, atol=atol, equal_nan=True):
+            return {"match": False, "max_abs_error": error, "error": f"Values of {var} differ"}
+
+    return {"match": True, "max_abs_error": max_abs_error, "error": None}
+
+
+def evaluate_query(query, dataset=None, rtol=1e-5, atol=1e-8):
+    """Processes a query and compares it with its reference.
+
+    The query is a dict with the tool calls to evaluate in 'functions' and
+    either the reference tool calls in 'reference_functions' or the path of
+    a NetCDF/Zarr reference output in 'reference'.
+    """
+    dataset = _worker_dataset if dataset is None else dataset
+    stats = {"id": query.get("id")}
+    start = time.perf_counter()
+
+    try:
+        result = deterministic_process_dataset(dataset, query["functions"]).dataset
+        if "reference_functions" in query:
+            reference = deterministic_process_dataset(dataset, query["reference_functions"]).dataset
+        else:
+            reference = open_dataset_lazily(query["reference"]).load()
+        stats.update(compare_datasets(result, reference, rtol=rtol, atol=atol))
+
+    except Exception as e:
+        stats.update({"match": False, "error": f"{type(e).__name__}: {e}"})
+
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+def run_evaluation(dataset_path, queries, output_file="evaluation_results.jsonl", max_workers=None, rtol=1e-5, atol=1e-8):
+    """Evaluates the queries on a process pool, streaming statistics to a JSONL file.
+
+    Every worker opens the dataset lazily once, instead of receiving a
+    pickled copy for each query. Returns a summary of the run.
+    """
+    summary = {"total": 0, "matched": 0, "mismatched": 0, "seconds": 0.0}
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(dataset_path,)) as pool, \
+            open(output_file, "w") as f:
+        futures = [pool.submit(evaluate_query, query, None, rtol, atol) for query in queries]
+
+        for future in as_completed(futures):
+            stats = future.result()
+            f.write(json.dumps(stats, default=str) + "\n")
+            f.flush()
+
+            summary["total"] += 1
+            summary["matched"] += int(stats["match"])
+            summary["mismatched"] += int(not stats["match"])
+            summary["seconds"] += stats["seconds"]
+
+    return summary
+
+
+def load_statistics(filename="evaluation_results.jsonl"):
+    """Loads the statistics written by run_evaluation."""
+    with open(filename, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
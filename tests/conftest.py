@@ -0,0 +1,32 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+
+def make_dataset(n_time: int = 96, n_lat: int = 6, n_lon: int = 8, freq: str = "D", seed: int = 0) -> xr.Dataset:
+    """Small ERA5-like dataset: t2m and tp on (time, lat, lon), in memory."""
+    rng = np.random.default_rng(seed)
+    coords = {
+        "time": pd.date_range("2000-01-01", periods=n_time, freq=freq),
+        "lat": np.linspace(60, 30, n_lat),
+        "lon": np.linspace(0, 35, n_lon),
+    }
+    dims = ("time", "lat", "lon")
+    shape = (n_time, n_lat, n_lon)
+    return xr.Dataset(
+        {
+            "t2m": (dims, rng.normal(285, 10, shape).astype("float32"), {"units": "K", "long_name": "2 metre temperature"}),
+            "tp": (dims, rng.gamma(1.0, 0.001, shape).astype("float32"), {"units": "m", "long_name": "Total precipitation"}),
+        },
+        coords=coords,
+        attrs={"title": "Test dataset"},
+    )
+
+
+@pytest.fixture
+def dataset() -> xr.Dataset:
+    return make_dataset()
@@ -0,0 +1,41 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import numpy as np
+import xarray as xr
+
+from climagent.state.dataset_state import DatasetState
+from climagent.state.json_state import JsonState
+from climagent.tools.xarray_tools_aggregating import AggregateDatasetTool
+
+
+def _aggregate(dataset, **kwargs):
+    state = DatasetState(dataset)
+    output = AggregateDatasetTool(dataset_state=state, json_state=JsonState(dataset)).invoke(kwargs)
+    assert output.startswith("Aggregation executed successfully"), output
+    return state.dataset
+
+
+def test_single_statistic_matches_xarray(dataset):
+    result = _aggregate(dataset, func="max", dims=["time"])
+    xr.testing.assert_allclose(result, dataset.max(dim="time"))
+
+
+def test_several_statistics_in_one_pass(dataset):
+    result = _aggregate(dataset, funcs=["mean", "std", "count"], dims=["lat", "lon"])
+
+    assert set(result.data_vars) == {f"{v}_{f}" for v in ("t2m", "tp") for f in ("mean", "std", "count")}
+    np.testing.assert_allclose(result["t2m_mean"], dataset["t2m"].mean(dim=["lat", "lon"]), rtol=1e-5)
+    np.testing.assert_allclose(result["tp_std"], dataset["tp"].std(dim=["lat", "lon"]), rtol=1e-4)
+    np.testing.assert_array_equal(result["t2m_count"], dataset.sizes["lat"] * dataset.sizes["lon"])
+
+
+def test_coslat_weighted_mean(dataset):
+    result = _aggregate(dataset, func="mean", dims=["lat", "lon"], weights="coslat")
+    expected = dataset["t2m"].weighted(np.cos(np.deg2rad(dataset.lat))).mean(dim=["lat", "lon"])
+    np.testing.assert_allclose(result["t2m"], expected, rtol=1e-5)
+
+
+def test_unknown_function_is_rejected(dataset):
+    tool = AggregateDatasetTool(dataset_state=DatasetState(dataset), json_state=JsonState(dataset))
+    assert tool._run(func="mode").startswith("Error")
@@ -0,0 +1,113 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import os
+
+import pytest
+import xarray as xr
+
+from conftest import make_dataset
+from climagent.state import catalog as catalog_module
+from climagent.state.catalog import DatasetCatalog
+from climagent.state.operation_plan import Aggregate, SelectVariables, Subset
+
+
+@pytest.fixture
+def archive(tmp_path):
+    """Two years split in a northern and a southern tile, one file each."""
+    dataset = make_dataset(n_time=731)
+    for year in ("2000", "2001"):
+        for tile, lats in (("north", slice(60, 45)), ("south", slice(45, 30))):
+            dataset.sel(time=year, lat=lats).to_netcdf(tmp_path / f"t2m_{year}_{tile}.nc")
+    return dataset, tmp_path
+
+
+def _catalog(tmp_path, source=None):
+    return DatasetCatalog(source or str(tmp_path / "*.nc"), index_path=str(tmp_path / "index.json"))
+
+
+def _names(paths):
+    return sorted(os.path.basename(p) for p in paths)
+
+
+def test_sources_are_expanded_from_globs_and_manifests(archive):
+    _, tmp_path = archive
+    manifest = tmp_path / "files.txt"
+    manifest.write_text("# tiles\nt2m_2000_north.nc\n\nt2m_2001_north.nc\n")
+
+    assert len(_catalog(tmp_path).paths) == 4
+    assert _names(_catalog(tmp_path, str(manifest)).paths) == ["t2m_2000_north.nc", "t2m_2001_north.nc"]
+    with pytest.raises(FileNotFoundError):
+        _catalog(tmp_path, str(tmp_path / "*.zarr"))
+
+
+def test_only_changed_files_are_indexed_again(archive, monkeypatch):
+    _, tmp_path = archive
+    _catalog(tmp_path)
+
+    indexed = []
+    index_file = catalog_module.index_file
+    monkeypatch.setattr(catalog_module, "index_file", lambda path: indexed.append(path) or index_file(path))
+    _catalog(tmp_path)
+    assert indexed == []
+
+    changed = tmp_path / "t2m_2001_south.nc"
+    stat = os.stat(changed)
+    os.utime(changed, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    catalog = _catalog(tmp_path)
+    assert indexed == [str(changed)]
+    assert catalog.index[str(changed)]["mtime_ns"] == stat.st_mtime_ns + 10 ** 9
+
+
+def test_skeleton_describes_the_combined_dataset_without_opening_files(archive):
+    dataset, tmp_path = archive
+    catalog = _catalog(tmp_path)
+    skeleton = catalog.skeleton()
+
+    assert not catalog._opened
+    assert dict(skeleton.sizes) == dict(dataset.sizes)
+    assert set(skeleton.data_vars) == set(dataset.data_vars)
+    for name in ("time", "lat", "lon"):
+        assert (skeleton[name].values == dataset[name].values).all()
+    assert skeleton["t2m"].attrs == dataset["t2m"].attrs
+
+
+@pytest.mark.parametrize("operations, expected", [
+    # A single value keeps the files nearest to it
+    ([Subset(coordinate_name="lat", values=(40.0,))], ["t2m_2000_south.nc", "t2m_2001_south.nc"]),
+    ([Subset(coordinate_name="lat", values=(45.0,))], ["t2m_2000_north.nc", "t2m_2000_south.nc", "t2m_2001_north.nc", "t2m_2001_south.nc"]),
+    ([Subset(coordinate_name="time", values=("2001",))], ["t2m_2001_north.nc", "t2m_2001_south.nc"]),
+    # Slices keep the files they overlap
+    ([Subset(coordinate_name="lat", values=(55.0, 50.0)), Subset(coordinate_name="time", values=("2001-03", "2001-05"))], ["t2m_2001_north.nc"]),
+    ([SelectVariables(variable_names=("t2m",)), Subset(coordinate_name="time", values=("2000-12-31", "2001-01-01"))],
+     ["t2m_2000_north.nc", "t2m_2000_south.nc", "t2m_2001_north.nc", "t2m_2001_south.nc"]),
+    # Selections after another operation do not prune
+    ([Aggregate(func="mean", dims=("lon",)), Subset(coordinate_name="time", values=("2001",))],
+     ["t2m_2000_north.nc", "t2m_2000_south.nc", "t2m_2001_north.nc", "t2m_2001_south.nc"]),
+])
+def test_selections_prune_the_files(archive, operations, expected):
+    _, tmp_path = archive
+    assert _names(_catalog(tmp_path).select(operations)) == expected
+
+
+def test_pruned_files_hold_the_selection(archive):
+    dataset, tmp_path = archive
+    catalog = _catalog(tmp_path)
+    operations = [Subset(coordinate_name="lat", values=(55.0, 50.0)), Subset(coordinate_name="time", values=("2001-03", "2001-05"))]
+
+    selected = catalog.open(catalog.select(operations)).sel(lat=slice(55.0, 50.0), time=slice("2001-03", "2001-05"))
+    xr.testing.assert_allclose(selected.load(), dataset.sel(lat=slice(55.0, 50.0), time=slice("2001-03", "2001-05")))
+
+
+def test_evicted_datasets_are_closed(archive, monkeypatch):
+    _, tmp_path = archive
+    catalog = _catalog(tmp_path)
+    monkeypatch.setattr(catalog_module, "OPEN_DATASETS", 1)
+    closed = []
+    close = xr.Dataset.close
+    monkeypatch.setattr(xr.Dataset, "close", lambda self: closed.append(self) or close(self))
+
+    first = catalog.open(catalog.paths[:1])
+    assert catalog.open(catalog.paths[:1]) is first
+    catalog.open(catalog.paths[1:2])
+    assert len(closed) == 1 and closed[0] is first
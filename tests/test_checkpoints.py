@@ -0,0 +1,106 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import xarray as xr
+
+from climagent.state.dataset_state import DatasetState
+from climagent.state.json_state import JsonState
+from climagent.state.operation_plan import Aggregate, SelectVariables, Subset
+from climagent.tools.xarray_tools_checkpoint import BranchDatasetTool, CheckpointDatasetTool, RevertDatasetTool
+
+
+SUBSET = Subset(coordinate_name="lat", values=(55.0, 40.0))
+MEAN = Aggregate(func="mean", dims=("time",))
+
+
+def test_checkpoints_retain_their_values_once_computed(dataset):
+    state = DatasetState(dataset)
+    state.apply_operation(SUBSET)
+    state.apply_operation(MEAN)
+    state.save_checkpoint("mean")
+
+    (checkpoint,) = state.list_checkpoints()
+    assert not checkpoint["retained"] and state._materialized is None
+    expected = MEAN.apply(SUBSET.apply(dataset))
+    xr.testing.assert_allclose(state.dataset, expected)
+    (checkpoint,) = state.list_checkpoints()
+    assert checkpoint["retained"] and checkpoint["nbytes"] == expected.nbytes
+
+
+def test_revert_resumes_from_the_retained_values(dataset):
+    state = DatasetState(dataset)
+    state.apply_operation(SUBSET)
+    state.save_checkpoint("subset")
+    state.dataset
+    state.apply_operation(MEAN)
+    state.revert("subset")
+
+    assert len(state.plan) == 0
+    xr.testing.assert_identical(state.dataset, SUBSET.apply(dataset))
+    state.apply_operation(SelectVariables(variable_names=("tp",)))
+    xr.testing.assert_allclose(state.dataset, SUBSET.apply(dataset)[["tp"]])
+
+
+def test_evicted_checkpoints_are_recomputed(dataset):
+    state = DatasetState(dataset, checkpoint_bytes=SUBSET.apply(dataset).nbytes)
+    for name, operation in (("subset", SUBSET), ("mean", MEAN), ("t2m", SelectVariables(variable_names=("t2m",)))):
+        state.apply_operation(operation)
+        state.save_checkpoint(name)
+        state.dataset
+
+    retained = {c["name"]: c["retained"] for c in state.list_checkpoints()}
+    assert retained == {"subset": False, "mean": True, "t2m": True}
+    state.revert("subset")
+    xr.testing.assert_identical(state.dataset, SUBSET.apply(dataset))
+
+
+def test_shared_values_are_counted_once(dataset):
+    state = DatasetState(dataset, checkpoint_bytes=int(SUBSET.apply(dataset).nbytes * 1.5))
+    state.apply_operation(SUBSET)
+    state.save_checkpoint("a")
+    state.dataset
+    state.save_checkpoint("b")
+
+    assert [c["retained"] for c in state.list_checkpoints()] == [True, True]
+    assert state.checkpoints["a"].materialized is state.checkpoints["b"].materialized
+
+
+def test_evicted_checkpoints_resume_from_an_ancestor_matched_by_lineage(dataset):
+    state = DatasetState(dataset)
+    state.apply_operation(SUBSET)
+    state.save_checkpoint("subset")
+    subset = state.dataset
+    # The following checkpoints derive from the retained values of "subset"
+    state.revert("subset")
+    state.apply_operation(MEAN)
+    state.save_checkpoint("mean")
+    state.dataset
+    state.apply_operation(SelectVariables(variable_names=("t2m",)))
+    state.save_checkpoint("t2m")
+    state.checkpoints["mean"].materialized = None
+
+    state.revert("t2m")
+    assert state.base is subset and len(state.plan) == 2
+    xr.testing.assert_allclose(state.dataset, MEAN.apply(SUBSET.apply(dataset))[["t2m"]])
+
+
+def test_branch_tool_keeps_both_branches(dataset):
+    dataset_state, json_state = DatasetState(dataset), JsonState(dataset)
+    tools = {tool.name: tool for tool in (
+        CheckpointDatasetTool(dataset_state=dataset_state, json_state=json_state),
+        RevertDatasetTool(dataset_state=dataset_state, json_state=json_state),
+        BranchDatasetTool(dataset_state=dataset_state, json_state=json_state),
+    )}
+    tools["checkpoint_dataset"].invoke({"name": "start"})
+    dataset_state.apply_operation(MEAN)
+    json_state.update_json_spec(dataset_state.view, MEAN)
+
+    output = tools["branch_dataset"].invoke({"checkpoint": "start", "name": "other", "save_current_as": "mean"})
+    assert output.startswith("Branch created successfully")
+    assert dataset_state.current_checkpoint == "other"
+    assert "time" in dataset_state.view.dims and "time" in json_state.get_spec().dict_["coords"]
+    assert {c["name"]: c["parent"] for c in dataset_state.list_checkpoints()} == {"start": None, "mean": "start", "other": "start"}
+
+    assert tools["branch_dataset"].invoke({"checkpoint": "missing", "name": "x"}).startswith("Error")
+    tools["revert_dataset"].invoke({"name": "mean"})
+    assert "time" not in dataset_state.dataset.dims
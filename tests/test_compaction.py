@@ -0,0 +1,72 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+
+from climagent.agent.compaction import compact_messages, estimate_tokens
+
+
+def _call(call_id, name, args):
+    return AIMessage(content="", tool_calls=[{"id": call_id, "name": name, "args": args}])
+
+
+def _conversation():
+    return [
+        SystemMessage(content="You are an agent."),
+        HumanMessage(content="Analyse the dataset."),
+        _call("0", "look_dataset", {"max_chars": 5000}),
+        ToolMessage(content="w" * 4000, tool_call_id="0", name="look_dataset"),
+        _call("1", "look_dataset", {"max_chars": 5000}),
+        ToolMessage(content="x" * 4000, tool_call_id="1", name="look_dataset"),
+        _call("2", "subset_dataset", {"coordinate_name": "lat", "values": ["40", "50"]}),
+        ToolMessage(content="Subset executed successfully: " + "y" * 1000, tool_call_id="2", name="subset_dataset"),
+        _call("3", "look_dataset", {"max_chars": 5000}),
+        ToolMessage(content="z" * 4000, tool_call_id="3", name="look_dataset"),
+        _call("4", "aggregate_dataset", {"dims": ["time"]}),
+        ToolMessage(content="Aggregation executed successfully", tool_call_id="4", name="aggregate_dataset"),
+    ]
+
+
+def test_messages_within_budget_are_unchanged():
+    messages = _conversation() + [SystemMessage(content="You are an agent.")]
+    assert compact_messages(messages, max_tokens=10 ** 6) == _conversation()
+
+
+def test_stale_outputs_are_compacted_and_the_last_turn_is_kept():
+    messages = _conversation()
+    compacted = compact_messages(messages, max_tokens=400, dataset_summary="Current dataset: ...",
+                                 mutating_tools={"subset_dataset", "aggregate_dataset"})
+
+    assert estimate_tokens(compacted) <= 400
+    assert compacted[-2:] == messages[-2:]
+    tool_outputs = {m.tool_call_id: m.content for m in compacted if isinstance(m, ToolMessage)}
+    assert tool_outputs["0"].startswith("[compacted: superseded by a later identical call]")
+    assert tool_outputs["2"].startswith("[compacted: see the current dataset state]")
+    # The dataset changed between the two last looks, so neither supersedes the other
+    assert tool_outputs["1"].startswith("[compacted: stale tool output]")
+    assert tool_outputs["3"].startswith("[compacted: stale tool output]")
+
+
+def test_errors_of_mutating_tools_are_kept():
+    messages = _conversation()
+    messages[7] = ToolMessage(content="Error: Unknown coordinate 'lat'.", tool_call_id="2", name="subset_dataset")
+    compacted = compact_messages(messages, max_tokens=400, dataset_summary="Current dataset: ...",
+                                 mutating_tools={"subset_dataset", "aggregate_dataset"})
+
+    tool_outputs = {m.tool_call_id: m.content for m in compacted if isinstance(m, ToolMessage)}
+    assert tool_outputs["2"] == "Error: Unknown coordinate 'lat'."
+    # A failed operation leaves the dataset unchanged, the first look is superseded by the second one
+    assert tool_outputs["1"].startswith("[compacted: superseded by a later identical call]")
+
+
+def test_dataset_summary_follows_the_leading_system_messages():
+    compacted = compact_messages(_conversation(), max_tokens=400, dataset_summary="Current dataset: ...",
+                                 mutating_tools={"subset_dataset"})
+
+    system = [i for i, m in enumerate(compacted) if isinstance(m, SystemMessage)]
+    assert system == [0, 1]
+    assert compacted[1].content == "Current dataset: ..."
+    # Every tool output still answers the call right before it
+    for i, m in enumerate(compacted):
+        if isinstance(m, ToolMessage):
+            assert compacted[i - 1].tool_calls[0]["id"] == m.tool_call_id
@@ -0,0 +1,46 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import pytest
+import xarray as xr
+
+from climagent.state import cost as cost_module
+from climagent.state.cost import MemoryBudgetExceeded
+from climagent.state.dataset_state import DatasetState
+from climagent.state.json_state import JsonState
+from climagent.state.operation_plan import Aggregate, SelectVariables, Subset
+from climagent.tools.xarray_tools_cost import DryRunTool
+
+
+def test_estimate_matches_the_planned_result(dataset):
+    state = DatasetState(dataset)
+    operations = [SelectVariables(variable_names=("t2m",)), Subset(coordinate_name="lat", values=(55.0, 40.0)), Aggregate(func="mean", dims=("time",))]
+    cost = state.estimate(operations)
+
+    expected = dataset[["t2m"]].sel(lat=slice(55.0, 40.0)).mean("time")
+    assert cost["output_sizes"] == dict(expected.sizes)
+    assert cost["output_variables"] == ["t2m"]
+    assert cost["bytes_read"] == dataset["t2m"].sel(lat=slice(55.0, 40.0)).nbytes
+
+
+def test_dry_run_leaves_the_session_untouched(dataset):
+    state, json_state = DatasetState(dataset), JsonState(dataset)
+    tool = DryRunTool(dataset_state=state, json_state=json_state)
+
+    output = tool.invoke({"steps": [{"tool": "aggregate_dataset", "func": "mean", "dims": ["time"]}]})
+    assert output.startswith("Estimated cost") and "'time'" not in output.split("variables")[0]
+    assert len(state.plan) == 0 and "time" in json_state.get_spec().dict_["coords"]
+    assert tool.invoke({}).startswith("Estimated cost")
+    assert tool.invoke({"steps": [{"tool": "aggregate_dataset", "func": "mean", "dims": ["depth"]}]}).startswith("Error in step 1")
+
+
+def test_plans_above_the_budget_are_streamed_or_rejected(dataset, monkeypatch):
+    monkeypatch.setattr(cost_module, "MIN_CHUNK_BYTES", 1024)
+    state = DatasetState(dataset, memory_budget=dataset.nbytes // 2)
+    state.apply_operation(Aggregate(func="mean", dims=("time",)))
+    xr.testing.assert_allclose(state.dataset, dataset.mean("time"))
+
+    state = DatasetState(dataset, memory_budget=dataset.nbytes // 2)
+    state.apply_operation(Subset(coordinate_name="lat", values=(60.0, 30.0)))
+    with pytest.raises(MemoryBudgetExceeded):
+        state.dataset
@@ -0,0 +1,38 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import dask
+import pytest
+import xarray as xr
+
+from climagent.state.dataset_state import DatasetState
+from climagent.state.export import export_dataset, export_path
+from climagent.state.operation_plan import Subset
+
+from conftest import make_dataset
+
+
+def test_exported_chunks_stay_below_the_dask_chunk_size(tmp_path):
+    source = tmp_path / "source.nc"
+    make_dataset(n_time=3000, n_lat=30, n_lon=50).to_netcdf(source, engine="scipy")
+
+    with dask.config.set({"array.chunk-size": "1MiB"}):
+        state = DatasetState(xr.open_dataset(source, engine="scipy"))
+        state.apply_operation(Subset(coordinate_name="lat", values=(60.0, 30.0)))
+        manifest = export_dataset(state.lazy_dataset(), str(tmp_path / "out.zarr"))
+
+    chunks = manifest["variables"]["t2m"]["chunks"]
+    assert chunks[1:] == [30, 50] and chunks[0] < 3000
+    assert chunks[0] * 30 * 50 * 4 <= 1024 ** 2
+    xr.testing.assert_allclose(xr.open_zarr(tmp_path / "out.zarr").compute(), state.dataset)
+
+
+def test_requested_chunks_are_kept(tmp_path, dataset):
+    manifest = export_dataset(dataset, str(tmp_path / "out.zarr"), chunks={"time": 10})
+    assert manifest["variables"]["tp"]["chunks"] == [10, 6, 8]
+
+
+def test_store_names_cannot_leave_the_export_directory(tmp_path):
+    with pytest.raises(ValueError):
+        export_path("../escape", "zarr", str(tmp_path))
+    assert export_path("result", "netcdf", str(tmp_path)) == str(tmp_path / "result.nc")
@@ -0,0 +1,90 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from climagent.state.dataset_state import DatasetState
+from climagent.state.expressions import BLOCK_SIZE, Expression, derive
+from climagent.state.operation_plan import Derive, OperationPlan, SelectVariables, Subset
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("t2m - 273.15", lambda d: d.t2m - 273.15),
+    ("sqrt(t2m**2 + tp**2)", lambda d: np.sqrt(d.t2m ** 2 + d.tp ** 2)),
+    ("where(t2m > 290, tp * 1000, 0)", lambda d: xr.where(d.t2m > 290, d.tp * 1000, 0)),
+    ("maximum(t2m, 285) % 7 - -tp", lambda d: np.maximum(d.t2m, 285) % 7 + d.tp),
+    ("log(tp + 1) / pi", lambda d: np.log(d.tp + 1) / np.pi),
+    ("t2m", lambda d: d.t2m),
+])
+def test_values_match_numpy(dataset, text, expected):
+    result = derive(dataset, "x", text)["x"]
+    np.testing.assert_allclose(result, expected(dataset), rtol=1e-6)
+    assert result.dtype == np.float32
+
+
+def test_blocks_larger_than_the_buffers_and_dask_data(dataset):
+    values = np.arange(3 * BLOCK_SIZE + 5, dtype=np.float64)
+    data = xr.Dataset({"a": ("n", values)})
+    np.testing.assert_array_equal(derive(data, "b", "a * 2 + 1")["b"], values * 2 + 1)
+
+    lazy = derive(dataset.chunk({"time": 10}), "c", "t2m - 273.15")
+    assert lazy["c"].chunks
+    np.testing.assert_allclose(lazy["c"].compute(), dataset.t2m - 273.15, rtol=1e-6)
+
+
+@pytest.mark.parametrize("text", [
+    "__import__('os').system('ls')",
+    "t2m.__class__",
+    "[t2m for t2m in tp]",
+    "lambda: t2m",
+    "t2m if tp else 1",
+    "open('f')",
+    "sqrt(t2m, tp)",
+    "unknown + 1",
+    "t2m + 'a'",
+    "t2m +" ,
+    "t2m + " * 200 + "1",
+])
+def test_unsafe_or_invalid_expressions_are_rejected(text):
+    with pytest.raises(ValueError):
+        Expression(text, ["t2m", "tp"])
+
+
+def test_units_are_inferred_only_when_they_follow(dataset):
+    units = {"t2m": "K", "tp": "m", "u": "m s-1"}
+    assert Expression("t2m - t2m", units).units(units) == "K"
+    assert Expression("abs(t2m) + maximum(t2m, t2m)", units).units(units) == "K"
+    assert Expression("sqrt(u**2 + u**2)", units).units(units) == "m s-1"
+    assert Expression("u**2", units).units(units) == "(m s-1)^2"
+    assert Expression("t2m - 273.15", units).units(units) is None
+    assert Expression("tp * 1000", units).units(units) is None
+    assert Expression("t2m + tp", units).units(units) is None
+
+    attrs = derive(dataset, "c", "t2m - 273.15", units="degC", long_name="Temperature")["c"].attrs
+    assert attrs == {"long_name": "Temperature", "expression": "t2m - 273.15", "units": "degC"}
+
+
+def test_derived_variables_need_a_variable_and_a_free_name(dataset):
+    with pytest.raises(ValueError):
+        derive(dataset, "x", "1 + 2")
+    with pytest.raises(ValueError):
+        derive(dataset, "lat", "t2m")
+
+
+def test_plan_keeps_the_operands_of_derived_variables(dataset):
+    operations = [
+        Derive(name="c", expression="t2m - 273.15"),
+        Subset(coordinate_name="lat", values=(55.0, 40.0)),
+        SelectVariables(variable_names=("c",)),
+    ]
+    optimized = list(OperationPlan(operations).optimize(dataset))
+    assert [type(op) for op in optimized] == [Subset, Derive, SelectVariables]
+
+    state = DatasetState(dataset)
+    for operation in operations:
+        state.apply_operation(operation)
+    expected = (dataset.t2m - 273.15).sel(lat=slice(55.0, 40.0))
+    np.testing.assert_allclose(state.dataset["c"], expected, rtol=1e-6)
+    assert list(state.dataset.data_vars) == ["c"]
@@ -0,0 +1,29 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import numpy as np
+import pytest
+
+from conftest import make_dataset
+from climagent.state.grouped_reduction import REDUCERS, _partials, climatology, group_labels
+
+
+@pytest.mark.parametrize("by", ["month", "dayofyear"])
+@pytest.mark.parametrize("func", REDUCERS)
+def test_chunked_climatology_matches_xarray(by, func):
+    dataset = make_dataset(n_time=800)
+    dataset["t2m"][5:40, 1, 2] = np.nan
+    dataset["t2m"][:, 0, 0] = np.nan
+    expected = getattr(dataset.groupby(f"time.{by}"), func)("time")
+
+    result = climatology(dataset.chunk({"time": 37, "lat": 4}), "time", by, func).compute()
+    np.testing.assert_allclose(result["t2m"].values, expected["t2m"].transpose(by, ...).values, rtol=1e-5, atol=1e-5)
+
+
+def test_block_partials_only_cover_the_groups_present():
+    dataset = make_dataset(n_time=800)
+    codes, groups = group_labels(dataset["time"], "dayofyear")
+
+    parts = _partials(dataset["t2m"].values[:30], codes[:30], ("mean",))
+    assert len(groups) == 366
+    assert parts.shape == (5, 30) + dataset["t2m"].shape[1:]
@@ -0,0 +1,9 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+from climagent.startup import IMPORT_BUDGET, check_import_budget
+
+
+def test_agent_import_within_budget():
+    # Raises RuntimeError above CLIMAGENT_IMPORT_BUDGET seconds
+    assert check_import_budget() <= IMPORT_BUDGET
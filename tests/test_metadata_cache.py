@@ -0,0 +1,92 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import os
+
+import pytest
+import xarray as xr
+
+from climagent.state import metadata_cache as metadata_cache_module
+from climagent.state.json_state import JsonState
+from climagent.state.metadata_cache import MetadataCache, schema_hash, source_identity
+
+
+@pytest.fixture
+def source(dataset, tmp_path):
+    path = tmp_path / "era5.nc"
+    dataset.to_netcdf(path)
+    return path
+
+
+def _spec(path, cache, **open_kwargs):
+    with xr.open_dataset(path, **open_kwargs) as dataset:
+        return JsonState(dataset, metadata_cache=cache).get_spec().dict_
+
+
+def _count_summaries(monkeypatch):
+    calls = []
+    summarize = JsonState._summarize
+    monkeypatch.setattr(JsonState, "_summarize", lambda self, dataset: calls.append(1) or summarize(self, dataset))
+    return calls
+
+
+def test_reopening_an_unchanged_file_reads_the_sidecar(source, tmp_path, monkeypatch):
+    cache = MetadataCache(str(tmp_path / "sidecars"))
+    first = _spec(source, cache)
+
+    def walk(self, dataset):
+        raise AssertionError("the dataset was summarized again")
+
+    monkeypatch.setattr(JsonState, "_summarize", walk)
+    assert _spec(source, cache) == first
+    assert len(os.listdir(cache.cache_dir)) == 1
+
+
+def test_sidecars_are_invalidated_by_size_mtime_and_schema(dataset, source, tmp_path, monkeypatch):
+    cache = MetadataCache(str(tmp_path / "sidecars"))
+    _spec(source, cache)
+    calls = _count_summaries(monkeypatch)
+
+    stat = os.stat(source)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    _spec(source, cache)
+    assert len(calls) == 1
+
+    # Same structure opened differently
+    assert "tp" not in _spec(source, cache, drop_variables=["tp"])["data_vars"]
+    assert len(calls) == 2
+
+    # Rewritten with the same modification time, only the size tells the change
+    mtime_ns = os.stat(source).st_mtime_ns
+    dataset.assign_attrs(title="reanalysis " * 100).to_netcdf(source)
+    os.utime(source, ns=(mtime_ns, mtime_ns))
+    assert os.stat(source).st_size != stat.st_size
+    assert _spec(source, cache)["attrs"]["title"].startswith("reanalysis")
+    assert len(calls) == 3
+    # Nothing changed since the last read
+    _spec(source, cache)
+    assert len(calls) == 3
+
+
+def test_failed_writes_leave_no_partial_sidecar(source, tmp_path, monkeypatch):
+    cache = MetadataCache(str(tmp_path / "sidecars"))
+    with xr.open_dataset(source) as dataset:
+        identity, schema = source_identity(dataset), schema_hash(dataset)
+
+    def dump(data, f):
+        f.write('{"version": ')
+        raise OSError("disk full")
+
+    monkeypatch.setattr(metadata_cache_module.json, "dump", dump)
+    cache.save(identity, schema, {"attrs": {}})
+    assert os.listdir(cache.cache_dir) == []
+    assert cache.load(identity, schema) is None
+
+    def dump(data, f):
+        f.write('{"version": ')
+        raise TypeError("not serializable")
+
+    monkeypatch.setattr(metadata_cache_module.json, "dump", dump)
+    with pytest.raises(TypeError):
+        cache.save(identity, schema, {"attrs": {}})
+    assert os.listdir(cache.cache_dir) == []
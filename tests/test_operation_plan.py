@@ -0,0 +1,76 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import xarray as xr
+
+from climagent.state.dataset_state import DatasetState
+from climagent.state.operation_plan import (
+    Aggregate, Climatology, ExtractPoints, OperationPlan, Quantiles, SelectVariables, Subset)
+
+
+def _run(dataset, operations):
+    state = DatasetState(dataset)
+    for operation in operations:
+        state.apply_operation(operation)
+    return state.dataset
+
+
+def test_selections_are_moved_ahead_of_reductions(dataset):
+    operations = [
+        Aggregate(func="mean", dims=("lon",)),
+        SelectVariables(variable_names=("t2m",)),
+        Subset(coordinate_name="lat", values=(55.0, 40.0)),
+    ]
+    optimized = OperationPlan(operations).optimize(dataset)
+    assert [type(op) for op in optimized] == [SelectVariables, Subset, Aggregate]
+    xr.testing.assert_allclose(_run(dataset, operations), OperationPlan(operations).execute(dataset))
+
+
+def test_subset_stays_after_the_reduction_of_its_coordinate(dataset):
+    operations = [Aggregate(func="mean", dims=("lat",)), Subset(coordinate_name="lat", values=(55.0, 40.0))]
+    assert list(OperationPlan(operations).optimize(dataset)) == operations
+
+
+def test_adjacent_numeric_slices_are_fused(dataset):
+    operations = [Subset(coordinate_name="lat", values=(60.0, 35.0)), Subset(coordinate_name="lat", values=(55.0, 30.0))]
+    optimized = list(OperationPlan(operations).optimize(dataset))
+    assert optimized == [Subset(coordinate_name="lat", values=(55.0, 35.0))]
+    xr.testing.assert_identical(_run(dataset, operations), OperationPlan(operations).execute(dataset))
+
+
+def test_subset_on_climatology_groups_is_not_moved(dataset):
+    operations = [Climatology(coordinate_name="time", by="month", func="mean"), Subset(coordinate_name="month", values=(2,))]
+    assert list(OperationPlan(operations).optimize(dataset)) == operations
+    result = _run(dataset, operations)
+    xr.testing.assert_allclose(result, OperationPlan(operations).execute(dataset).compute())
+    assert "month" not in result.dims
+
+
+def test_subset_on_extracted_stations_is_not_moved(dataset):
+    operations = [
+        ExtractPoints(lats=(45.0, 50.0), lons=(10.0, 20.0), names=("a", "b"), dims=("lat", "lon")),
+        Subset(coordinate_name="station", values=("b",)),
+    ]
+    assert list(OperationPlan(operations).optimize(dataset)) == operations
+    result = _run(dataset, operations)
+    assert result["station"].item() == "b"
+    assert result["t2m"].dims == ("time",)
+
+
+def test_subset_on_quantiles_is_not_moved(dataset):
+    operations = [Quantiles(q=(0.1, 0.9), dims=("time",), method="exact"), Subset(coordinate_name="quantile", values=(0.9,))]
+    assert list(OperationPlan(operations).optimize(dataset)) == operations
+    result = _run(dataset, operations)
+    expected = dataset.quantile(0.9, dim="time")
+    xr.testing.assert_allclose(result["t2m"], expected["t2m"].astype(result["t2m"].dtype), rtol=1e-5)
+
+
+def test_subset_moves_past_operations_after_the_one_creating_its_coordinate(dataset):
+    operations = [
+        Climatology(coordinate_name="time", by="month", func="mean"),
+        Aggregate(func="mean", dims=("lon",)),
+        Subset(coordinate_name="month", values=(1, 2)),
+    ]
+    optimized = list(OperationPlan(operations).optimize(dataset))
+    assert [type(op) for op in optimized] == [Climatology, Subset, Aggregate]
+    xr.testing.assert_allclose(_run(dataset, operations), OperationPlan(operations).execute(dataset).compute())
@@ -0,0 +1,80 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from climagent.agent.climagent import ClimAgent
+from climagent.agent.pipeline import Pipeline, validate_pipeline
+from climagent.agent.replay_llm import ScriptedChatModel
+from climagent.state.json_state import JsonState
+
+
+SUBSET = {"tool": "subset_dataset", "coordinate_name": "lat", "values": ["55", "40"]}
+RESAMPLE = {"tool": "resampletime_dataset", "coordinate_name": "time", "frequency": "MS"}
+SPATIAL_MEAN = {"tool": "aggregate_dataset", "dims": ["lat", "lon"]}
+LOOK = {"tool": "look_dataset", "max_chars": 2000}
+
+
+def _errors(dataset, *steps):
+    return validate_pipeline(Pipeline(steps=list(steps)), JsonState(dataset))
+
+
+def test_valid_pipelines_have_no_errors(dataset):
+    assert _errors(dataset, SUBSET, {"tool": "select_variables", "variable_names": ["t2m"]}, RESAMPLE, SPATIAL_MEAN, LOOK) == []
+
+
+def test_unknown_coordinates_are_reported(dataset):
+    (error,) = _errors(dataset, dict(SUBSET, coordinate_name="latitude"))
+    assert error.startswith("Step 1 (subset_dataset): unknown coordinate 'latitude'")
+
+
+def test_dimensions_removed_by_an_aggregation_cannot_be_used(dataset):
+    errors = _errors(dataset, {"tool": "aggregate_dataset", "dims": ["time"]}, RESAMPLE, {"tool": "aggregate_dataset", "dims": ["time", "lat"]})
+    assert [e.split(":")[0] for e in errors] == ["Step 2 (resampletime_dataset)", "Step 3 (aggregate_dataset)"]
+    assert "unknown dimensions ['time']" in errors[1]
+
+
+@pytest.mark.parametrize("reduction", [
+    dict(RESAMPLE, funcs=["max", "min"]),
+    {"tool": "aggregate_dataset", "dims": ["time"], "funcs": ["max", "min"]},
+])
+def test_several_reductions_rename_the_variables(dataset, reduction):
+    assert _errors(dataset, reduction, {"tool": "select_variables", "variable_names": ["t2m_max", "tp_min"]}) == []
+    (error,) = _errors(dataset, reduction, {"tool": "select_variables", "variable_names": ["t2m"]})
+    assert "unknown variables ['t2m']" in error
+
+
+def test_derived_variables_can_be_used_later(dataset):
+    derive = {"tool": "derive_variable", "name": "t2m_c", "expression": "t2m - 273.15", "units": "degC"}
+    assert _errors(dataset, derive, {"tool": "derive_variable", "name": "t2m_f", "expression": "t2m_c * 1.8 + 32"},
+                   {"tool": "select_variables", "variable_names": ["t2m_f"]}) == []
+    (error,) = _errors(dataset, {"tool": "derive_variable", "name": "wind", "expression": "sqrt(u10**2 + v10**2)"})
+    assert error.startswith("Step 1 (derive_variable)") and "u10" in error
+
+
+def _planned(steps):
+    return AIMessage(content="", tool_calls=[{"name": "Pipeline", "args": {"steps": steps}, "id": "plan", "type": "tool_call"}])
+
+
+def test_scripted_pipeline_runs_every_step(dataset):
+    steps = [SUBSET, {"tool": "select_variables", "variable_names": ["t2m"]}, RESAMPLE, SPATIAL_MEAN, LOOK]
+    agent = ClimAgent(dataset, ScriptedChatModel(script=[_planned(steps), "answer"]), structured_plan=True)
+    result = agent.run([HumanMessage(content="Monthly mean temperature between 40N and 55N")])
+
+    outputs = [m.content for m in result["messages"] if isinstance(m, ToolMessage)]
+    assert len(outputs) == len(steps) and not any(o.startswith("Error") for o in outputs)
+    assert outputs[-1].startswith("Dataset content")
+    assert result["messages"][-1].content == "answer"
+    assert [s["name"] for s in result["spans"] if s["kind"] == "tool"] == [step["tool"] for step in steps]
+    assert dict(agent.dataset_state.view.sizes) == {"time": 4}
+
+
+def test_invalid_pipelines_are_not_executed(dataset):
+    steps = [SPATIAL_MEAN, SUBSET]
+    agent = ClimAgent(dataset, ScriptedChatModel(script=[_planned(steps), "answer"]), structured_plan=True)
+    result = agent.run([HumanMessage(content="q")])
+
+    assert not any(isinstance(m, ToolMessage) for m in result["messages"])
+    assert "unknown coordinate 'lat'" in "\n".join(str(m.content) for m in result["messages"])
+    assert agent.dataset_state.history == []
@@ -0,0 +1,71 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import xarray as xr
+
+from climagent.state.dataset_state import DatasetState
+from climagent.state.operation_plan import SelectVariables, Subset
+from climagent.state.prefetch import Prefetcher, covers, plan_hints
+
+
+def _opened(dataset, tmp_path):
+    path = tmp_path / "source.nc"
+    dataset.to_netcdf(path, engine="scipy")
+    return xr.open_dataset(path, engine="scipy")
+
+
+def test_files_opened_without_chunks_are_prefetched(dataset, tmp_path):
+    prefetcher = Prefetcher()
+    state = DatasetState(_opened(dataset, tmp_path), prefetcher=prefetcher)
+    state.apply_operation(SelectVariables(variable_names=("t2m",)))
+    state.apply_operation(Subset(coordinate_name="lat", values=(55.0, 40.0)))
+
+    state.prefetch().result()
+    xr.testing.assert_identical(state.dataset, dataset[["t2m"]].sel(lat=slice(55.0, 40.0)))
+    stats = prefetcher.stats()
+    assert (stats["loaded"], stats["hits"], stats["blocks"]) == (1, 1, 1)
+
+
+def test_datasets_in_memory_are_not_prefetched(dataset):
+    state = DatasetState(dataset, prefetcher=Prefetcher())
+    state.apply_operation(Subset(coordinate_name="lat", values=(55.0, 40.0)))
+    assert state.prefetch() is None
+
+
+def test_blocks_cover_narrower_selections(dataset, tmp_path):
+    prefetcher = Prefetcher()
+    state = DatasetState(_opened(dataset, tmp_path), prefetcher=prefetcher)
+    state.prefetch([Subset(coordinate_name="time", values=("2000-01-01", "2000-02-29"))]).result()
+
+    state.apply_operation(Subset(coordinate_name="time", values=("2000-01-10", "2000-01-20")))
+    state.apply_operation(Subset(coordinate_name="lat", values=(55.0, 40.0)))
+    xr.testing.assert_identical(state.dataset, dataset.sel(time=slice("2000-01-10", "2000-01-20"), lat=slice(55.0, 40.0)))
+    assert prefetcher.stats()["hits"] == 1
+
+
+def test_covers_checks_variables_and_labels(dataset):
+    block = dataset[["t2m"]].isel(time=slice(0, 30))
+    assert covers(block, dataset[["t2m"]].isel(time=slice(5, 10), lat=0))
+    assert not covers(block, dataset[["tp"]].isel(time=slice(5, 10)))
+    assert not covers(block, dataset[["t2m"]].isel(time=slice(20, 40)))
+
+
+def test_plan_hints_name_variables_and_years(dataset):
+    hints = plan_hints("Average t2m over 2000 and 2001 with `aggregate_dataset`", dataset)
+    assert hints == [
+        SelectVariables(variable_names=("t2m",)),
+        Subset(coordinate_name="time", values=("2000-01-01", "2001-12-31T23:59:59")),
+    ]
+
+
+def test_least_recently_used_blocks_are_evicted(dataset):
+    chunked = dataset[["t2m"]].chunk({"time": 32})
+    parts = {key: chunked.isel(time=slice(32 * i, 32 * (i + 1))) for i, key in enumerate("abc")}
+    prefetcher = Prefetcher(capacity=int(parts["a"].nbytes * 2.5))
+    for key, part in parts.items():
+        prefetcher.prefetch("source", key, lambda part=part: part).result()
+
+    stats = prefetcher.stats()
+    assert stats["evictions"] == 1 and stats["blocks"] == 2
+    assert prefetcher.lookup("source", parts["a"]) is None
+    assert prefetcher.lookup("source", parts["c"]) is not None
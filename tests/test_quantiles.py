@@ -0,0 +1,57 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import numpy as np
+import pytest
+
+from climagent.state.quantiles import quantiles, rank_error_bound, sketch_quantiles
+
+from conftest import make_dataset
+
+
+Q = (0.01, 0.1, 0.5, 0.9, 0.99)
+
+
+def _rank_errors(values, estimates, q):
+    """Largest rank error (fraction of the values) of the estimated quantiles, per quantile."""
+    values = np.sort(values.ravel())
+    ranks = np.searchsorted(values, estimates, side="left") / values.size
+    return np.abs(ranks - np.asarray(q))
+
+
+def test_in_memory_and_single_block_data_get_exact_quantiles(dataset):
+    for data in (dataset, dataset.chunk({"time": -1, "lat": 2})):
+        result = quantiles(data, ("time",), Q, method="sketch", exact_bytes=0)
+        assert result["t2m"].attrs["quantile_method"] == "exact"
+        np.testing.assert_allclose(result["t2m"], dataset["t2m"].quantile(list(Q), dim="time"), rtol=1e-6)
+
+
+def test_sketched_quantiles_are_within_their_error_bound():
+    dataset = make_dataset(n_time=4000, n_lat=2, n_lon=2).chunk({"time": 250})
+    result = quantiles(dataset, ("time",), Q, method="auto", exact_bytes=0)
+    attrs = result["t2m"].attrs
+
+    assert attrs["quantile_method"] == "sketch"
+    values = dataset["t2m"].values
+    for i in range(2):
+        for j in range(2):
+            errors = _rank_errors(values[:, i, j], result["t2m"].values[:, i, j], Q)
+            assert np.all(errors <= np.asarray(attrs["quantile_rank_error"]))
+
+
+def test_sketches_ignore_nans():
+    import dask.array as da
+
+    values = np.random.default_rng(1).normal(size=(2000, 3))
+    values[::3] = np.nan
+    result, levels = sketch_quantiles(da.from_array(values, chunks=(100, 3)), (0,), (0.5,))
+
+    assert levels > 1
+    finite = values[~np.isnan(values[:, 0])]
+    error = _rank_errors(finite[:, 0], result.compute()[:, 0], (0.5,))
+    assert error[0] <= rank_error_bound(0.5, levels, finite.shape[0])
+
+
+def test_unknown_dimensions_are_rejected(dataset):
+    with pytest.raises(ValueError):
+        quantiles(dataset, ("depth",), Q)
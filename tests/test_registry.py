@@ -0,0 +1,102 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import asyncio
+import threading
+
+import pytest
+from langchain_core.messages import HumanMessage
+
+from climagent.agent.registry import AgentRegistry, SessionBusy
+from climagent.agent.replay_llm import ScriptedChatModel
+
+
+def _registry(dataset, release=None, **kwargs):
+    """Registry on `dataset` whose model answers once `release` is set."""
+
+    def answer(messages):
+        if release is not None:
+            release.wait(timeout=10)
+        return "answer"
+
+    registry = AgentRegistry(**kwargs)
+    registry.register("era5", dataset, ScriptedChatModel(script=[answer] * 20))
+    return registry
+
+
+async def _until(condition):
+    while not condition():
+        await asyncio.sleep(0.01)
+
+
+def test_sessions_reject_requests_above_max_pending(dataset):
+    release = threading.Event()
+    session = _registry(dataset, release, session_pending=2).open_session("era5")
+
+    async def main():
+        runs = [asyncio.create_task(session.arun([HumanMessage(content=f"q{i}")])) for i in range(2)]
+        await _until(lambda: session.pending == 2)
+        with pytest.raises(SessionBusy):
+            await session.arun([HumanMessage(content="q2")])
+        release.set()
+        return await asyncio.gather(*runs)
+
+    results = asyncio.run(main())
+    assert [r["messages"][-1].content for r in results] == ["answer", "answer"]
+    assert session.pending == 0
+    # Runs of a session are serialized, both questions are in its conversation
+    assert [m.content for m in session.messages if isinstance(m, HumanMessage)] in (["q0", "q1"], ["q1", "q0"])
+
+
+def test_idle_sessions_expire(dataset):
+    registry = _registry(dataset, session_ttl=60)
+    idle, busy = registry.open_session("era5"), registry.open_session("era5")
+    idle.last_used -= 120
+    busy.last_used -= 120
+    busy.pending = 1
+
+    registry.open_session("era5")
+    assert idle.session_id not in registry.sessions
+    assert busy.session_id in registry.sessions
+    with pytest.raises(KeyError):
+        registry.get_session(idle.session_id)
+
+
+def test_least_recently_used_sessions_are_closed_first(dataset):
+    registry = _registry(dataset, max_sessions=2)
+    first, second = registry.open_session("era5"), registry.open_session("era5")
+    registry.get_session(first.session_id)
+
+    third = registry.open_session("era5")
+    assert list(registry.sessions) == [first.session_id, third.session_id]
+    assert second.agent is not first.agent and first.agent.graph is second.agent.graph
+
+
+def test_server_answers_429_for_busy_sessions_and_503_when_full(dataset):
+    pytest.importorskip("aiohttp")
+    from aiohttp.test_utils import TestClient, TestServer
+    from climagent.agent.server import create_app
+
+    release = threading.Event()
+    registry = _registry(dataset, release, session_pending=1)
+
+    async def main():
+        client = TestClient(TestServer(create_app(registry, max_running=1, max_queued=0)))
+        await client.start_server()
+        try:
+            busy, other = [(await (await client.post("/sessions", json={"dataset": "era5"})).json())["session_id"]
+                           for _ in range(2)]
+            first = asyncio.create_task(client.post(f"/sessions/{busy}/messages", json={"content": "q"}))
+            await _until(lambda: registry.get_session(busy).pending == 1)
+
+            same_session = await client.post(f"/sessions/{busy}/messages", json={"content": "q"})
+            other_session = await client.post(f"/sessions/{other}/messages", json={"content": "q"})
+            release.set()
+            answered = await first
+            return same_session.status, other_session.status, other_session.headers.get("Retry-After"), answered.status, await answered.json()
+        finally:
+            await client.close()
+
+    same_session, other_session, retry_after, answered, body = asyncio.run(main())
+    assert (same_session, other_session, retry_after) == (429, 503, "1")
+    assert answered == 200 and body["answer"] == "answer"
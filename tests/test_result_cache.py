@@ -0,0 +1,88 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import xarray as xr
+
+from climagent.state.dataset_state import DatasetState
+from climagent.state.operation_plan import Aggregate, ResampleTime, SelectVariables, Subset
+from climagent.state.result_cache import ResultCache
+
+
+def _state(dataset, cache, operations):
+    state = DatasetState(dataset, cache=cache)
+    for operation in operations:
+        state.apply_operation(operation)
+    return state
+
+
+def test_repeated_and_extended_chains_reuse_cached_results(dataset, tmp_path):
+    cache = ResultCache(cache_dir=str(tmp_path))
+    selections = [SelectVariables(variable_names=("t2m",)), Subset(coordinate_name="lat", values=(55.0, 40.0))]
+
+    first = _state(dataset, cache, selections).dataset
+    again = _state(dataset, cache, selections).dataset
+    extended = _state(dataset, cache, selections + [Aggregate(func="mean", dims=("time",))]).dataset
+
+    xr.testing.assert_identical(first, again)
+    xr.testing.assert_allclose(extended, _state(dataset, None, selections + [Aggregate(func="mean", dims=("time",))]).dataset)
+    stats = cache.stats()
+    assert (stats["misses"], stats["hits"], stats["prefix_hits"]) == (1, 1, 1)
+    # The selections and the aggregation are stored once
+    assert stats["memory_entries"] == 2
+
+
+def test_reductions_sharing_a_prefix_reuse_it(dataset, tmp_path):
+    cache = ResultCache(cache_dir=str(tmp_path))
+    prefix = [SelectVariables(variable_names=("t2m",)), ResampleTime(coordinate_name="time", frequency="MS")]
+
+    _state(dataset, cache, prefix + [Aggregate(func="mean", dims=("time",))]).dataset
+    maximum = _state(dataset, cache, prefix + [Aggregate(func="max", dims=("time",))]).dataset
+
+    xr.testing.assert_allclose(maximum, _state(dataset, None, prefix + [Aggregate(func="max", dims=("time",))]).dataset)
+    stats = cache.stats()
+    assert (stats["misses"], stats["prefix_hits"]) == (1, 1)
+
+
+def test_lazy_results_are_stored_and_reused(dataset, tmp_path):
+    cache = ResultCache(cache_dir=str(tmp_path))
+    sessions = [DatasetState(dataset, cache=cache) for _ in range(2)]
+
+    views = []
+    for state in sessions:
+        state.apply_operation(Subset(coordinate_name="lat", values=(55.0, 40.0)))
+        views.append(state.lazy_dataset())
+        assert views[-1].chunks
+
+    stats = cache.stats()
+    assert (stats["misses"], stats["hits"], stats["memory_entries"]) == (1, 1, 1)
+    xr.testing.assert_identical(views[0].compute(), views[1].compute())
+    xr.testing.assert_identical(views[1].compute(), sessions[1].dataset)
+
+
+def test_values_are_computed_outside_the_lock(dataset, tmp_path):
+    cache = ResultCache(cache_dir=str(tmp_path))
+    acquired = []
+
+    def probe(block):
+        # Runs in a dask worker thread while the result is computed
+        if cache._lock.acquire(timeout=1):
+            cache._lock.release()
+            acquired.append(True)
+        else:
+            acquired.append(False)
+        return block
+
+    chunked = dataset.chunk({"time": 24})
+    chunked["t2m"] = chunked["t2m"].copy(data=chunked["t2m"].data.map_blocks(probe, dtype=chunked["t2m"].dtype))
+    cache.put("key", chunked)
+    assert acquired and all(acquired)
+
+
+def test_results_above_the_memory_tier_are_spilled_to_disk(dataset, tmp_path):
+    cache = ResultCache(memory_bytes=dataset.nbytes // 2, cache_dir=str(tmp_path))
+    stored = cache.put("large", dataset.chunk({"time": 24}))
+
+    assert cache.stats()["disk_entries"] == 1
+    xr.testing.assert_identical(stored.compute(), dataset)
+    # A new cache on the same directory finds the entry
+    assert ResultCache(cache_dir=str(tmp_path)).get("large") is not None
@@ -0,0 +1,40 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import numpy as np
+
+from climagent.state.dataset_state import DatasetState
+from climagent.state.json_state import JsonState
+from climagent.tools.xarray_tools_spatial import ExtractPointsTool, SpatialSubsetTool
+
+
+def _tools(dataset):
+    dataset_state, json_state = DatasetState(dataset), JsonState(dataset)
+    return dataset_state, ExtractPointsTool(dataset_state=dataset_state, json_state=json_state), SpatialSubsetTool(dataset_state=dataset_state, json_state=json_state)
+
+
+def test_points_are_extracted_at_the_nearest_cells(dataset):
+    state, extract, _ = _tools(dataset)
+    output = extract.invoke({"latitudes": [41.0, 59.0], "longitudes": [1.0, 34.0], "names": ["a", "b"]})
+
+    assert output.startswith("Points extracted successfully")
+    result = state.dataset
+    expected = dataset.sel(lat=[41.0, 59.0], lon=[1.0, 34.0], method="nearest")
+    np.testing.assert_array_equal(result["t2m"].sel(station="a"), expected["t2m"].isel(lat=0, lon=0))
+    np.testing.assert_array_equal(result["t2m"].sel(station="b"), expected["t2m"].isel(lat=1, lon=1))
+
+
+def test_points_without_coordinates_are_rejected(dataset):
+    _, extract, _ = _tools(dataset)
+    assert extract.invoke({}).startswith("Error")
+    assert extract.invoke({"latitudes": [41.0]}).startswith("Error")
+
+
+def test_box_subset_keeps_the_cells_inside(dataset):
+    state, _, subset = _tools(dataset)
+    output = subset.invoke({"lat_min": 40.0, "lat_max": 50.0, "lon_min": 0.0, "lon_max": 20.0})
+
+    assert output.startswith("Spatial subset executed successfully")
+    result = state.dataset
+    assert result.lat.min() >= 40.0 and result.lat.max() <= 50.0
+    assert result.lon.min() >= 0.0 and result.lon.max() <= 20.0
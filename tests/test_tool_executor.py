@@ -0,0 +1,89 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import asyncio
+import contextvars
+import threading
+import time
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from climagent.agent.climagent import ClimAgent
+from climagent.agent.replay_llm import ScriptedChatModel
+from climagent.tools.tool_executor import map_blocking, run_blocking
+from climagent.tools.xarray_tools_look import LookDatasetTool
+
+
+def _call(call_id, name, **args):
+    return {"id": call_id, "name": name, "args": args, "type": "tool_call"}
+
+
+def _waiting(barrier, delays):
+    """Blocking function that only returns once `barrier.parties` calls run at once, the first ones last."""
+
+    def func(i):
+        barrier.wait(timeout=5)
+        time.sleep(delays[i])
+        return i
+
+    return func
+
+
+def test_run_blocking_runs_calls_concurrently_and_keeps_their_results():
+    barrier = threading.Barrier(3)
+    func = _waiting(barrier, [0.2, 0.1, 0.0])
+
+    async def main():
+        return await asyncio.gather(*(run_blocking(func, i) for i in range(3)))
+
+    assert asyncio.run(main()) == [0, 1, 2]
+
+
+def test_map_blocking_keeps_the_order_and_the_context():
+    barrier = threading.Barrier(3)
+    func = _waiting(barrier, [0.2, 0.1, 0.0])
+    variable = contextvars.ContextVar("variable", default=None)
+    variable.set("caller")
+
+    assert map_blocking(func, range(3)) == [0, 1, 2]
+    assert map_blocking(lambda i: (i, variable.get()), range(2)) == [(0, "caller"), (1, "caller")]
+
+
+def test_read_only_calls_are_batched_between_mutating_ones(dataset):
+    agent = ClimAgent(dataset, ScriptedChatModel())
+    calls = [_call("1", "look_dataset"), _call("2", "dry_run"), _call("3", "subset_dataset"),
+             _call("4", "select_variables"), _call("5", "look_dataset"), _call("6", "missing_tool")]
+
+    assert [[t["id"] for t in batch] for batch in agent._tool_batches(calls)] == [["1", "2"], ["3"], ["4"], ["5", "6"]]
+
+
+@pytest.mark.parametrize("run_async", [False, True])
+def test_tools_of_one_turn_run_in_batches_and_answer_in_order(dataset, monkeypatch, run_async):
+    events, lock = [], threading.Lock()
+    look = LookDatasetTool._run
+
+    def _run(self, max_chars=10000):
+        with lock:
+            events.append(("start", max_chars))
+        time.sleep(0.2)
+        result = look(self, max_chars)
+        with lock:
+            events.append(("end", max_chars))
+        return result
+
+    monkeypatch.setattr(LookDatasetTool, "_run", _run)
+    calls = [_call("a", "look_dataset", max_chars=1000), _call("b", "look_dataset", max_chars=1001),
+             _call("c", "subset_dataset", coordinate_name="lat", values=["55", "40"]),
+             _call("d", "look_dataset", max_chars=1002)]
+    agent = ClimAgent(dataset, ScriptedChatModel(script=["plan", AIMessage(content="", tool_calls=calls), "answer"]))
+
+    messages = [HumanMessage(content="q")]
+    result = asyncio.run(agent.arun(messages)) if run_async else agent.run(messages)
+
+    outputs = [m for m in result["messages"] if isinstance(m, ToolMessage)]
+    assert [m.tool_call_id for m in outputs] == ["a", "b", "c", "d"]
+    # The two first looks overlap, the last one runs after the subset and sees it
+    assert {e for e in events[:2]} == {("start", 1000), ("start", 1001)}
+    assert events[4:] == [("start", 1002), ("end", 1002)]
+    assert "'lat': 6" in outputs[0].content and "'lat': 3" in outputs[3].content
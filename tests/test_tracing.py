@@ -0,0 +1,71 @@
+# Author: jacopo.grassi@polito.it
+# Institute: Politecnico di Torino
+
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from climagent.state.dataset_state import DatasetState
+from climagent.state.json_state import JsonState
+from climagent.tools.xarray_tools_indexing import SelectVariablesTool
+from climagent.tracing import Tracer, span
+
+
+def test_spans_are_nested_and_report_process_memory():
+    tracer = Tracer()
+    with tracer.activate():
+        with span("agent", "node"):
+            with span("inner", "tool", n=1):
+                pass
+    inner, outer = tracer.spans
+
+    assert inner["parent_id"] == outer["span_id"] and outer["parent_id"] is None
+    assert inner["attributes"]["n"] == 1
+    for record in (inner, outer):
+        assert record["attributes"]["max_rss_bytes"] > 0
+        assert "rss_delta_bytes" in record["attributes"] and "peak_alloc_bytes" not in record["attributes"]
+
+
+def test_spans_report_the_peak_of_their_own_allocations():
+    tracer = Tracer(trace_memory=True)
+    try:
+        with tracer.activate():
+            with span("agent", "node"):
+                with span("large", "tool"):
+                    np.ones(8 * 1024 ** 2 // 8).sum()
+                with span("small", "tool"):
+                    np.ones(1024).sum()
+    finally:
+        tracemalloc.stop()
+    large, small, outer = tracer.spans
+
+    assert large["attributes"]["peak_alloc_bytes"] >= 8 * 1024 ** 2
+    assert small["attributes"]["peak_alloc_bytes"] < 1024 ** 2
+    # The parent span includes the peak of its children
+    assert outer["attributes"]["peak_alloc_bytes"] >= large["attributes"]["peak_alloc_bytes"]
+
+
+def test_failed_spans_are_recorded():
+    tracer = Tracer()
+    with tracer.activate(), pytest.raises(ValueError):
+        with span("agent", "node"):
+            raise ValueError("boom")
+    assert tracer.spans[0]["status"] == "error: ValueError: boom"
+
+
+def test_tool_spans_record_dataset_metrics(dataset):
+    tool = SelectVariablesTool(dataset_state=DatasetState(dataset), json_state=JsonState(dataset))
+    tracer = Tracer()
+    with tracer.activate():
+        tool.invoke({"variable_names": ["t2m"]})
+    (record,) = tracer.spans
+
+    assert record["name"] == "select_variables" and record["kind"] == "tool"
+    assert record["attributes"]["input_nbytes"] == dataset.nbytes
+    assert record["attributes"]["output_nbytes"] == dataset[["t2m"]].nbytes
+
+
+def test_no_span_without_tracer():
+    with span("agent", "node") as s:
+        s.set(x=1)